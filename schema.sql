@@ -36,31 +36,225 @@ create table vehicle_listings (
   mileage integer not null,
   price integer not null,
   title text,
+  remote boolean default false,
+
+  -- listing history compaction (python scripts/db_tools.py compact): a row stands for listing_count scrapes from created_on to last_seen
+  last_seen timestamp,
+  listing_count integer not null default 1,
   unique (vin, created_on)
 )
 
--- see recent scrape results by date, model
-select listings.created_on::date, model, count(*) 
+-- listing history compaction columns
+  -- re-runnable, also applied by: python scripts/db_tools.py setup / compact
+  -- compacting deletes listing rows, so it isn't run from here: python scripts/db_tools.py compact
+alter table vehicle_listings
+  add column if not exists remote boolean default false,
+  add column if not exists last_seen timestamp,
+  add column if not exists listing_count integer not null default 1;
+
+-- analytics indexes & summary views
+  -- re-runnable, also applied by: python scripts/db_tools.py setup
+  -- the summary views are snapshots: refresh them after each scrape with the refresh below or: python scripts/db_tools.py refresh
+create index if not exists vehicle_listings_created_on_idx on vehicle_listings (created_on);
+create index if not exists vehicle_listings_source_created_on_idx on vehicle_listings (source, created_on);
+create index if not exists vehicles_model_idx on vehicles (model);
+
+-- one row per vehicle, first_seen/last_seen/listing_count count compacted rows as every scrape they stand for
+create materialized view if not exists vehicle_summaries as
+select
+  vehicles.vin,
+  vehicles.model,
+  min(listings.created_on) as first_seen,
+  max(coalesce(listings.last_seen, listings.created_on)) as last_seen,
+  sum(listings.listing_count) as listing_count,
+  array_agg(distinct listings.source order by listings.source) as sources
 from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
-where listings.created_on::date > now()::date - interval '2 weeks'
-group by listings.created_on::date, model order by listings.created_on::date desc, model
+group by vehicles.vin, vehicles.model;
+create unique index if not exists vehicle_summaries_vin_idx on vehicle_summaries (vin);
+create index if not exists vehicle_summaries_model_idx on vehicle_summaries (model);
+
+-- listing rows per scrape day, source & model (compacted rows only count on their first day)
+create materialized view if not exists daily_listing_counts as
+select listings.created_on::date as scrape_date, listings.source, vehicles.model, count(*) as listings
+from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
+group by listings.created_on::date, listings.source, vehicles.model;
+create unique index if not exists daily_listing_counts_key_idx on daily_listing_counts (scrape_date, source, model);
+
+-- refresh summary views, concurrently so readers aren't blocked (needs the unique indexes above)
+refresh materialized view concurrently vehicle_summaries;
+refresh materialized view concurrently daily_listing_counts;
+
+-- partition vehicle_listings by created_on month
+  -- queries with a created_on range only scan the months they cover, old months can be detached & archived
+  -- the primary key becomes (id, created_on) since unique constraints have to include the partition key, ids stay unique through the shared sequence
+  -- (vin, created_on) uniqueness & the vehicles fk are kept, columns keep their order (analyze.py reads listings.*)
+  -- also works on a fresh, empty vehicle_listings, re-runnable: skipped once vehicle_listings is partitioned
+  -- one transaction (a do block), drops the summary views & the vehicle_source_listings triggers, afterwards re-create them & the indexes: python scripts/db_tools.py setup
+  -- inserts outside the monthly partitions land in the vehicle_listings_default partition, python scripts/db_tools.py refresh / partitions
+  -- keep months created ahead and move such rows into their month's partition
+  -- detach & move old months to the listings_archive schema: python scripts/db_tools.py archive <YYYY-MM>
+do $migration$
+declare
+  month date;
+begin
+  if (select relkind from pg_class where oid = to_regclass('vehicle_listings')) = 'p' then
+    raise notice 'vehicle_listings is already partitioned, skipping';
+    create table if not exists vehicle_listings_default partition of vehicle_listings default;
+    return;
+  end if;
+
+  alter table vehicle_listings
+    add column if not exists remote boolean default false,
+    add column if not exists last_seen timestamp,
+    add column if not exists listing_count integer not null default 1;
+  drop materialized view if exists vehicle_summaries;
+  drop materialized view if exists daily_listing_counts;
+  drop index if exists vehicle_listings_created_on_idx;
+  drop index if exists vehicle_listings_source_created_on_idx;
+  alter table vehicle_listings rename to vehicle_listings_unpartitioned;
+  alter table vehicle_listings_unpartitioned rename constraint vehicle_listings_pkey to vehicle_listings_unpartitioned_pkey;
+  alter table vehicle_listings_unpartitioned rename constraint vehicle_listings_vin_created_on_key to vehicle_listings_unpartitioned_vin_created_on_key;
+  alter table vehicle_listings_unpartitioned rename constraint vehicle_listings_vin_fkey to vehicle_listings_unpartitioned_vin_fkey;
+
+  create table vehicle_listings (
+    id integer not null default nextval('vehicle_listings_id_seq'),
+    created_on timestamp not null default now(),
+    vin text references vehicles (vin),
+    source text not null,
+    owner text,
+    zip integer not null,
+    mileage integer not null,
+    price integer not null,
+    title text,
+    remote boolean default false,
+    last_seen timestamp,
+    listing_count integer not null default 1,
+    primary key (id, created_on),
+    unique (vin, created_on)
+  ) partition by range (created_on);
+  alter sequence vehicle_listings_id_seq owned by vehicle_listings.id;
+
+  -- one partition per month from the earliest listing through 2 months ahead, named like vehicle_listings_y2021m01
+  for month in
+    select months::date from generate_series(
+      (select date_trunc('month', coalesce(min(created_on), now())) from vehicle_listings_unpartitioned),
+      date_trunc('month', now()) + interval '2 months',
+      interval '1 month'
+    ) months
+  loop
+    execute format(
+      'create table %I partition of vehicle_listings for values from (%L) to (%L)',
+      'vehicle_listings_' || to_char(month, '"y"YYYY"m"MM'), month, month + interval '1 month'
+    );
+  end loop;
+  create table vehicle_listings_default partition of vehicle_listings default;
+
+  insert into vehicle_listings (id, created_on, vin, source, owner, zip, mileage, price, title, remote, last_seen, listing_count)
+  select id, created_on, vin, source, owner, zip, mileage, price, title, remote, last_seen, listing_count
+  from vehicle_listings_unpartitioned;
+  drop table vehicle_listings_unpartitioned;
+end $migration$;
+
+-- per-vin per-source latest listing index
+  -- one row per (vin, source): that source's latest listing, kept current by triggers as listings are inserted / updated (re-seen)
+  -- cheapest active listing across sources & source coverage read <= 1 row per source of a vehicle instead of its whole history
+  -- re-runnable, also applied by: python scripts/db_tools.py setup, which also rebuilds the index (e.g. after deleting listings)
+  -- re-run after the partitioning migration, the triggers are dropped with the old table
+create table if not exists vehicle_source_listings (
+  vin text not null,
+  source text not null,
+  listing_id integer not null,
+  created_on timestamp not null,
+  last_seen timestamp not null,
+  price integer not null,
+  primary key (vin, source)
+);
+
+create or replace function track_vehicle_source_listings() returns trigger as $$
+begin
+  insert into vehicle_source_listings as latest (vin, source, listing_id, created_on, last_seen, price)
+  select distinct on (vin, source) vin, source, id, created_on, coalesce(last_seen, created_on), price
+  from new_listings
+  where vin is not null
+  order by vin, source, created_on desc
+  on conflict (vin, source) do update set
+    listing_id = excluded.listing_id,
+    created_on = excluded.created_on,
+    last_seen = excluded.last_seen,
+    price = excluded.price
+  where excluded.created_on >= latest.created_on;
+  return null;
+end
+$$ language plpgsql;
+
+-- statement level: one upsert per insert / update statement over its new rows (transition table), not one per row
+drop trigger if exists vehicle_source_listings_insert_trigger on vehicle_listings;
+drop trigger if exists vehicle_source_listings_update_trigger on vehicle_listings;
+create trigger vehicle_source_listings_insert_trigger
+  after insert on vehicle_listings
+  referencing new table as new_listings
+  for each statement execute function track_vehicle_source_listings();
+create trigger vehicle_source_listings_update_trigger
+  after update on vehicle_listings
+  referencing new table as new_listings
+  for each statement execute function track_vehicle_source_listings();
+
+begin;
+truncate vehicle_source_listings;
+insert into vehicle_source_listings (vin, source, listing_id, created_on, last_seen, price)
+select distinct on (vin, source) vin, source, id, created_on, coalesce(last_seen, created_on), price
+from vehicle_listings
+where vin is not null
+order by vin, source, created_on desc;
+commit;
+analyze vehicle_source_listings;
+
+-- cheapest active listing of each vehicle across its sources' latest listings
+create or replace view cheapest_active_listings as
+select distinct on (vin) vin, source, listing_id, created_on, last_seen, price
+from vehicle_source_listings
+where last_seen > now() - interval '1 day'
+order by vin, price, created_on desc;
+
+-- see recent scrape results by date, model
+select scrape_date, model, sum(listings)
+from daily_listing_counts
+where scrape_date > now()::date - interval '2 weeks'
+group by scrape_date, model order by scrape_date desc, model
 
 -- see recent scrape results by date, source & model
-select listings.created_on::date, source, model, count(*) 
+select scrape_date, source, model, listings
+from daily_listing_counts
+where scrape_date > now()::date - interval '3 days'
+order by scrape_date desc, source, model
+
+-- see today's scrape results without waiting for a refresh (range on created_on uses vehicle_listings_created_on_idx)
+select source, model, count(*)
 from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
-where listings.created_on::date > now()::date - interval '3 days'
-group by listings.created_on::date, source, model order by listings.created_on::date desc, source, model
+where listings.created_on >= now()::date
+group by source, model order by source, model
 
--- see vehicles not covered by specified sources
+-- see vehicles not covered by specified sources (live from vehicle_source_listings: no view refresh needed)
 with vehicle_sources as (
-  select vehicles.vin, array_agg(distinct listings.source order by listings.source) as all_sources
-  from vehicles join vehicle_listings listings
-    on vehicles.vin = listings.vin
-  group by vehicles.vin
-) select all_sources, count(*)
+  select vin, array_agg(source order by source) as sources
+  from vehicle_source_listings
+  group by vin
+) select sources, count(*)
 from vehicle_sources
-where ARRAY['autolist', 'edmunds'] && all_sources = false
-group by all_sources order by count(*) desc
+where ARRAY['autolist', 'edmunds'] && sources = false
+group by sources order by count(*) desc, sources
+
+-- see vehicles not covered by specified sources, by model (anti-join on vehicle_source_listings)
+select vehicles.model, count(*) as not_covered
+from vehicles
+where exists (select 1 from vehicle_source_listings listed where listed.vin = vehicles.vin)
+  and not exists (select 1 from vehicle_source_listings covered where covered.vin = vehicles.vin and covered.source = any(ARRAY['autolist', 'edmunds']))
+group by vehicles.model order by vehicles.model
+
+-- see which source has the cheapest active listing how often
+select source, count(*)
+from cheapest_active_listings
+group by source order by count(*) desc, source
 
 -- update all listings of a given color
 update vehicles set
@@ -78,21 +272,13 @@ update vehicles set
 where vin = '3C4NJDBB2JT150267'
 
 -- vehicles by number of distinct sources
-with distinct_sources as (
-  select array_agg(distinct source) as sources
-  from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
-  group by vehicles.vin
-) select array_length(sources, 1) as sources, count(*)
-from distinct_sources
+select array_length(sources, 1) as sources, count(*)
+from vehicle_summaries
 group by array_length(sources, 1) order by array_length(sources, 1) desc
 
 -- average length of detection
-with detection_lengths as (
-  select max(created_on) - min(created_on) as detection_length
-  from vehicle_listings
-  group by vin
-) select avg(detection_length) as detection_length
-from detection_lengths
+select avg(last_seen - first_seen) as detection_length
+from vehicle_summaries
 
 -- db stats (1/26/2021)
   -- scraped 3k individual vehciles (7 different Jeep models)
@@ -19,16 +19,23 @@ NOT ACCOUNTED FOR IN FILTER, need to check manually
 '''
 
 import sys, os
+import re
 import json
+import pickle
 import dateutil.parser, time, datetime
 import matplotlib.dates as mdates
 import itertools
+import concurrent.futures
 import numpy as np
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '../utils/'))
 
 import py_utils
 import py_postgres
+import py_table
+import py_snapshot
+import py_instrument
+import py_geo
 import plotter
 
 # control vars
@@ -37,6 +44,11 @@ CONFIG_SECRET_PATH = 'incl/config_secret.json'
 SELECTION_PATH = 'incl/selection_params.json'
 OUTPUT_PATH = 'results/ranked_listings.csv'
 ACTIVE_PERIOD = 60*60*24 # s
+# extra active windows evaluated alongside ACTIVE_PERIOD, each adds active_{name} & active_sources_{name} vehicle columns
+ACTIVE_WINDOWS = {
+	'3d': 60*60*24*3,
+	'7d': 60*60*24*7
+}
 VERBOSE = True
 
 # use local copies of data instead of connecting to DB
@@ -44,6 +56,64 @@ LOCAL_MODE = False
 LOCAL_VEHCILES_PATH = '../../../Downloads/vehicles.csv'
 LOCAL_LISTINGS_PATH = '../../../Downloads/vehicle_listings.csv'
 
+# compute per-vehicle aggregates in postgres (AGGREGATE_QUERY) instead of pulling every listing
+AGGREGATE_MODE = False
+
+# stream DATA_QUERY rows through a server-side cursor into prep_listings(...), STREAM_ITERSIZE rows at a time
+STREAM_MODE = True
+STREAM_ITERSIZE = 5000
+
+# listings are converted to columns PREP_CHUNK_SIZE rows at a time
+PREP_CHUNK_SIZE = 20000
+
+# cache prepped listings on disk keyed by a data fingerprint, memory-mapped when nothing changed
+SNAPSHOT_MODE = True
+SNAPSHOT_DIR = 'cache/snapshots'
+SNAPSHOT_KEEP = 3 # most recently used snapshots kept, older ones are evicted
+SNAPSHOT_INVALIDATE = False # drop all snapshots before loading
+SNAPSHOT_VERSION = 2 # bump when prep_listings(...) or LISTING_SCHEMA change, also invalidates incremental state
+
+# only fetch listings added since the last run, merging them into state saved at INCREMENTAL_STATE_PATH
+INCREMENTAL_MODE = False
+INCREMENTAL_STATE_PATH = 'cache/incremental_state.pkl'
+INCREMENTAL_TAIL_PERIOD = max(ACTIVE_PERIOD, *ACTIVE_WINDOWS.values()) # s, listing history kept before each vehicle's latest listing, must be >= ACTIVE_PERIOD & every ACTIVE_WINDOWS period
+INCREMENTAL_ID_WINDOW = 1000 # listing ids below the last watermark re-read each run, scrapers insert concurrently so ids can commit out of order
+
+# run each model's get_unique_vehicles(...) + augment_vehicles(...) in a process pool, results are merged in config order
+MODEL_WORKERS = None # None: one worker per model up to the cpu count, 1: run models serially in this process
+
+# collapse each vehicle's runs of listings with unchanged source, price & mileage into change points, see compress_history(...)
+COMPRESS_HISTORY = False
+
+# vehicle_listings has been compacted by scripts/db_tools.py compact, its rows carry last_seen & listing_count
+COMPACTED_DB = False
+
+# print the latest scrape's listings per source from the daily_listing_counts summary view (schema.sql, scripts/db_tools.py)
+SCRAPE_SUMMARY = True
+
+# json report of each run's stages (wall & cpu time, rows in/out, peak rss) and py_postgres calls, see py_instrument
+RUN_REPORT = True
+RUN_REPORT_DIR = 'results/run_reports'
+RUN_REPORT_KEEP = 30 # most recent reports kept, older ones are pruned
+RUN_PROFILE = False # cProfile each top level stage, summarized in the report & saved as .prof files next to it
+RUN_TRACE_MEMORY = False # tracemalloc peak of python allocations per stage, slows allocation heavy stages
+
+# vehicle distances from the origin zip to each vehicle's latest listing zip instead of the augment_vehicles.js db distance
+# zip distances are cached at LOCATIONS_CACHE_PATH, recomputed when the origin or the coordinates change, see get_locations(...)
+ZIP_COORDS_PATH = 'incl/zip_coords.csv' # written by scripts/export_zip_coords.js, without it vehicles keep the db distance
+DISTANCE_ORIGIN_ZIP = None # None: config['location_config']['zip']
+LOCATIONS_CACHE_PATH = 'cache/locations.pkl'
+
+# ranks dumped to OUTPUT_PATH: RANKED_OFFSET + 1 to RANKED_OFFSET + RANKED_LIMIT, None: all ranks
+RANKED_LIMIT = None
+RANKED_OFFSET = 0
+RANK_CHUNK_SIZE = 100000 # vehicles scored at a time by rank_vehicles(...)
+
+# render plots headless in plotter.render_batch(...) workers instead of showing them one at a time
+PLOT_HEADLESS = True
+PLOT_WORKERS = None # see plotter.BATCH_WORKERS
+PLOT_PRICE_HISTORY = False # also plot the filtered vehicles' listing price histories
+
 DATA_QUERY = '''
 	select 
 		vehicles.make,
@@ -61,6 +131,7 @@ DATA_QUERY = '''
 	from vehicles 
 	join vehicle_listings listings
 		on vehicles.vin = listings.vin
+	where vehicles.model = any(%(models)s)
 	order by vehicles.vin
 '''
 DATA_QUERY_HEADERS = [
@@ -87,6 +158,190 @@ DATA_QUERY_HEADERS = [
 	'remote'
 ]
 
+# appended to listings.* by the schema.sql listing history compaction columns
+COMPACTED_DB_HEADERS = [
+	'last_seen',
+	'listing_count'
+]
+
+def data_query_headers():
+	return DATA_QUERY_HEADERS + (COMPACTED_DB_HEADERS if COMPACTED_DB else [])
+
+# one row per vehicle, mirrors get_unique_vehicles(...) + augment_vehicles(...)
+# key listings (earliest, latest and first active listing per source) are returned as arrays
+AGGREGATE_QUERY = '''
+	with history as (
+		select
+			listings.*,
+			lag(listings.price) over (partition by listings.vin order by listings.created_on) as prev_price,
+			first_value(listings.id) over (partition by listings.vin order by listings.created_on) as earliest_id,
+			first_value(listings.id) over (partition by listings.vin order by listings.created_on desc) as raw_latest_id
+		from vehicles
+		join vehicle_listings listings
+			on vehicles.vin = listings.vin
+		where vehicles.model = any(%(models)s)
+	), raw_latest as (
+		select * from history where id = raw_latest_id
+	), cheapest_candidate as (
+		select distinct on (history.vin) history.vin, history.id, history.price
+		from history
+		join raw_latest
+			on history.vin = raw_latest.vin
+		where history.created_on > raw_latest.created_on - %(active_period)s * interval '1 second'
+			and history.source != raw_latest.source
+		order by history.vin, history.price, history.created_on
+	), latest as (
+		select
+			raw_latest.vin,
+			case when cheapest_candidate.price < raw_latest.price then cheapest_candidate.id else raw_latest.id end as id
+		from raw_latest
+		left join cheapest_candidate
+			on raw_latest.vin = cheapest_candidate.vin
+	), first_active as (
+		select distinct on (vin, source) id
+		from history
+		where created_on > %(active_since)s
+		order by vin, source, created_on
+	), flagged as (
+		select
+			history.*,
+			latest.id as latest_id,
+			(history.id = history.earliest_id or history.id = latest.id or first_active.id is not null) as is_key
+		from history
+		join latest
+			on history.vin = latest.vin
+		left join first_active
+			on history.id = first_active.id
+	)
+	select
+		vehicles.make,
+		vehicles.model,
+		vehicles.version,
+		vehicles.year,
+		vehicles.drivetrain,
+		vehicles.color,
+		vehicles.estimated_value,
+		vehicles._owner as parsed_owner,
+		vehicles.distance,
+		vehicles.score_adjustments,
+		vehicles.sold,
+		vehicles.vin,
+		flagged.latest_id,
+		count(*) filter (where flagged.price > flagged.prev_price) as price_increases,
+		count(*) filter (where flagged.price < flagged.prev_price) as price_decreases,
+		array_agg(distinct flagged.source) as all_sources,
+		array_agg(distinct flagged.source) filter (where flagged.created_on > %(active_since)s) as active_sources,
+		array_agg(flagged.id order by flagged.created_on) filter (where flagged.is_key) as key_ids,
+		array_agg(flagged.created_on order by flagged.created_on) filter (where flagged.is_key) as key_scrape_times,
+		array_agg(flagged.source order by flagged.created_on) filter (where flagged.is_key) as key_sources,
+		array_agg(flagged.owner order by flagged.created_on) filter (where flagged.is_key) as key_owners,
+		array_agg(flagged.zip order by flagged.created_on) filter (where flagged.is_key) as key_zips,
+		array_agg(flagged.mileage order by flagged.created_on) filter (where flagged.is_key) as key_mileages,
+		array_agg(flagged.price order by flagged.created_on) filter (where flagged.is_key) as key_prices,
+		array_agg(flagged.remote order by flagged.created_on) filter (where flagged.is_key) as key_remotes
+	from flagged
+	join vehicles
+		on flagged.vin = vehicles.vin
+	group by vehicles.vin, flagged.latest_id
+'''
+AGGREGATE_QUERY_HEADERS = [
+	'make',
+	'model',
+	'version',
+	'year',
+	'drivetrain',
+	'color',
+	'estimated_value',
+	'parsed_owner',
+	'distance',
+	'score_adjustments',
+	'sold',
+	'vin',
+	'latest_id',
+	'price_increases',
+	'price_decreases',
+	'all_sources',
+	'active_sources',
+	'key_ids',
+	'key_scrape_times',
+	'key_sources',
+	'key_owners',
+	'key_zips',
+	'key_mileages',
+	'key_prices',
+	'key_remotes'
+]
+AGGREGATE_KEY_FIELDS = {
+	'scrape_time': 'key_scrape_times',
+	'source': 'key_sources',
+	'owner': 'key_owners',
+	'zip': 'key_zips',
+	'mileage': 'key_mileages',
+	'price': 'key_prices',
+	'remote': 'key_remotes'
+}
+
+# cheap check for any change to DATA_QUERY results, vehicles are edited in place so they are hashed
+DATA_FINGERPRINT_QUERY = '''
+	select
+		(select count(*) from vehicle_listings),
+		(select max(id) from vehicle_listings),
+		(select max(created_on) from vehicle_listings),
+		(select md5(string_agg(vehicles::text, ',' order by vin)) from vehicles)
+'''
+
+# DATA_QUERY rows with listing ids in (after_id, up_to_id]
+INCREMENTAL_LISTINGS_QUERY = f'''
+	select * from ({DATA_QUERY}) data
+	where data.id > %(after_id)s and data.id <= %(up_to_id)s
+'''
+LISTINGS_WATERMARK_QUERY = '''
+	select coalesce(max(id), 0) from vehicle_listings
+'''
+# latest scrape day in the summary view vs in vehicle_listings, max(created_on) is read from vehicle_listings_created_on_idx
+SCRAPE_SUMMARY_QUERY = '''
+	select scrape_date, source, sum(listings)::integer
+	from daily_listing_counts
+	where model = any(%(models)s)
+		and scrape_date = (select max(scrape_date) from daily_listing_counts)
+	group by scrape_date, source
+	order by source
+'''
+LATEST_SCRAPE_QUERY = '''
+	select max(created_on)::date from vehicle_listings
+'''
+VEHICLES_QUERY = '''
+	select
+		vehicles.make,
+		vehicles.model,
+		vehicles.version,
+		vehicles.year,
+		vehicles.drivetrain,
+		vehicles.color,
+		vehicles.estimated_value,
+		vehicles._owner as parsed_owner,
+		vehicles.distance,
+		vehicles.score_adjustments,
+		vehicles.sold,
+		vehicles.vin
+	from vehicles
+	where vehicles.model = any(%(models)s)
+'''
+VEHICLES_QUERY_HEADERS = [
+	'make',
+	'model',
+	'version',
+	'year',
+	'drivetrain',
+	'color',
+	'estimated_value',
+	'parsed_owner',
+	'distance',
+	'score_adjustments',
+	'sold',
+	'vin'
+]
+
 ACTIVE_COLOR = 'b'
 INACTIVE_COLOR = 'r'
 CHOSEN_COLOR = 'g'
@@ -102,319 +357,1094 @@ LISTING_FIELDS = [
 	'price',
 	'mileage',
 	'scrape_time',
-	'remote'
+	'remote',
+	'first_seen',
+	'listing_count'
 ]
-def format_vehicle_link(vehicle, source):
-	link = None
-	if source == 'auto_trader':
-		link = f'https://www.autotrader.com/cars-for-sale/vehicledetails.xhtml?vin={vehicle["vin"]}'
-	elif source == 'autolist':
-		if vehicle['model'] == 'grand_cherokee':
-			link = f'https://www.autolist.com/jeep-grand+cherokee#vin={vehicle["vin"]}'
-		elif vehicle['model'] == 'compass':
-			link = f'https://www.autolist.com/jeep-compass#vin={vehicle["vin"]}'
-		else:
-			raise ValueError(f'format_vehicle_link: unsupported model for given source: {vehicle["model"]}, {source}')
-	elif source == 'edmunds':
-		if vehicle['model'] == 'grand_cherokee':
-			link = f'https://www.edmunds.com/jeep/grand-cherokee/{vehicle["year"]}/vin/{vehicle["vin"]}/'
-		elif vehicle['model'] == 'compass':
-			link = f'https://www.edmunds.com/jeep/compass/{vehicle["year"]}/vin/{vehicle["vin"]}/'
-		else:
-			raise ValueError(f'format_vehicle_link: unsupported model for given source: {vehicle["model"]}, {source}')
-	elif source == 'carvana':
-		link = "carvana linking not currently supported"
-	else:
-		raise ValueError(f'format_vehicle_link: unsupported source: {source}')
 
-	return link
+# columnar schema of prepped listings, see utils/py_table.py
+LISTING_SCHEMA = {
+	'vin': str,
+	'make': py_table.CATEGORY,
+	'model': py_table.CATEGORY,
+	'version': py_table.CATEGORY,
+	'year': np.int64,
+	'drivetrain': py_table.CATEGORY,
+	'color': py_table.CATEGORY,
+	'estimated_value': py_table.NULLABLE_INT,
+	'parsed_owner': py_table.CATEGORY,
+	'distance': py_table.NULLABLE_INT,
+	'score_adjustments': object,
+	'sold': bool,
+	'source': py_table.CATEGORY,
+	'owner': py_table.CATEGORY,
+	'zip': np.int64,
+	'price': np.int64,
+	'mileage': np.int64,
+	'scrape_time': np.float64, # epoch s, last seen for listings standing for several scrapes
+	'remote': bool,
+	'first_seen': np.float64, # epoch s
+	'listing_count': np.int64 # scrapes this listing stands for
+}
+VEHICLE_FIELDS = [f for f in LISTING_SCHEMA if f not in LISTING_FIELDS]
+PASSTHROUGH_FIELDS = [f for f in VEHICLE_FIELDS if f not in ['year', 'sold', 'score_adjustments']] + ['source', 'owner']
+
+# listings of a vehicle with the same values for these are collapsed by compress_history(...)
+HISTORY_RUN_FIELDS = ['source', 'price', 'mileage']
+
+# vehicle table columns holding row indices into vehicles['_listings']
+LISTING_INDEX_FIELDS = ['listings_start', 'listings_end', 'earliest_listing', 'latest_listing']
+
+# vehicle links by source, formatted with the vehicle's LINK_VEHICLE_FIELDS & params: its model's scrape_params for the source, lowercased
+# sources without a template get no link (cars.com listing ids aren't kept)
+LINK_TEMPLATES = {
+	'auto_trader': 'https://www.autotrader.com/cars-for-sale/vehicledetails.xhtml?vin={vin}',
+	'autolist': 'https://www.autolist.com/{params[make]}-{params[model]}#vin={vin}',
+	'edmunds': 'https://www.edmunds.com/{params[make]}/{params[model]}/{year}/vin/{vin}/',
+	'carvana': 'carvana linking not currently supported'
+}
+LINK_VEHICLE_FIELDS = ['vin', 'year']
+
+# compile LINK_TEMPLATES once per source & model of config['scrape_configs'] into {(source, model): template}
+# with the scrape_params filled in, models without scrape_params for a source get no link for it
+def compile_link_templates(scrape_configs):
+	templates = {}
+	vehicle_fields = {f: f'{{{f}}}' for f in LINK_VEHICLE_FIELDS}
+	for model, scrape_config in scrape_configs.items():
+		for source, params in scrape_config.get('scrape_params', {}).items():
+			if source not in LINK_TEMPLATES:
+				continue
+			try:
+				templates[(source, model)] = LINK_TEMPLATES[source].format(params={k: str(v).lower() for k, v in params.items()}, **vehicle_fields)
+			except KeyError as error:
+				raise ValueError(f'compile_link_templates: scrape_params missing {error} for model, source: {model}, {source}')
+	return templates
+
+# None if there's no template for the source & vehicle's model
+def format_vehicle_link(link_templates, vehicle, source):
+	template = link_templates.get((source, vehicle['model']))
+	if template is None:
+		return None
+	return template.format(**{f: vehicle[f] for f in LINK_VEHICLE_FIELDS})
+
+LOCAL_VEHICLE_FIELDS = ['make', 'model', 'version', 'year']
+
+def _parse_local_time(value):
+	if isinstance(value, datetime.datetime):
+		return value
+	try:
+		return datetime.datetime.fromisoformat(value)
+	except ValueError:
+		return dateutil.parser.parse(value)
+
+# local csv columns cast while reading, see py_utils.read_csv_columns(...)
+LOCAL_VEHICLES_SCHEMA = {'year': int}
+LOCAL_LISTINGS_SCHEMA = {'zip': int, 'mileage': int, 'price': int, 'created_on': _parse_local_time, 'last_seen': _parse_local_time, 'listing_count': int}
+
+# hash join: index vehicles by vin once, then look up each listing in the index
+# vehicle_columns, listing_columns: {column: list of values} as read by py_utils.read_csv_columns(...)
+# output matches the old nested loop join: sorted by vin, listings in file order within each vin
+def join_local_data(vehicle_columns, listing_columns):
+	vehicles_by_vin = {}
+	vehicle_values = zip(*[vehicle_columns[f] if f in vehicle_columns else itertools.repeat(None) for f in LOCAL_VEHICLE_FIELDS])
+	for vin, values in zip(vehicle_columns.get('vin', []), vehicle_values):
+		if vin not in vehicles_by_vin:
+			vehicles_by_vin[vin] = dict(zip(LOCAL_VEHICLE_FIELDS, values))
+
+	listing_fields = [f for f in listing_columns if f != 'created_on']
+	joined_data = []
+	for created_on, vin, values in zip(listing_columns.get('created_on', []), listing_columns.get('vin', []), zip(*[listing_columns[f] for f in listing_fields])):
+		if vin is None or vin == '' or vin not in vehicles_by_vin:
+			continue
+		joined_data.append({
+			**vehicles_by_vin[vin],
+			**dict(zip(listing_fields, values)),
+			'scrape_time': _parse_local_time(created_on)
+		})
+	return sorted(joined_data, key=lambda j: j['vin'])
 
-def get_data(config):
+def get_data(config, models):
 	data = []
 	if LOCAL_MODE:
-		raw_vehicles = py_utils.read_csv(LOCAL_VEHCILES_PATH)
-		raw_listings = py_utils.read_csv(LOCAL_LISTINGS_PATH)
-
-		# brute force join but whatever
-		joined_data = []
-		for vehicle in raw_vehicles:
-			for listing in raw_listings:
-				if listing['vin'] is not None and listing['vin'] != "" and vehicle['vin'] == listing['vin']:
-					joined_data.append({
-						**py_utils.dict_pick(vehicle, ['make', 'model', 'version', 'year']),
-						**py_utils.dict_omit(listing, ['created_on']),
-						'scrape_time': dateutil.parser.parse(listing['created_on'])
-					})
-		data = sorted(joined_data, key=lambda j: j['vin'])
+		read_errors = []
+		vehicle_columns = py_utils.read_csv_columns(LOCAL_VEHCILES_PATH, LOCAL_VEHICLES_SCHEMA, read_errors)
+		data = join_local_data(vehicle_columns, py_utils.read_csv_columns(LOCAL_LISTINGS_PATH, LOCAL_LISTINGS_SCHEMA, read_errors))
+		if len(read_errors):
+			print(f'skipped {len(read_errors)} unparsable csv rows')
+			if VERBOSE:
+				for read_error in read_errors:
+					print(f'\t{read_error["file"]} row {read_error["row"]}: {read_error["error"]}')
+	elif STREAM_MODE:
+		py_postgres.connect(config['pg_config'])
+		print(f'streaming listings, itersize: {STREAM_ITERSIZE}')
+		return py_postgres.stream(DATA_QUERY, {'models': models}, headers=data_query_headers(), itersize=STREAM_ITERSIZE)
 	else:
 		py_postgres.connect(config['pg_config'])
-		data = py_postgres.query(DATA_QUERY, headers=DATA_QUERY_HEADERS)
+		data = py_postgres.query(DATA_QUERY, {'models': models}, headers=data_query_headers())
 	print(f'found {len(data)} listings, LOCAL_MODE: {LOCAL_MODE}')
 	return data
 
+def _empty_listing_columns():
+	return {name: [] for name in LISTING_SCHEMA}
+
+def get_snapshot_key(config, models):
+	if LOCAL_MODE:
+		data_fingerprint = [[os.path.getsize(path), os.path.getmtime(path)] for path in [LOCAL_VEHCILES_PATH, LOCAL_LISTINGS_PATH]]
+	else:
+		py_postgres.connect(config['pg_config'])
+		data_fingerprint = py_postgres.query(DATA_FINGERPRINT_QUERY)[0]
+	return py_snapshot.make_key({
+		'version': SNAPSHOT_VERSION,
+		'local_mode': LOCAL_MODE,
+		'models': models,
+		'data': data_fingerprint
+	})
+
+def print_scrape_summary(config, models):
+	py_postgres.connect(config['pg_config'])
+	try:
+		summary_rows = py_postgres.query(SCRAPE_SUMMARY_QUERY, {'models': models})
+		latest_scrape = py_postgres.query(LATEST_SCRAPE_QUERY)[0][0]
+	except RuntimeError as error:
+		print(f'no scrape summary, create the summary views with scripts/db_tools.py setup: {error}')
+		return
+	if len(summary_rows) == 0:
+		print('no scrape summary, summary views are empty')
+		return
+	summary_date = summary_rows[0][0]
+	print(f'latest scrape {summary_date}: ' + ', '.join(f'{source}: {count}' for _, source, count in summary_rows))
+	if latest_scrape is not None and latest_scrape > summary_date:
+		print(f'\tsummary views are stale, latest listing is from {latest_scrape}, run scripts/db_tools.py refresh')
+
+# prepped listings of models, from a snapshot if the data hasn't changed since it was taken
+def get_listings(config, models):
+	if SNAPSHOT_MODE:
+		if SNAPSHOT_INVALIDATE:
+			print(f'invalidated snapshots: {py_snapshot.invalidate(SNAPSHOT_DIR)}')
+		snapshot_key = get_snapshot_key(config, models)
+		with py_instrument.stage('snapshot_load') as stage:
+			listings = py_snapshot.load(SNAPSHOT_DIR, snapshot_key)
+			stage['rows_out'] = py_table.length(listings) if listings is not None else None
+		if listings is not None:
+			print(f'loaded {py_table.length(listings)} listings from snapshot {snapshot_key}')
+			return listings
+
+	with py_instrument.stage('prep_listings') as stage:
+		listings = prep_listings((row for row in get_data(config, models) if row['model'] in models), {'verbose': VERBOSE})
+		stage['rows_out'] = py_table.length(listings)
+	print(f'prepped {py_table.length(listings)} listings')
+	if SNAPSHOT_MODE:
+		py_snapshot.save(listings, SNAPSHOT_DIR, snapshot_key)
+		evicted = py_snapshot.evict(SNAPSHOT_DIR, SNAPSHOT_KEEP)
+		print(f'saved snapshot {snapshot_key}' + (f', evicted: {evicted}' if len(evicted) else ''))
+	return listings
+
+# rows can be any iterable (e.g. a py_postgres.stream(...) generator), converted to columns in chunks
 def prep_listings(raw_model_data, options={}):
-	vehicles = []
+	chunk_size = options['chunk_size'] if 'chunk_size' in options else PREP_CHUNK_SIZE
+	chunks = []
+	columns = _empty_listing_columns()
 	for row in raw_model_data:
 		try:
-			if row['zip'] is None or row['zip'] == '':
-				row['zip'] = 0
-			vehicles.append({
-				**row,
-				'year': int(row['year']),
-				'zip': int(row['zip']),
-				'price': int(row['price']),
-				'mileage': int(row['mileage']),
-			})
-		except ValueError as error:
+			year = int(row['year'])
+			_zip = int(row['zip']) if row['zip'] is not None and row['zip'] != '' else 0
+			price = int(row['price'])
+			mileage = int(row['mileage'])
+		except (ValueError, TypeError) as error:
 			if ('verbose' in options and options['verbose']):
 				print(f'error parsing row, skipping: \n\trow: {row}\n\terror: {error}\n')
-	return vehicles
+			continue
+
+		for name in PASSTHROUGH_FIELDS:
+			columns[name].append(row.get(name))
+		columns['year'].append(year)
+		columns['zip'].append(_zip)
+		columns['price'].append(price)
+		columns['mileage'].append(mileage)
+		columns['sold'].append(row.get('sold') == True)
+		columns['score_adjustments'].append(row.get('score_adjustments') or {})
+		columns['remote'].append(row.get('remote') == True or row.get('remote') == 't')
+
+		# compacted vehicle_listings rows stand for listing_count scrapes from created_on to last_seen
+		scrape_time = row['scrape_time'].timestamp()
+		columns['first_seen'].append(scrape_time)
+		columns['scrape_time'].append(row['last_seen'].timestamp() if row.get('last_seen') else scrape_time)
+		columns['listing_count'].append(row.get('listing_count') or 1)
+
+		if len(columns['vin']) >= chunk_size:
+			chunks.append(py_table.from_columns(columns, LISTING_SCHEMA))
+			columns = _empty_listing_columns()
+	chunks.append(py_table.from_columns(columns, LISTING_SCHEMA))
+	return py_table.concat(chunks) if len(chunks) > 1 else chunks[0]
+
+# start, end row of each run of equal keys, keys must be sorted
+def _group_bounds(keys):
+	if len(keys) == 0:
+		return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+	starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+	ends = np.append(starts[1:], len(keys))
+	return starts, ends
+
+# rows of vehicles['_listings'] belonging to each vehicle, flattened in vehicle order
+# returns listing row index, vehicle (group) index of each and the offset of each vehicle's first entry
+def _listing_index(vehicles):
+	counts = vehicles['listings_end'] - vehicles['listings_start']
+	offsets = np.cumsum(counts) - counts
+	index = np.arange(counts.sum()) - np.repeat(offsets - vehicles['listings_start'], counts)
+	groups = np.repeat(np.arange(len(counts)), counts)
+	return index, groups, offsets
 
 def get_unique_vehicles(listings):
-	vin_func = lambda listing: listing['vin']
-	grouped_listings = itertools.groupby(sorted(listings, key=vin_func), vin_func)
-	
-	unique_vehicles = {}
-	for vin, listings in grouped_listings:
-		listings_list = sorted(list(listings), key=lambda l: l['scrape_time'].timestamp())
-		unique_vehicles[vin] = {
-			**py_utils.dict_omit(listings_list[0], LISTING_FIELDS),
-			'listings': [py_utils.dict_pick(l, LISTING_FIELDS) for l in listings_list]
-		}
+	listings = py_table.take(listings, np.lexsort((listings['scrape_time'], listings['vin'])))
+	starts, ends = _group_bounds(listings['vin'])
+
+	unique_vehicles = py_table.take(py_table.select(listings, VEHICLE_FIELDS), starts)
+	unique_vehicles['score_adjustment'] = np.array([sum(a.values()) for a in unique_vehicles['score_adjustments']], dtype=np.float64)
+	unique_vehicles['listings_start'] = starts
+	unique_vehicles['listings_end'] = ends
+	unique_vehicles['_listings'] = py_table.select(listings, LISTING_FIELDS)
 	return unique_vehicles
 
-def augment_vehicles(unique_vehicles):
-	all_listings = [v['listings'] for v in unique_vehicles.values()]
-	flat_listings = [l for vehicle_listings in all_listings for l in vehicle_listings]
-	most_recent_scrape = max([l['scrape_time'].timestamp() for l in flat_listings])
-
-	augmented_vehicles = {}
-	for vin, vehicle in unique_vehicles.items():
-
-		# ensure latest_listing is cheapest active listing
-		raw_latest_listing = vehicle['listings'][len(vehicle['listings']) - 1]
-		latest_listing = raw_latest_listing
-		for listing in vehicle['listings']:
-			if listing['scrape_time'].timestamp() > raw_latest_listing['scrape_time'].timestamp() - ACTIVE_PERIOD \
-				and listing['source'] !=  raw_latest_listing['source'] \
-				and listing['price'] < latest_listing['price']:
-				latest_listing = listing
-
-		earliest_listing = vehicle['listings'][0]
-		days_detected = (latest_listing['scrape_time'].timestamp() - earliest_listing['scrape_time'].timestamp())/60/60/24
-		active = latest_listing['scrape_time'].timestamp() > datetime.datetime.now().timestamp() - ACTIVE_PERIOD
-
-		active_sources = []
-		all_sources = []
-		active_links = {}
-		for listing in vehicle['listings']:
-			if listing['source'] not in all_sources:
-				all_sources.append(listing['source'])
-			if listing['scrape_time'].timestamp() > datetime.datetime.now().timestamp() - ACTIVE_PERIOD \
-				and listing['source'] not in active_sources:
-				active_sources.append(listing['source'])
-				active_links[listing['source']] = format_vehicle_link(vehicle, listing['source'])
-
-		net_price_change = latest_listing['price'] - earliest_listing['price']
-		price_increases = 0
-		price_decreases = 0
-		prev_price = earliest_listing['price']
-		for listing in vehicle['listings']:
-			if listing['price'] > prev_price:
-				price_increases += 1
-			if listing['price'] < prev_price:
-				price_decreases += 1
-			prev_price = listing['price']
-
-		augmented_vehicles[vin] = {
-			**vehicle,
-			'earliest_listing': earliest_listing,
-			'latest_listing': latest_listing,
-			'days_detected': days_detected,
-			'active': active,
-			'all_sources': sorted(all_sources),
-			'active_sources': sorted(active_sources),
-			'active_links': active_links,
-			'net_price_change': net_price_change,
-			'price_increases': price_increases,
-			'price_decreases': price_decreases
-		}
+# price history change points: each run of consecutive listings of a vehicle with the same HISTORY_RUN_FIELDS becomes one
+# listing, the run's last listing with the first_seen of its first and the summed listing_count
+# augment_vehicles(...) results are unchanged except when the cheapest active listing's run started before the active
+# window, the run's last listing is then used instead of its first one inside the window
+def compress_history(unique_vehicles):
+	listings = unique_vehicles['_listings']
+	index, groups, offsets = _listing_index(unique_vehicles)
+	if len(index) == 0:
+		return unique_vehicles
 
-	return augmented_vehicles
+	new_run = np.zeros(len(index), dtype=bool)
+	new_run[0] = True
+	for key in [groups] + [listings[f][index] for f in HISTORY_RUN_FIELDS]:
+		new_run[1:] |= key[1:] != key[:-1]
+	run_starts = np.flatnonzero(new_run)
+	run_ends = np.append(run_starts[1:], len(index))
 
-def filter_vehicles(all_vehicles, _filter):
-	passes = []
-	for vehicle in all_vehicles:
-		_pass = True
-		
+	compressed = py_table.take(listings, index[run_ends - 1])
+	compressed['first_seen'] = listings['first_seen'][index[run_starts]]
+	compressed['listing_count'] = np.add.reduceat(listings['listing_count'][index], run_starts)
+	counts = np.bincount(groups[run_starts], minlength=len(offsets))
+	return {
+		**unique_vehicles,
+		'listings_start': np.cumsum(counts) - counts,
+		'listings_end': np.cumsum(counts),
+		'_listings': compressed
+	}
+
+# per vehicle counts of price increases, decreases between consecutive listings
+def _price_changes(price, groups, n_vehicles):
+	price_steps = np.diff(price)
+	same_vehicle = groups[1:] == groups[:-1]
+	price_increases = np.bincount(groups[1:][same_vehicle & (price_steps > 0)], minlength=n_vehicles)
+	price_decreases = np.bincount(groups[1:][same_vehicle & (price_steps < 0)], minlength=n_vehicles)
+	return price_increases, price_decreases
+
+# position of each vehicle's first listing with scrape_time > since (per vehicle array or scalar)
+# each vehicle's listings are sorted by scrape_time (see get_unique_vehicles(...)), so listings after since are a suffix:
+# binary search over all vehicles at once, log2(most listings of a vehicle) vectorized steps
+def _first_after(scrape_time, starts, ends, since):
+	since = np.broadcast_to(since, starts.shape)
+	lo = starts.copy()
+	hi = ends.copy()
+	searching = lo < hi
+	while searching.any():
+		mid = (lo + hi) // 2
+		after = scrape_time[np.where(searching, mid, 0)] > since
+		hi = np.where(searching & after, mid, hi)
+		lo = np.where(searching & ~after, mid + 1, lo)
+		searching = lo < hi
+	return lo
+
+# ufunc reduce of values[starts[i]:ends[i]], identity for empty ranges
+# values must have one extra trailing element (any value) so ranges can end at len(values) - 1
+def _range_reduce(ufunc, padded_values, starts, ends, identity):
+	if len(starts) == 0:
+		return padded_values[:0]
+	reduced = ufunc.reduceat(padded_values, np.column_stack([starts, ends]).reshape(-1))[::2]
+	return np.where(ends > starts, reduced, identity)
+
+# reference_time: epoch s that vehicles are active relative to, now if None, fix it to keep runs / models consistent
+def augment_vehicles(unique_vehicles, reference_time=None, active_period=ACTIVE_PERIOD, active_windows=ACTIVE_WINDOWS):
+	listings = unique_vehicles['_listings']
+	if len(listings['_categories']['source']) > 63:
+		raise ValueError(f'augment_vehicles: too many sources for source bitmasks: {len(listings["_categories"]["source"])}')
+	index, groups, offsets = _listing_index(unique_vehicles)
+	reference_time = datetime.datetime.now().timestamp() if reference_time is None else reference_time
+	active_since = reference_time - active_period
+
+	scrape_time = listings['scrape_time'][index]
+	price = listings['price'][index]
+	source = listings['source'][index]
+	ends = offsets + (unique_vehicles['listings_end'] - unique_vehicles['listings_start'])
+
+	# ensure latest_listing is cheapest active listing
+	# (first cheapest listing from another source within active_period of the raw latest listing, if cheaper)
+	raw_latest = ends - 1
+	candidates_start = _first_after(scrape_time, offsets, ends, scrape_time[raw_latest] - active_period)
+	max_price = np.iinfo(np.int64).max
+	candidate_price = np.where(source != source[raw_latest][groups], price, max_price)
+	cheapest_price = _range_reduce(np.minimum, np.append(candidate_price, max_price), candidates_start, ends, max_price)
+	positions = np.arange(len(index) + 1)
+	cheapest = _range_reduce(np.minimum, np.where(np.append(candidate_price == cheapest_price[groups], False), positions, len(index)), candidates_start, ends, len(index))
+	latest = np.where(cheapest_price < price[raw_latest], cheapest, raw_latest)
+	earliest = offsets
+
+	days_detected = (scrape_time[latest] - listings['first_seen'][index[earliest]])/60/60/24
+
+	# sources as bitmasks over listings['_categories']['source'] codes
+	source_bits = np.left_shift(1, np.append(source, 0).astype(np.int64))
+	all_sources = np.bitwise_or.reduceat(source_bits[:-1], offsets) if len(offsets) else source_bits[:0]
+
+	# active & active sources for active_period and each extra window, listings since are found by binary search
+	windows = {'': active_period, **{f'_{name}': period for name, period in active_windows.items()}}
+	active_columns = {}
+	for suffix, period in windows.items():
+		since = reference_time - period
+		active_columns[f'active{suffix}'] = scrape_time[latest] > since
+		active_columns[f'active_sources{suffix}'] = _range_reduce(np.bitwise_or, source_bits, _first_after(scrape_time, offsets, ends, since), ends, 0)
+
+	price_increases, price_decreases = _price_changes(price, groups, len(offsets))
+
+	return {
+		**unique_vehicles,
+		'earliest_listing': index[earliest],
+		'latest_listing': index[latest],
+		'days_detected': days_detected,
+		'all_sources': all_sources,
+		**active_columns,
+		'net_price_change': price[latest] - price[earliest],
+		'price_increases': price_increases,
+		'price_decreases': price_decreases,
+		'_active_since': active_since
+	}
+
+# vehicle table from AGGREGATE_QUERY rows, same columns as augment_vehicles(...)
+# vehicles['_listings'] only holds each vehicle's key listings, so vehicle_dicts(...) 'listings' are partial
+def aggregated_vehicles(aggregate_rows, active_since):
+	key_listing_rows = []
+	for row in aggregate_rows:
+		vehicle = py_utils.dict_pick(row, VEHICLE_FIELDS)
+		for i in range(len(row['key_ids'])):
+			key_listing_rows.append({
+				**vehicle,
+				**{field: row[key_field][i] for field, key_field in AGGREGATE_KEY_FIELDS.items()}
+			})
+	vehicles = get_unique_vehicles(prep_listings(key_listing_rows, {'verbose': VERBOSE}))
+	listings = vehicles['_listings']
+	rows_by_vin = {row['vin']: row for row in aggregate_rows}
+	vehicle_rows = [rows_by_vin[vin] for vin in vehicles['vin'].tolist()]
+
+	py_table.add_categories(listings, 'source', [source for row in vehicle_rows for source in row['all_sources']])
+	source_codes = {source: code for code, source in enumerate(listings['_categories']['source'])}
+	def source_bits(sources):
+		return sum([1 << source_codes[source] for source in (sources or [])])
+
+	earliest = vehicles['listings_start']
+	latest = earliest + np.array([row['key_ids'].index(row['latest_id']) for row in vehicle_rows], dtype=np.int64)
+	scrape_time = listings['scrape_time']
+	return {
+		**vehicles,
+		'earliest_listing': earliest,
+		'latest_listing': latest,
+		'days_detected': (scrape_time[latest] - scrape_time[earliest])/60/60/24,
+		'active': scrape_time[latest] > active_since,
+		'all_sources': np.array([source_bits(row['all_sources']) for row in vehicle_rows], dtype=np.int64),
+		'active_sources': np.array([source_bits(row['active_sources']) for row in vehicle_rows], dtype=np.int64),
+		'net_price_change': listings['price'][latest] - listings['price'][earliest],
+		'price_increases': np.array([row['price_increases'] for row in vehicle_rows], dtype=np.int64),
+		'price_decreases': np.array([row['price_decreases'] for row in vehicle_rows], dtype=np.int64),
+		'_active_since': active_since
+	}
+
+def get_aggregated_vehicles(config, models):
+	if COMPACTED_DB:
+		raise ValueError('get_aggregated_vehicles: AGGREGATE_QUERY does not support COMPACTED_DB, it reads created_on as each listing\'s scrape time')
+	active_since = datetime.datetime.now() - datetime.timedelta(seconds=ACTIVE_PERIOD)
+	py_postgres.connect(config['pg_config'])
+	aggregate_rows = py_postgres.query(
+		AGGREGATE_QUERY,
+		{'models': models, 'active_period': ACTIVE_PERIOD, 'active_since': active_since},
+		headers=AGGREGATE_QUERY_HEADERS
+	)
+	print(f'found {len(aggregate_rows)} vehicles, AGGREGATE_MODE: {AGGREGATE_MODE}')
+	return aggregated_vehicles(aggregate_rows, active_since.timestamp())
+
+# listing table (LISTING_SCHEMA columns) of a vehicle table's listings, vehicle fields repeated per listing
+def _vehicle_listing_table(vehicles):
+	index, groups, offsets = _listing_index(vehicles)
+	listings = {
+		**py_table.take(py_table.select(vehicles, VEHICLE_FIELDS), groups),
+		**py_table.take(vehicles['_listings'], index)
+	}
+	listings['_categories'] = {**vehicles['_categories'], **vehicles['_listings']['_categories']}
+	listings['_nullable'] = vehicles['_nullable'] | vehicles['_listings']['_nullable']
+	return py_table.select(listings, LISTING_SCHEMA)
+
+# drop listings no longer needed to update a vehicle incrementally:
+# keeps each vehicle's earliest listing and those within tail_period of its latest listing
+def compact_vehicles(vehicles, tail_period):
+	listings = vehicles['_listings']
+	index, groups, offsets = _listing_index(vehicles)
+	scrape_time = listings['scrape_time'][index]
+	raw_latest = offsets + (vehicles['listings_end'] - vehicles['listings_start']) - 1
+	keep = (scrape_time > scrape_time[raw_latest][groups] - tail_period)
+	keep[offsets] = True
+
+	new_rows = np.full(py_table.length(listings), -1, dtype=np.int64)
+	new_rows[index[keep]] = np.arange(keep.sum())
+	counts = np.bincount(groups[keep], minlength=len(offsets))
+	compacted = {
+		**vehicles,
+		**{f: new_rows[vehicles[f]] for f in ['earliest_listing', 'latest_listing'] if f in vehicles},
+		'listings_start': np.cumsum(counts) - counts,
+		'listings_end': np.cumsum(counts),
+		'_listings': py_table.take(listings, index[keep])
+	}
+	if '_active_since' in compacted:
+		del compacted['_active_since']
+	return compacted
+
+# merge listings newer than every listing in previous_vehicles (a compact_vehicles(...) table) into it
+# returns None if new listings predate their vehicle's latest known listing, needs a full recompute then
+# reference_time: see augment_vehicles(...)
+def merge_new_listings(previous_vehicles, new_listings, reference_time=None):
+	if previous_vehicles is None:
+		return augment_vehicles(get_unique_vehicles(new_listings), reference_time)
+
+	previous_listings = previous_vehicles['_listings']
+	previous_vins = {vin: i for i, vin in enumerate(previous_vehicles['vin'].tolist())}
+	previous_latest_time = previous_listings['scrape_time'][previous_vehicles['listings_end'] - 1]
+	new_previous = np.array([previous_vins.get(vin, -1) for vin in new_listings['vin'].tolist()], dtype=np.int64)
+	if np.any((new_previous >= 0) & (new_listings['scrape_time'] <= previous_latest_time[new_previous])):
+		return None
+
+	merged = augment_vehicles(get_unique_vehicles(py_table.concat([_vehicle_listing_table(previous_vehicles), new_listings])), reference_time)
+
+	# price changes & sources from listings dropped by compact_vehicles(...)
+	index, groups, offsets = _listing_index(previous_vehicles)
+	retained_increases, retained_decreases = _price_changes(previous_listings['price'][index], groups, len(offsets))
+	dropped_increases = previous_vehicles['price_increases'] - retained_increases
+	dropped_decreases = previous_vehicles['price_decreases'] - retained_decreases
+
+	merged_previous = np.array([previous_vins.get(vin, -1) for vin in merged['vin'].tolist()], dtype=np.int64)
+	has_previous = merged_previous >= 0
+	merged['price_increases'] = merged['price_increases'] + np.where(has_previous, dropped_increases[merged_previous], 0)
+	merged['price_decreases'] = merged['price_decreases'] + np.where(has_previous, dropped_decreases[merged_previous], 0)
+
+	py_table.add_categories(merged['_listings'], 'source', previous_listings['_categories']['source'])
+	source_codes = {source: code for code, source in enumerate(merged['_listings']['_categories']['source'])}
+	lookup = [source_codes[source] for source in previous_listings['_categories']['source']]
+	previous_sources = _remap_source_bits(previous_vehicles['all_sources'], lookup)
+	merged['all_sources'] = merged['all_sources'] | np.where(has_previous, previous_sources[merged_previous], 0)
+	return merged
+
+# overwrite vehicle fields with current VEHICLES_QUERY rows, these are edited in place in the db
+def refresh_vehicle_fields(vehicles, vehicle_rows):
+	rows_by_vin = {row['vin']: row for row in vehicle_rows}
+	current = py_table.to_lists(vehicles, VEHICLE_FIELDS)
+	for i, vin in enumerate(current['vin']):
+		if vin in rows_by_vin:
+			for field in VEHICLE_FIELDS:
+				current[field][i] = rows_by_vin[vin][field]
+	current['sold'] = [sold == True for sold in current['sold']]
+	current['score_adjustments'] = [adjustments or {} for adjustments in current['score_adjustments']]
+
+	refreshed = {**vehicles, **py_table.from_columns(current, py_utils.dict_pick(LISTING_SCHEMA, VEHICLE_FIELDS))}
+	refreshed['_categories'] = {**vehicles['_categories'], **refreshed['_categories']}
+	refreshed['_nullable'] = vehicles['_nullable'] | refreshed['_nullable']
+	refreshed['score_adjustment'] = np.array([sum(a.values()) for a in refreshed['score_adjustments']], dtype=np.float64)
+	return refreshed
+
+def load_incremental_state(models):
+	if not os.path.exists(INCREMENTAL_STATE_PATH):
+		return None
+	state = pickle.load(open(INCREMENTAL_STATE_PATH, 'rb'))
+	if state.get('version') != SNAPSHOT_VERSION or 'merged_ids' not in state or state['models'] != models or state['tail_period'] != INCREMENTAL_TAIL_PERIOD:
+		print(f'incremental state is for a different version, models or tail period, ignoring: {INCREMENTAL_STATE_PATH}')
+		return None
+	return state
+
+def save_incremental_state(state):
+	os.makedirs(os.path.dirname(INCREMENTAL_STATE_PATH), exist_ok=True)
+	with open(INCREMENTAL_STATE_PATH + '.tmp', 'wb') as state_file:
+		pickle.dump(state, state_file)
+	os.replace(INCREMENTAL_STATE_PATH + '.tmp', INCREMENTAL_STATE_PATH)
+
+# DATA_QUERY rows not in merged_ids, adds the listing id of every row read to read_ids
+def _unmerged_rows(rows, merged_ids, read_ids):
+	for row in rows:
+		read_ids.add(row['listing_id'])
+		if row['listing_id'] not in merged_ids:
+			yield row
+
+# merge listings added since state (a load_incremental_state(...) state, None for a full compute) into it
+# listings with ids within INCREMENTAL_ID_WINDOW below the last watermark are re-read, those merged before are skipped by id
+# returns the up to date vehicles & the state to save or pass back in, the state isn't modified
+def update_incremental_vehicles(config, models, state):
+	longest_window = max(ACTIVE_PERIOD, *ACTIVE_WINDOWS.values())
+	if INCREMENTAL_TAIL_PERIOD < longest_window:
+		raise ValueError(f'update_incremental_vehicles: INCREMENTAL_TAIL_PERIOD must be >= ACTIVE_PERIOD & every ACTIVE_WINDOWS period: {INCREMENTAL_TAIL_PERIOD}, {longest_window}')
+	py_postgres.connect(config['pg_config'])
+	up_to_id = py_postgres.query(LISTINGS_WATERMARK_QUERY)[0][0]
+
+	vehicles = None
+	read_ids = set()
+	if state is not None:
+		after_id = max(state['watermark'] - INCREMENTAL_ID_WINDOW, 0)
+		new_rows = py_postgres.stream(INCREMENTAL_LISTINGS_QUERY, {'after_id': after_id, 'up_to_id': up_to_id, 'models': models}, headers=data_query_headers(), itersize=STREAM_ITERSIZE)
+		new_listings = prep_listings((row for row in _unmerged_rows(new_rows, state['merged_ids'], read_ids) if row['model'] in models), {'verbose': VERBOSE})
+		print(f'found {py_table.length(new_listings)} new listings since listing {after_id}')
+		vehicles = merge_new_listings(state['vehicles'], new_listings)
+		if vehicles is None:
+			print('new listings predate saved state, running full recompute')
+	if vehicles is None:
+		rows = py_postgres.stream(INCREMENTAL_LISTINGS_QUERY, {'after_id': 0, 'up_to_id': up_to_id, 'models': models}, headers=data_query_headers(), itersize=STREAM_ITERSIZE)
+		vehicles = merge_new_listings(None, prep_listings((row for row in _unmerged_rows(rows, set(), read_ids) if row['model'] in models), {'verbose': VERBOSE}))
+	else:
+		read_ids |= state['merged_ids']
+
+	vehicles = refresh_vehicle_fields(vehicles, py_postgres.query(VEHICLES_QUERY, {'models': models}, headers=VEHICLES_QUERY_HEADERS))
+	new_state = {
+		'version': SNAPSHOT_VERSION,
+		'models': models,
+		'tail_period': INCREMENTAL_TAIL_PERIOD,
+		'watermark': up_to_id,
+		'merged_ids': {listing_id for listing_id in read_ids if listing_id > up_to_id - INCREMENTAL_ID_WINDOW},
+		'vehicles': compact_vehicles(vehicles, INCREMENTAL_TAIL_PERIOD)
+	}
+	return vehicles, new_state
+
+def get_incremental_vehicles(config, models):
+	vehicles, state = update_incremental_vehicles(config, models, load_incremental_state(models))
+	save_incremental_state(state)
+	return vehicles
+
+# row index of each model's rows in one pass over the model column, rows keep their order within a model
+def partition_by_model(table, models):
+	order = np.argsort(table['model'], kind='stable')
+	starts, ends = _group_bounds(table['model'][order])
+	index_by_model = {table['_categories']['model'][table['model'][order[start]]]: order[start:end] for start, end in zip(starts, ends)}
+	return {model: index_by_model.get(model, np.array([], dtype=np.int64)) for model in models}
+
+# {model: vehicle table}, for vehicle tables holding several models
+def split_by_model(vehicles, models):
+	partitions = partition_by_model(vehicles, models)
+	return {model: py_table.take(vehicles, partitions[model]) for model in models}
+
+def build_model_vehicles(model_listings, reference_time=None, compress=False):
+	unique_vehicles = get_unique_vehicles(model_listings)
+	return augment_vehicles(compress_history(unique_vehicles) if compress else unique_vehicles, reference_time)
+
+# {model: augmented vehicle table}, see MODEL_WORKERS
+# all models are active relative to the same reference_time, now if None
+def get_model_vehicles(listings, models, reference_time=None):
+	reference_time = datetime.datetime.now().timestamp() if reference_time is None else reference_time
+	partitions = partition_by_model(listings, models)
+	model_listings = [py_table.take(listings, partitions[model]) for model in models]
+	workers = min(len(models), MODEL_WORKERS or os.cpu_count())
+	if workers <= 1:
+		return {model: build_model_vehicles(l, reference_time, COMPRESS_HISTORY) for model, l in zip(models, model_listings)}
+	with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+		# map(...) returns results in submission order
+		return dict(zip(models, executor.map(build_model_vehicles, model_listings, itertools.repeat(reference_time), itertools.repeat(COMPRESS_HISTORY))))
+
+# source bitmask columns: all_sources, active_sources and active_sources_{window}
+def _source_bits_fields(vehicles):
+	return [f for f in py_table.column_names(vehicles) if f == 'all_sources' or f.startswith('active_sources')]
+
+def _remap_source_bits(bits, lookup):
+	remapped = np.zeros_like(bits)
+	for old_code, new_code in enumerate(lookup):
+		remapped |= ((bits >> old_code) & 1) << new_code
+	return remapped
+
+# concat vehicle tables, merging their listings and re-pointing listing indices & source bitmasks
+def concat_vehicles(vehicle_tables):
+	if all([t['_listings'] is vehicle_tables[0]['_listings'] for t in vehicle_tables]):
+		return {**py_table.concat(vehicle_tables), **{k: v for k, v in vehicle_tables[0].items() if k in ['_listings', '_active_since']}}
+
+	listings = py_table.concat([t['_listings'] for t in vehicle_tables])
+	source_codes = {source: code for code, source in enumerate(listings['_categories']['source'])}
+
+	shifted_tables = []
+	offset = 0
+	for t in vehicle_tables:
+		shifted = {**t, **{f: t[f] + offset for f in LISTING_INDEX_FIELDS if f in t}}
+		lookup = [source_codes[source] for source in t['_listings']['_categories']['source']]
+		for f in _source_bits_fields(t):
+			shifted[f] = _remap_source_bits(t[f], lookup)
+		shifted_tables.append(shifted)
+		offset += py_table.length(t['_listings'])
+
+	vehicles = py_table.concat(shifted_tables)
+	vehicles['_listings'] = listings
+	if '_active_since' in vehicle_tables[0]:
+		vehicles['_active_since'] = vehicle_tables[0]['_active_since']
+	return vehicles
+
+# zip coordinates & each zip's distance from the origin zip, None without ZIP_COORDS_PATH
+# cached at LOCATIONS_CACHE_PATH by origin & coordinates file, so changing the origin only recomputes the distances
+def get_locations(config):
+	if not os.path.exists(ZIP_COORDS_PATH):
+		print(f'no zip coordinates at {ZIP_COORDS_PATH}, keeping db distances')
+		return None
+	origin_zip = DISTANCE_ORIGIN_ZIP if DISTANCE_ORIGIN_ZIP is not None else config.get('location_config', {}).get('zip')
+	if origin_zip is None:
+		raise ValueError('get_locations: no distance origin, set DISTANCE_ORIGIN_ZIP or location_config.zip in the config')
+	key = {'origin_zip': int(origin_zip), 'coords_mtime': os.path.getmtime(ZIP_COORDS_PATH)}
+
+	cached = pickle.load(open(LOCATIONS_CACHE_PATH, 'rb')) if os.path.exists(LOCATIONS_CACHE_PATH) else None
+	if cached is not None and cached['key'] == key:
+		return cached
+	if cached is not None and cached['key']['coords_mtime'] == key['coords_mtime']:
+		coords = cached['coords']
+	else:
+		coords = py_geo.load_zip_coords(ZIP_COORDS_PATH)
+	locations = {'key': key, 'coords': coords, 'distances': py_geo.distances_from(coords, key['origin_zip'])}
+	print(f'computed distances from {key["origin_zip"]} to {len(coords["zip"])} zips')
+
+	os.makedirs(os.path.dirname(LOCATIONS_CACHE_PATH), exist_ok=True)
+	with open(LOCATIONS_CACHE_PATH + '.tmp', 'wb') as locations_file:
+		pickle.dump(locations, locations_file)
+	os.replace(LOCATIONS_CACHE_PATH + '.tmp', LOCATIONS_CACHE_PATH)
+	return locations
+
+# distance to each vehicle's latest listing zip, vehicles with unknown zips keep their db distance
+def resolve_distances(vehicles, locations):
+	if locations is None:
+		return vehicles
+	zip_distance = py_geo.zip_distances(locations['coords'], locations['distances'], _latest_listing_values(vehicles, 'zip'))
+	return {**vehicles, 'distance': np.where(np.isnan(zip_distance), vehicles['distance'], zip_distance)}
+
+# compatibility adapter: vehicle table -> list of vehicle dicts as built by the old per-row pipeline
+# active_links are only formatted with link_templates (compile_link_templates(...)), else left empty
+def vehicle_dicts(vehicles, link_templates=None):
+	listings = vehicles['_listings']
+	index, groups, offsets = _listing_index(vehicles)
+	listing_lists = py_table.to_lists(listings, [f for f in LISTING_FIELDS if f in listings], index)
+	listing_times = listing_lists['scrape_time']
+	listing_lists['scrape_time'] = [datetime.datetime.fromtimestamp(t) for t in listing_times]
+	if 'first_seen' in listing_lists:
+		listing_lists['first_seen'] = [datetime.datetime.fromtimestamp(t) for t in listing_lists['first_seen']]
+	listing_rows = [dict(zip(LISTING_FIELDS, values)) for values in zip(*[listing_lists[f] if f in listing_lists else itertools.repeat(None, len(index)) for f in LISTING_FIELDS])]
+	row_positions = {row_index: position for position, row_index in enumerate(index.tolist())}
+
+	source_categories = listings['_categories']['source']
+	def decode_sources(bits):
+		return sorted([source for code, source in enumerate(source_categories) if (bits >> code) & 1])
+
+	extra_fields = [f for f in ['score'] if f in vehicles]
+	vehicle_rows = py_table.to_rows(vehicles, VEHICLE_FIELDS + extra_fields)
+	starts = offsets.tolist()
+	ends = (offsets + vehicles['listings_end'] - vehicles['listings_start']).tolist()
+	augmented = 'latest_listing' in vehicles
+	dicts = []
+	for i, vehicle in enumerate(vehicle_rows):
+		vehicle['listings'] = listing_rows[starts[i]:ends[i]]
+		if augmented:
+			active_links = {}
+			for position in range(starts[i], ends[i]):
+				source = listing_rows[position]['source']
+				if link_templates is not None and listing_times[position] > vehicles['_active_since'] and source not in active_links:
+					link = format_vehicle_link(link_templates, vehicle, source)
+					if link is not None:
+						active_links[source] = link
+			vehicle.update({
+				'earliest_listing': listing_rows[row_positions[int(vehicles['earliest_listing'][i])]],
+				'latest_listing': listing_rows[row_positions[int(vehicles['latest_listing'][i])]],
+				'days_detected': float(vehicles['days_detected'][i]),
+				'active': bool(vehicles['active'][i]),
+				'all_sources': decode_sources(int(vehicles['all_sources'][i])),
+				'active_sources': decode_sources(int(vehicles['active_sources'][i])),
+				'active_links': active_links,
+				'net_price_change': int(vehicles['net_price_change'][i]),
+				'price_increases': int(vehicles['price_increases'][i]),
+				'price_decreases': int(vehicles['price_decreases'][i])
+			})
+		dicts.append(vehicle)
+	return dicts
+
+def _latest_listing_values(vehicles, field):
+	return vehicles['_listings'][field][vehicles['latest_listing']]
+
+# compile named filter dicts (selection_params filters_*) into one predicate plan
+# clauses are hashable tuples, clauses shared between filter sets are evaluated once
+def compile_filter_plan(filters):
+	plan = {'clauses': [], 'sets': {}}
+	clause_ids = {}
+	for name, _filter in filters.items():
+		clauses = []
 		if 'model' in _filter:
-			if vehicle['model'] not in _filter['models']:
-				_pass = False
+			clauses.append(('models', tuple(_filter['models'])))
 		if 'color_not' in _filter:
-			if vehicle['color'] in _filter['color_not']:
-				_pass = False
+			clauses.append(('color_not', tuple(_filter['color_not'])))
 		if 'active' in _filter:
-			if vehicle['active'] != True:
-				_pass = False
+			clauses.append(('active',))
 		if 'not_sold' in _filter:
-			if vehicle['sold'] != False:
-				_pass = False
-		
-		if 'max_miles' in _filter:
-			if vehicle['latest_listing']['mileage'] > _filter['max_miles']:
-				_pass = False
-		if 'min_miles' in _filter:
-			if vehicle['latest_listing']['mileage'] < _filter['min_miles']:
-				_pass = False
-		if 'max_price' in _filter:
-			if vehicle['latest_listing']['price'] > _filter['max_price']:
-				_pass = False
-		if 'min_price' in _filter:
-			if vehicle['latest_listing']['price'] < _filter['min_price']:
-				_pass = False
-
-		if "min_year_by_model" in _filter:
-			if vehicle['model'] in _filter["min_year_by_model"]:
-				if vehicle['year'] < _filter["min_year_by_model"][vehicle['model']]:
-					_pass = False
-
-		if _pass:
-			passes.append(vehicle)
-	print(f'filter_vehicles: filtered {len(all_vehicles)} vehicles down to {len(passes)}')
-	return passes
+			clauses.append(('not_sold',))
+		for bound in ['max_miles', 'min_miles', 'max_price', 'min_price']:
+			if bound in _filter:
+				clauses.append((bound, _filter[bound]))
+		if 'min_year_by_model' in _filter:
+			for model, min_year in _filter['min_year_by_model'].items():
+				clauses.append(('min_year', model, min_year))
 
+		plan['sets'][name] = []
+		for clause in clauses:
+			if clause not in clause_ids:
+				clause_ids[clause] = len(plan['clauses'])
+				plan['clauses'].append(clause)
+			plan['sets'][name].append(clause_ids[clause])
+	return plan
 
+def _describe_clause(clause):
+	kind = clause[0]
+	if kind == 'models':
+		return f'model in {list(clause[1])}'
+	elif kind == 'color_not':
+		return f'color not in {list(clause[1])}'
+	elif kind in ['active', 'not_sold']:
+		return kind
+	elif kind == 'min_year':
+		return f'{clause[1]} year >= {clause[2]}'
+	bound_descriptions = {'max_miles': 'mileage <=', 'min_miles': 'mileage >=', 'max_price': 'price <=', 'min_price': 'price >='}
+	return f'{bound_descriptions[kind]} {clause[1]}'
 
-def plot_vehicles(plot_data, config):
-	def thousands_format_func(number): return format(int(number), ',')
+def _clause_mask(vehicles, clause):
+	kind = clause[0]
+	if kind == 'models':
+		return py_table.isin(vehicles, 'model', clause[1])
+	elif kind == 'color_not':
+		return ~py_table.isin(vehicles, 'color', clause[1])
+	elif kind == 'active':
+		return vehicles['active']
+	elif kind == 'not_sold':
+		return ~vehicles['sold']
+	elif kind == 'max_miles':
+		return _latest_listing_values(vehicles, 'mileage') <= clause[1]
+	elif kind == 'min_miles':
+		return _latest_listing_values(vehicles, 'mileage') >= clause[1]
+	elif kind == 'max_price':
+		return _latest_listing_values(vehicles, 'price') <= clause[1]
+	elif kind == 'min_price':
+		return _latest_listing_values(vehicles, 'price') >= clause[1]
+	elif kind == 'min_year':
+		return ~(py_table.isin(vehicles, 'model', [clause[1]]) & (vehicles['year'] < clause[2]))
+	raise ValueError(f'filter clause not implemented: {clause}')
+
+# returns pass mask per filter set and per clause selectivity per filter set:
+	# removed: vehicles failing the clause, removed_only: vehicles failing only that clause
+def evaluate_filter_plan(vehicles, plan):
+	clause_masks = [_clause_mask(vehicles, clause) for clause in plan['clauses']]
 
-	def year_data_func(v): return v['year']
-	year_axis_format = {'label': 'year', 'tick_interval': 1}
+	masks = {}
+	selectivity = {}
+	for name, clause_ids in plan['sets'].items():
+		fail_counts = np.zeros(py_table.length(vehicles), dtype=np.int64)
+		for clause_id in clause_ids:
+			fail_counts += ~clause_masks[clause_id]
+		masks[name] = fail_counts == 0
+		selectivity[name] = [{
+			'clause': _describe_clause(plan['clauses'][clause_id]),
+			'removed': int((~clause_masks[clause_id]).sum()),
+			'removed_only': int((~clause_masks[clause_id] & (fail_counts == 1)).sum())
+		} for clause_id in clause_ids]
+	return masks, selectivity
 
-	def mileage_data_func(v): return v['latest_listing']['mileage']
-	mileage_axis_format = {'label': 'mileage', 'tick_format_func': lambda x, pos: thousands_format_func(x)}
+# filter vehicles by several named filter dicts in one pass, returns {name: filtered vehicles}
+def filter_vehicle_sets(all_vehicles, filters):
+	masks, selectivity = evaluate_filter_plan(all_vehicles, compile_filter_plan(filters))
 
-	def listings_time_func(v): return [l['scrape_time'] for l in v['listings']]
-	def listings_plot_order_func(v): return -1*v['latest_listing']['scrape_time'].timestamp()
-	# time_format = {'label': 'scrape time', 'tick_locator': mdates.DayLocator(bymonthday=1, interval=7), 'tick_format_func': lambda x, pos: mdates.num2date(x).strftime('%m-%d-%y')}
-	time_format = {'label': 'scrape time', 'tick_locator': mdates.WeekdayLocator(byweekday=1), 'tick_format_func': lambda x, pos: mdates.num2date(x).strftime('%m-%d-%y')}
+	filtered_sets = {}
+	for name, passes in masks.items():
+		filtered_sets[name] = py_table.take(all_vehicles, passes)
+		print(f'filter_vehicles: {name}: filtered {len(passes)} vehicles down to {py_table.length(filtered_sets[name])}')
+		for clause in sorted(selectivity[name], key=lambda c: -c['removed']):
+			print(f'\t{clause["clause"]}: removed {clause["removed"]}, only clause failed by {clause["removed_only"]}')
+	return filtered_sets
 
-	def price_data_func(v): return v['latest_listing']['price']
-	def listings_price_func(v): return [l['price'] for l in v['listings']]
-	price_axis_format = {'label': 'price', 'tick_format_func': lambda x, pos: f'${thousands_format_func(x/1000)}k'}
+def filter_vehicles(all_vehicles, _filter):
+	return filter_vehicle_sets(all_vehicles, {'filter': _filter})['filter']
 
-	def days_detected_data_func(v): return v['days_detected']
-	days_detected_format = {'label': 'days_detected', 'min_tick_interval': 1, 'tick_format_func': lambda x, pos: round(x)}
 
-	def net_price_change_data_func(v): return v['net_price_change']
-	net_price_change_format = {'label': 'net_price_change', 'tick_format_func': lambda x, pos: f'${x}'}
 
-	def score_func(v): return v['score']
-	score_axis_format = {'label': 'score'}
+# plot axis tick formatters, module level so plot jobs can be sent to plotter.render_batch(...) workers
+def _thousands_format(x, pos): return format(int(x), ',')
+def _price_format(x, pos): return f'${_thousands_format(x/1000, pos)}k'
+def _time_format(x, pos): return mdates.num2date(x).strftime('%m-%d-%y')
+def _round_format(x, pos): return round(x)
+def _dollar_format(x, pos): return f'${x}'
 
-	def active_inactive_color_func(v): 
-		if v['vin'] == config['chosen_vin']:
-			return CHOSEN_COLOR
-		elif v['active'] == True:
-			return ACTIVE_COLOR 
-		else:
-			return INACTIVE_COLOR
-	active_inactive_color_legend = [
-		{'label': 'active', 'color': ACTIVE_COLOR},
-		{'label': 'inactive', 'color': INACTIVE_COLOR},
-		{'label': 'chosen', 'color': CHOSEN_COLOR},
+YEAR_AXIS_FORMAT = {'label': 'year', 'tick_interval': 1}
+MILEAGE_AXIS_FORMAT = {'label': 'mileage', 'tick_format_func': _thousands_format}
+TIME_AXIS_FORMAT = {'label': 'scrape time', 'tick_locator': mdates.WeekdayLocator(byweekday=1), 'tick_format_func': _time_format}
+PRICE_AXIS_FORMAT = {'label': 'price', 'tick_format_func': _price_format}
+DAYS_DETECTED_AXIS_FORMAT = {'label': 'days_detected', 'min_tick_interval': 1, 'tick_format_func': _round_format}
+NET_PRICE_CHANGE_AXIS_FORMAT = {'label': 'net_price_change', 'tick_format_func': _dollar_format}
+SCORE_AXIS_FORMAT = {'label': 'score'}
+
+ACTIVE_INACTIVE_COLOR_LEGEND = [
+	{'label': 'active', 'color': ACTIVE_COLOR},
+	{'label': 'inactive', 'color': INACTIVE_COLOR},
+	{'label': 'chosen', 'color': CHOSEN_COLOR},
+]
+REMOTE_COLOR_LEGEND = [
+	{'label': 'local', 'color': LOCAL_COLOR},
+	{'label': 'remote', 'color': REMOTE_COLOR},
+	{'label': 'chosen', 'color': CHOSEN_COLOR},
+]
+
+def _active_inactive_colors(vehicles, chosen_vin):
+	colors = np.where(vehicles['active'], ACTIVE_COLOR, INACTIVE_COLOR)
+	return np.where(vehicles['vin'] == chosen_vin, CHOSEN_COLOR, colors)
+
+def _remote_colors(vehicles, chosen_vin):
+	colors = np.where(_latest_listing_values(vehicles, 'remote'), REMOTE_COLOR, LOCAL_COLOR)
+	return np.where(vehicles['vin'] == chosen_vin, CHOSEN_COLOR, colors)
+
+def _price_evaluation_panel(vehicles, label, chosen_vin):
+	return {
+		'label': label,
+		'x': _latest_listing_values(vehicles, 'mileage'),
+		'y': _latest_listing_values(vehicles, 'price'),
+		'color': _remote_colors(vehicles, chosen_vin)
+	}
+
+# naive local datetime64s of epoch seconds, as datetime.datetime.fromtimestamp(...) gives them
+# utc offsets only change on quarter hours, so they're looked up once per quarter hour
+def _local_datetime64(times):
+	quarters, inverse = np.unique(np.floor(times/900).astype(np.int64), return_inverse=True)
+	offsets = np.array([time.localtime(quarter*900).tm_gmtoff for quarter in quarters.tolist()], dtype=np.float64)
+	return np.round((times + offsets[inverse.reshape(-1)])*1e6).astype(np.int64).astype('datetime64[us]')
+
+# per vehicle listing price histories, most recently seen vehicle first
+# times are drawn in local time like the listing datetimes of vehicle_dicts(...)
+def _price_history_lines(vehicles):
+	listings = vehicles['_listings']
+	vehicles = py_table.take(vehicles, np.argsort(-listings['scrape_time'][vehicles['latest_listing']], kind='stable'))
+	index, groups, offsets = _listing_index(vehicles)
+	# listings standing for several scrapes (see compress_history(...)) are drawn from first_seen to their last scrape
+	repeats = np.where(listings['listing_count'][index] > 1, 2, 1)
+	points = np.repeat(index, repeats)
+	first_point = np.append(True, points[1:] != points[:-1]) if len(points) else np.array([], dtype=bool)
+	times = np.where(first_point, listings['first_seen'][points], listings['scrape_time'][points])
+	return {
+		'x': mdates.date2num(_local_datetime64(times)),
+		'y': listings['price'][points],
+		'series_lengths': np.add.reduceat(repeats, offsets) if len(offsets) else offsets
+	}
+
+# plot jobs for plotter.render_batch(...), any number of models
+def plot_jobs(plot_data, config):
+	chosen_vin = config['chosen_vin']
+	jobs = [
+		# one panel per model
+		(plotter.grid_scatter, {
+			'panels': [_price_evaluation_panel(model_data['all_vehicles'], model, chosen_vin) for model, model_data in plot_data['models'].items()],
+			'title': 'price evaluation',
+			'legend_entries': REMOTE_COLOR_LEGEND,
+			'x_axis_format': MILEAGE_AXIS_FORMAT,
+			'y_axis_format': PRICE_AXIS_FORMAT
+		}),
+		(plotter.grid_scatter, {
+			'panels': [
+				_price_evaluation_panel(plot_data['all']['all_vehicles'], 'all vehicles', chosen_vin),
+				_price_evaluation_panel(plot_data['filtered_for_csv'], 'filtered vehciles', chosen_vin)
+			],
+			'title': 'filtered listings',
+			'legend_entries': REMOTE_COLOR_LEGEND,
+			'x_axis_format': MILEAGE_AXIS_FORMAT,
+			'y_axis_format': PRICE_AXIS_FORMAT
+		}),
+		(plotter.grid_scatter, {
+			'panels': [{
+				'label': 'historic scores',
+				'x': _latest_listing_values(plot_data['filtered_for_plot'], 'price'),
+				'y': plot_data['filtered_for_plot']['score'],
+				'color': _active_inactive_colors(plot_data['filtered_for_plot'], chosen_vin)
+			}],
+			'title': 'historic scores',
+			'legend_entries': ACTIVE_INACTIVE_COLOR_LEGEND,
+			'x_axis_format': PRICE_AXIS_FORMAT,
+			'y_axis_format': SCORE_AXIS_FORMAT
+		})
 	]
+	if PLOT_PRICE_HISTORY:
+		# most daily listings repeat the previous price, only price changes are drawn
+		jobs.append((plotter.array_line_plot, {
+			**_price_history_lines(plot_data['filtered_for_csv']),
+			'title': 'price history',
+			'x_axis_format': TIME_AXIS_FORMAT,
+			'y_axis_format': PRICE_AXIS_FORMAT,
+			'decimate': True
+		}))
+	return jobs
+
+def plot_vehicles(plot_data, config):
+	jobs = plot_jobs(plot_data, config)
+	if PLOT_HEADLESS:
+		filepaths = plotter.render_batch(jobs, PLOT_WORKERS)
+		print(f'rendered {len(filepaths)} plots')
+	else:
+		for plot_func, kwargs in jobs:
+			plot_func(**kwargs)
 
-	def remote_color_func(v): 
-		if v['vin'] == config['chosen_vin']:
-			return CHOSEN_COLOR
-		elif v['latest_listing']['remote'] == True or v['latest_listing']['remote'] == 't':
-			return REMOTE_COLOR 
+SCALAR_SORT_FIELDS = ['price', 'mileage']
+DICT_SORT_FIELDS = ['drivetrain', 'color', 'model', 'version']
+BOOL_SORT_FIELDS = ['remote']
+
+# compile a selection_params sort config once into a scoring plan for score_vehicles(...)
+	# scalar fields: one weight per field
+	# dict fields: {value: weight} lookups, expanded to per-category tables per vehicle table
+	# distance_by_dealer: dealer ids memoized by owner & dealer fees by dealer id in the plan, across calls with it
+def compile_sort_plan(sort_config):
+	plan = {
+		'scalar_fields': [],
+		'scalar_weights': [],
+		'lookups': {},
+		'bool_weights': {},
+		'dealers': None,
+		'default_dealer': None,
+		'dealer_ids': {},
+		'dealer_fees': {}
+	}
+	for param, value in sort_config.items():
+		if param in SCALAR_SORT_FIELDS:
+			plan['scalar_fields'].append(param)
+			plan['scalar_weights'].append(value)
+		elif param in DICT_SORT_FIELDS:
+			plan['lookups'][param] = dict(value)
+		elif param in BOOL_SORT_FIELDS:
+			plan['bool_weights'][param] = value
+		elif param == 'distance_by_dealer':
+			plan['dealers'] = [(canonical_dealer(dealer), info['per_mile'], info['flat_fee']) for dealer, info in py_utils.dict_omit(value, ['default']).items()]
+			plan['default_dealer'] = (value['default']['per_mile'], value['default']['flat_fee'])
 		else:
-			return LOCAL_COLOR
-	remote_color_legend = [
-		{'label': 'local', 'color': LOCAL_COLOR},
-		{'label': 'remote', 'color': REMOTE_COLOR},
-		{'label': 'chosen', 'color': CHOSEN_COLOR},
-	]
+			raise ValueError(f'scoring not implemented for field: {param}')
+	plan['scalar_weights'] = np.array(plan['scalar_weights'], dtype=np.float64)
+	return plan
 
-	def constant_color_func(v): return DEFAULT_COLOR
-
-	if len(list(plot_data['models'].keys())) != 2:
-		raise ValueError('analyze.plot_vehicles currently configured for exactly 2 models')
-
-	# TURNED OFF: wasn't looking at & slowed down script
-	# plotter.double_scatter(
-	# 	list(plot_data['models'].values())[0]['all_vehicles'], list(plot_data['models'].values())[1]['all_vehicles'],
-	# 	mileage_data_func, price_data_func, remote_color_func,
-	# 	list(plot_data['models'].keys())[0], list(plot_data['models'].keys())[1],
-	# 	'price evaluation', legend_entries=remote_color_legend,
-	# 	x_axis_format=mileage_axis_format, y_axis_format=price_axis_format
-	# )
-
-	plotter.double_scatter(
-		plot_data['all']['all_vehicles'], plot_data['filtered_for_csv'],
-		mileage_data_func, price_data_func, remote_color_func,
-		'all vehicles', 'filtered vehciles',
-		'filtered listings', legend_entries=remote_color_legend,
-		x_axis_format=mileage_axis_format, y_axis_format=price_axis_format
-	)
+# owner -> canonical dealer id: lowercased, punctuation & repeated whitespace dropped
+# owners spelled differently share a dealer id, and so a single dealer fee lookup
+def canonical_dealer(owner):
+	if owner is None:
+		return None
+	return ' '.join(re.sub(r'[^a-z0-9]+', ' ', owner.lower()).split())
 
-	# plotter.single_histogram(
-	# 	plot_data['filtered_for_plot'], score_func,
-	# 	'historic scores',
-	# 	score_format
-	# )
-	plotter.single_scatter(
-		plot_data['filtered_for_plot'],
-		price_data_func, score_func, active_inactive_color_func, 
-		'historic scores', legend_entries=active_inactive_color_legend,
-		x_axis_format=price_axis_format, y_axis_format=score_axis_format
-	)
+# (per_mile, flat_fee) of first dealer found in the owner's dealer id, None if no match
+def _dealer_fee(plan, owner):
+	if owner not in plan['dealer_ids']:
+		plan['dealer_ids'][owner] = canonical_dealer(owner)
+	dealer_id = plan['dealer_ids'][owner]
+	if dealer_id not in plan['dealer_fees']:
+		fee = None
+		if dealer_id is not None:
+			for dealer, per_mile, flat_fee in plan['dealers']:
+				if dealer in dealer_id:
+					fee = (per_mile, flat_fee)
+					break
+		plan['dealer_fees'][dealer_id] = fee
+	return plan['dealer_fees'][dealer_id]
 
-def sort_listings(filtered_listings, sort_config):
-	scalar_fields = ['price', 'mileage']
-	dict_fields = ['drivetrain', 'color', 'model', 'version']
-	bool_fields = ['remote']
-	
-	def score_vehicle(vehicle):
-		score = 0
-		for param, value in sort_config.items():
-			if param in scalar_fields:
-				if param in LISTING_FIELDS and param in vehicle['latest_listing']:
-					score = score + value*vehicle['latest_listing'][param]
-				elif param in vehicle:
-					score = score + value*vehicle[param]
-			elif param in dict_fields:
-				if param in LISTING_FIELDS and param in vehicle['latest_listing'] and vehicle['latest_listing'][param] in value:
-					score = score + value[vehicle['latest_listing'][param]]
-				elif param in vehicle and vehicle[param] in value:
-					score = score + value[vehicle[param]]
-			elif param in bool_fields:
-				if param in LISTING_FIELDS and param in vehicle['latest_listing'] and vehicle['latest_listing'][param]:
-					score = score + value
-				elif param in vehicle and vehicle[param]:
-					score = score + value
-			elif param == 'distance_by_dealer':
-				distance_by_dealer_scored = False
-				distance_by_dealer_adj = None
-				for dealer, scoring_info in py_utils.dict_omit(value, ['default']).items():
-					if not distance_by_dealer_scored and 'parsed_owner' in vehicle and vehicle['parsed_owner'] is not None and dealer.lower() in vehicle['parsed_owner'].lower():
-						score = score + vehicle['distance']*scoring_info['per_mile'] + scoring_info['flat_fee']
-						distance_by_dealer_scored = True
-				if not distance_by_dealer_scored and 'distance' in vehicle and vehicle['distance'] is not None:
-					score = score + vehicle['distance']*value['default']['per_mile'] + value['default']['flat_fee']
-			else:
-				raise ValueError(f'scoring not implemented for field: {param}')
-		for reason, adjustment in vehicle['score_adjustments'].items():
-			score += adjustment
-		return score
-	
-	for vehicle in filtered_listings:
-		vehicle['score'] = score_vehicle(vehicle)
-	return sorted(filtered_listings, key=lambda v: v['score'])
+# table, row index of a scored field: latest listing for listing fields, else the vehicle itself
+def _scored_field_source(vehicles, field):
+	if field in LISTING_FIELDS and field in vehicles['_listings']:
+		return vehicles['_listings'], vehicles['latest_listing']
+	elif field in vehicles:
+		return vehicles, slice(None)
+	return None, None
+
+def score_vehicles(vehicles, plan):
+	score = np.zeros(py_table.length(vehicles))
+
+	# elementwise rather than a matrix product, so a vehicle's score doesn't depend on the rows scored with it
+	for field, weight in zip(plan['scalar_fields'], plan['scalar_weights']):
+		table, index = _scored_field_source(vehicles, field)
+		if table is not None:
+			score = score + table[field][index].astype(np.float64)*weight
+
+	for field, weights in plan['lookups'].items():
+		table, index = _scored_field_source(vehicles, field)
+		if table is not None:
+			category_weights = np.array([weights.get(c, 0) for c in table['_categories'][field]], dtype=np.float64)
+			score = score + category_weights[table[field][index]]
 
-def dump_ranked_listings(all_scored_vehicles, ranked_choices, sort_config):
+	for field, weight in plan['bool_weights'].items():
+		table, index = _scored_field_source(vehicles, field)
+		if table is not None:
+			score = score + np.where(table[field][index], weight, 0)
+
+	if plan['dealers'] is not None:
+		owner_fees = [_dealer_fee(plan, owner) for owner in vehicles['_categories']['parsed_owner']]
+		owner_matched = np.array([fee is not None for fee in owner_fees], dtype=bool)
+		owner_per_mile = np.array([fee[0] if fee is not None else 0 for fee in owner_fees], dtype=np.float64)
+		owner_flat_fee = np.array([fee[1] if fee is not None else 0 for fee in owner_fees], dtype=np.float64)
+
+		owner_codes = vehicles['parsed_owner']
+		has_distance = ~np.isnan(vehicles['distance'])
+		matched = owner_matched[owner_codes]
+		default_per_mile, default_flat_fee = plan['default_dealer']
+		per_mile = np.where(matched, owner_per_mile[owner_codes], np.where(has_distance, default_per_mile, 0))
+		flat_fee = np.where(matched, owner_flat_fee[owner_codes], np.where(has_distance, default_flat_fee, 0))
+		score = score + np.where(has_distance, vehicles['distance'], 0)*per_mile + flat_fee
+
+	return score + vehicles['score_adjustment']
+
+def score_listings(filtered_listings, sort_plan):
+	return {**filtered_listings, 'score': score_vehicles(filtered_listings, sort_plan)}
+
+def sort_listings(filtered_listings, sort_plan):
+	scored = score_listings(filtered_listings, sort_plan)
+	return py_table.take(scored, np.argsort(scored['score'], kind='stable'))
+
+# positions of the k best (lowest) scores ordered by (score, id), same order as a stable argsort on ids order
+# partial selection: one np.partition to find the k-th score, only the k selected are sorted
+# ties at the k-th score keep the lowest ids, nan scores sort last
+def _select_top(scores, ids, k):
+	if k <= 0:
+		return np.array([], dtype=np.int64)
+	if k >= len(scores):
+		return np.lexsort((ids, scores))
+	threshold = np.partition(scores, k - 1)[k - 1]
+	if np.isnan(threshold):
+		better, tied = ~np.isnan(scores), np.isnan(scores)
+	else:
+		better, tied = scores < threshold, scores == threshold
+	better_positions = np.flatnonzero(better)
+	tied_positions = np.flatnonzero(tied)
+	tied_positions = tied_positions[np.argsort(ids[tied_positions], kind='stable')][:k - len(better_positions)]
+	selected = np.concatenate([better_positions, tied_positions])
+	return selected[np.lexsort((ids[selected], scores[selected]))]
+
+# ranks offset + 1 to offset + limit of vehicles by score (lowest first), as sort_listings(...)[offset:offset + limit]
+# vehicles are scored chunk_size at a time keeping only the best offset + limit, so memory is bounded by
+# chunk_size + offset + limit rows however large the candidate pool is, limit None ranks everything
+def rank_vehicles(vehicles, sort_plan, limit=None, offset=0, chunk_size=RANK_CHUNK_SIZE):
+	n = py_table.length(vehicles)
+	keep = n if limit is None else min(n, offset + limit)
+	best_ids = np.array([], dtype=np.int64)
+	best_scores = np.array([], dtype=np.float64)
+	for start in range(0, n, chunk_size):
+		chunk_ids = np.arange(start, min(n, start + chunk_size))
+		chunk_scores = score_vehicles(py_table.take(vehicles, chunk_ids), sort_plan)
+		ids = np.concatenate([best_ids, chunk_ids])
+		scores = np.concatenate([best_scores, chunk_scores])
+		selected = _select_top(scores, ids, keep)
+		best_ids, best_scores = ids[selected], scores[selected]
+	ranked = py_table.take(vehicles, best_ids[offset:])
+	ranked['score'] = best_scores[offset:]
+	return ranked
+
+# alltime_score_% of each score: % of sorted_scores (np.sort(...)ed all scores) below it to 1 decimal
+# sort the scores once per scoring, not per call
+def score_percentiles(sorted_scores, scores):
+	return np.round(np.searchsorted(sorted_scores, scores)/len(sorted_scores)*100, 1)
+
+# dump rows of ranked_choices, a rank_vehicles(...) page starting at first_rank
+# alltime_score_% is relative to sorted_scores, see score_percentiles(...), links are only formatted for these rows
+def ranked_rows(sorted_scores, ranked_choices, link_templates, first_rank=1):
 	# vehicle fields to dump first
 	DUMP_FIELDS_LISTING = [
 		'price_f',
@@ -440,10 +1470,10 @@ def dump_ranked_listings(all_scored_vehicles, ranked_choices, sort_config):
 		'link_3'
 	]
 
-	sorted_scores = sorted([v['score'] for v in all_scored_vehicles if 'score' in v])
+	percentiles = score_percentiles(sorted_scores, ranked_choices['score']).tolist()
 	dumpable_listings = []
-	rank = 1
-	for vehicle in ranked_choices:
+	rank = first_rank
+	for vehicle, percentile in zip(vehicle_dicts(ranked_choices, link_templates), percentiles):
 		# format for dump
 		vehicle['days_detected'] = round(vehicle['days_detected'])
 		vehicle['score_f'] = f'{round(vehicle["score"] / 1000, 1)}k'
@@ -458,62 +1488,127 @@ def dump_ranked_listings(all_scored_vehicles, ranked_choices, sort_config):
 		max_links = 4
 		for link in list(vehicle['active_links'].values()):
 			if written_links >= max_links:
-				raise ValueError(f'dump_ranked_listings: unsupported number of links: {len(vehicle["active_links"])}')
+				raise ValueError(f'ranked_rows: unsupported number of links: {len(vehicle["active_links"])}')
 			vehicle[f'link_{written_links}'] = link
 			written_links += 1
 
 		dumpable_listings.append({
 			'rank': rank,
 			'score_f': vehicle['score_f'],
-			'alltime_score_%': round(np.searchsorted(sorted_scores, vehicle['score'])/len(sorted_scores)*100,1),
+			'alltime_score_%': percentile,
 			**py_utils.dict_pick(vehicle['latest_listing'], DUMP_FIELDS_LISTING),
 			**py_utils.dict_pick(vehicle, DUMP_FIELDS_VEHICLE)
 		})
 		rank += 1
-	py_utils.write_csv(OUTPUT_PATH, dumpable_listings)
+	return dumpable_listings
 
-def main():
-	config_public = json.load(open(CONFIG_PUBLIC_PATH))
-	config_secret = json.load(open(CONFIG_SECRET_PATH))
-	config = {**config_public, **config_secret}
-	selections_params = json.load(open(SELECTION_PATH)) 
+def dump_ranked_listings(sorted_scores, ranked_choices, link_templates, first_rank=1):
+	py_utils.write_csv(OUTPUT_PATH, ranked_rows(sorted_scores, ranked_choices, link_templates, first_rank))
 
-	src_data = get_data(config)
+def run_pipeline(config, selections_params):
+	models = list(config['scrape_configs'].keys())
+	if SCRAPE_SUMMARY and not LOCAL_MODE:
+		with py_instrument.stage('scrape_summary'):
+			print_scrape_summary(config, models)
+	if AGGREGATE_MODE or INCREMENTAL_MODE:
+		with py_instrument.stage('aggregate_vehicles' if AGGREGATE_MODE else 'incremental_vehicles') as stage:
+			vehicles = get_aggregated_vehicles(config, models) if AGGREGATE_MODE else get_incremental_vehicles(config, models)
+			vehicles_by_model = split_by_model(vehicles, models)
+			stage['rows_out'] = py_table.length(vehicles)
+	else:
+		with py_instrument.stage('get_listings') as stage:
+			listings = get_listings(config, models)
+			stage['rows_out'] = py_table.length(listings)
+		with py_instrument.stage('get_model_vehicles', rows_in=py_table.length(listings)) as stage:
+			vehicles_by_model = get_model_vehicles(listings, models)
+			stage['rows_out'] = sum([py_table.length(v) for v in vehicles_by_model.values()])
+		del listings
 	plot_data = {
-		'all': {
-			'all_vehicles': [],
-			'active_vehicles': [],
-			'inactive_vehicles': []
-		},
 		'models': {}
 	}
-	for model, model_config in config['scrape_configs'].items():
-		raw_model_data = [row for row in src_data if row['model'] == model]
-
-		model_listings = prep_listings(raw_model_data, {'verbose': VERBOSE})
-		raw_model_vehicles = get_unique_vehicles(model_listings)
-		model_vehicles = augment_vehicles(raw_model_vehicles)
-
-		all_vehicles = [vehicle for vehicle in model_vehicles.values()]
-		active_vehicles = [vehicle for vehicle in model_vehicles.values() if vehicle['active'] == True]
-		inactive_vehicles = [vehicle for vehicle in model_vehicles.values() if vehicle['active'] == False]
-		print(f'{model}: found {len(active_vehicles)} active and {len(inactive_vehicles)} inactive vehicles')
+	model_vehicle_tables = []
+	for model in models:
+		model_vehicles = vehicles_by_model[model]
+		active_vehicles = py_table.take(model_vehicles, model_vehicles['active'])
+		inactive_vehicles = py_table.take(model_vehicles, ~model_vehicles['active'])
+		print(f'{model}: found {py_table.length(active_vehicles)} active and {py_table.length(inactive_vehicles)} inactive vehicles')
+		for name in ACTIVE_WINDOWS:
+			if f'active_{name}' in model_vehicles:
+				print(f'\t{name}: {np.count_nonzero(model_vehicles[f"active_{name}"])} active')
 
 		plot_data['models'][model] = {
-			'all_vehicles': all_vehicles,
+			'all_vehicles': model_vehicles,
 			'active_vehicles': active_vehicles,
 			'inactive_vehicles': inactive_vehicles
 		}
-		plot_data['all']['all_vehicles'] = plot_data['all']['all_vehicles'] + all_vehicles
-		plot_data['all']['active_vehicles'] = plot_data['all']['active_vehicles'] + active_vehicles
-		plot_data['all']['inactive_vehicles'] = plot_data['all']['inactive_vehicles'] + active_vehicles
-	plot_data['filtered_for_csv'] = filter_vehicles(plot_data['all']['all_vehicles'], selections_params['filters_for_csv'])
-	plot_data['filtered_for_plot'] = sort_listings(filter_vehicles(plot_data['all']['all_vehicles'], selections_params['filters_for_plot']), selections_params['sort'])
+		model_vehicle_tables.append(model_vehicles)
+	with py_instrument.stage('concat_vehicles') as stage:
+		all_vehicles = concat_vehicles(model_vehicle_tables)
+		stage['rows_out'] = py_table.length(all_vehicles)
+	with py_instrument.stage('resolve_distances', rows_in=py_table.length(all_vehicles)):
+		all_vehicles = resolve_distances(all_vehicles, get_locations(config))
+	plot_data['all'] = {
+		'all_vehicles': all_vehicles,
+		'active_vehicles': py_table.take(all_vehicles, all_vehicles['active']),
+		'inactive_vehicles': py_table.take(all_vehicles, ~all_vehicles['active'])
+	}
+	sort_plan = compile_sort_plan(selections_params['sort'])
+	with py_instrument.stage('filter_vehicles', rows_in=py_table.length(all_vehicles)) as stage:
+		filtered = filter_vehicle_sets(plot_data['all']['all_vehicles'], py_utils.dict_pick(selections_params, ['filters_for_csv', 'filters_for_plot']))
+		stage['rows_out'] = {name: py_table.length(vehicles) for name, vehicles in filtered.items()}
+	plot_data['filtered_for_csv'] = filtered['filters_for_csv']
+	with py_instrument.stage('score_listings', rows_in=py_table.length(filtered['filters_for_plot'])) as stage:
+		plot_data['filtered_for_plot'] = score_listings(filtered['filters_for_plot'], sort_plan)
+		stage['rows_out'] = py_table.length(plot_data['filtered_for_plot'])
+
+	with py_instrument.stage('plot_vehicles'):
+		plot_vehicles(plot_data, config)
+
+	with py_instrument.stage('dump_ranked_listings', rows_in=py_table.length(plot_data['filtered_for_csv'])) as stage:
+		ranked_choices = rank_vehicles(plot_data['filtered_for_csv'], sort_plan, RANKED_LIMIT, RANKED_OFFSET)
+		dump_ranked_listings(np.sort(plot_data['filtered_for_plot']['score']), ranked_choices, compile_link_templates(config['scrape_configs']), RANKED_OFFSET + 1)
+		stage['rows_out'] = py_table.length(ranked_choices)
 
-	plot_vehicles(plot_data, config)
+def run_report_meta(config):
+	return {
+		'models': list(config['scrape_configs'].keys()),
+		'argv': sys.argv,
+		'pid': os.getpid(),
+		'flags': {name: globals()[name] for name in [
+			'LOCAL_MODE',
+			'STREAM_MODE',
+			'SNAPSHOT_MODE',
+			'INCREMENTAL_MODE',
+			'AGGREGATE_MODE',
+			'COMPRESS_HISTORY',
+			'COMPACTED_DB',
+			'MODEL_WORKERS',
+			'PLOT_WORKERS',
+			'PLOT_PRICE_HISTORY'
+		]}
+	}
+
+def main():
+	config_public = json.load(open(CONFIG_PUBLIC_PATH))
+	config_secret = json.load(open(CONFIG_SECRET_PATH))
+	config = {**config_public, **config_secret}
+	selections_params = json.load(open(SELECTION_PATH)) 
 
-	ranked_choices = sort_listings(plot_data['filtered_for_csv'], selections_params['sort'])
-	dump_ranked_listings(plot_data['filtered_for_plot'], ranked_choices, selections_params)
+	if not RUN_REPORT:
+		run_pipeline(config, selections_params)
+		return
+	py_instrument.start_run('analyze', run_report_meta(config), RUN_PROFILE, RUN_TRACE_MEMORY)
+	# the report is also written when the run fails, the failing stage has an 'error'
+	try:
+		run_pipeline(config, selections_params)
+	finally:
+		report = py_instrument.finish_run()
+		# microseconds & pid: runs started within the same second (e.g. from cron & by hand) don't overwrite each other's report
+		report_path = os.path.join(RUN_REPORT_DIR, f'{datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")}_{os.getpid()}.json')
+		py_instrument.save(report, report_path)
+		py_instrument.prune(RUN_REPORT_DIR, RUN_REPORT_KEEP)
+		print(f'run report: {report_path}, {report["wall_s"]:.2f}s, peak rss: {report["peak_rss_mb"]:.0f}MB')
 	
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+	main()
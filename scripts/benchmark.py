@@ -0,0 +1,808 @@
+'''
+Benchmark
+- times analyze pipeline pieces against seeded synthetic data
+- run from repo root: python scripts/benchmark.py [bench_name ...]
+
+Benchmarks
+	join	: LOCAL_MODE hash join vs the old nested loop join, at 1x/10x/100x synthetic sizes
+	score	: compiled sort plan scoring, at 1k/10k/100k vehicles
+	py_utils	: dedupe & dict projection helpers vs their previous implementations, at 100k rows
+	history	: compress_history change points vs full listing history, at 100k vehicles x 19 listings with prices changing at ~10% of listings
+	windows	: augment_vehicles with 0, 2 and 6 extra active windows, at 100k vehicles x 19 listings
+	models	: per-model pipeline, old per-model isin scan vs single-pass partition, serial and in a process pool, at 24 models
+	plots	: headless batch plot rendering, 24 model price evaluation grid + filtered/score plots, at 100k vehicles
+	lines	: price history line plot, one ax.plot per vehicle vs one LineCollection, with and without decimation, at 5k vehicles x 30 listings
+	csv	: LOCAL_MODE typed csv load + prep and ranked listings csv write vs read_csv / DictWriter, at 100k listings
+	rank	: top 100 ranking + alltime score percentiles, full sort + per vehicle searchsorted vs rank_vehicles + score_percentiles, at 100k/500k candidates
+	pipeline	: time & peak rss (py_instrument stages) of each analyze stage on realistic synthetic data, at 10k/100k/1M listings
+		results are appended to PIPELINE_RESULTS_PATH and compared against the previous run at the same size
+
+DB Benchmarks (need the pg_config in analyze.CONFIG_SECRET_PATH, only run when named)
+	db	: schema.sql reporting queries before vs after db_tools.py setup (indexes, summary views & per-source latest listing index), at 50k vehicles x 20 listings in a scratch schema
+		also times listing inserts with & without the per-source latest listing index trigger
+'''
+
+import sys, os
+import random
+import itertools
+import gc
+import datetime, time
+import json
+import csv
+import subprocess
+import tempfile
+import contextlib, io
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../utils/'))
+sys.path.append(os.path.dirname(__file__))
+
+import py_utils
+import py_table
+import py_postgres
+import py_instrument
+import analyze
+import db_tools
+
+SEED = 0
+BASE_VEHICLES = 30
+LISTINGS_PER_VEHICLE = 19
+SCALES = [1, 10, 100]
+NESTED_LOOP_MAX_COMPARISONS = 2*10**8 # skip the old join above this, it takes minutes
+
+MODELS = ['grand_cherokee', 'compass']
+SOURCES = ['autolist', 'auto_trader', 'edmunds', 'cars.com', 'carvana']
+START_TIME = datetime.datetime(2021, 1, 1)
+SCORE_SIZES = [10**3, 10**4, 10**5]
+SCORE_REPEATS = 10
+PY_UTILS_ROWS = 10**5
+PY_UTILS_UNIQUE_VALUES = 1000
+CSV_LISTINGS = 10**5
+MANY_MODELS = [f'model_{i}' for i in range(24)]
+MODELS_VEHICLES = 10**5
+LINE_VEHICLES = 5000
+LINE_LISTINGS_PER_VEHICLE = 30
+RANK_SIZES = [10**5, 5*10**5] # candidate vehicles
+RANK_TOP = 100
+PIPELINE_SIZES = [10**4, 10**5, 10**6] # listings
+PIPELINE_RESULTS_PATH = 'results/benchmarks/pipeline.jsonl'
+PIPELINE_REGRESSION_RATIO = 1.2 # stage times this much slower than the previous run are flagged
+# realistic data, from the schema.sql db stats (1/26/2021)
+# listings by source, cars.com is left out since it gets no link (see analyze.LINK_TEMPLATES)
+PIPELINE_SOURCE_WEIGHTS = {'autolist': 48, 'auto_trader': 6, 'edmunds': 2, 'carvana': 0.5}
+PIPELINE_SOURCES_PER_VEHICLE = [0.87, 0.08, 0.037, 0.013] # share of vehicles listed by 1, 2, 3 & 4 sources
+PIPELINE_LISTINGS_PER_VEHICLE = 19 # mean, geometric
+PIPELINE_HISTORY_DAYS = 70
+PIPELINE_PRICE_DROP_RATE = 0.08 # per listing, drops of $100-1000
+PIPELINE_PRICE_RAISE_RATE = 0.01 # per listing, raises of $100-500
+DB_SCHEMA = 'cars_benchmark' # scratch schema, dropped and recreated by bench_db
+DB_VEHICLES = 5*10**4
+DB_LISTINGS_PER_VEHICLE = 20
+DB_HISTORY_DAYS = 180
+DB_MODELS = ['grand_cherokee', 'cherokee', 'compass', 'renegade', 'wrangler', 'gladiator', 'wagoneer']
+DB_REPEATS = 3
+
+COLORS = ['gray', 'white', 'black', 'silver', 'red', 'orange', 'blue', None]
+OWNERS = ['Texas Direct Auto', 'CarMax Oakland', 'CarMax Sacramento', 'Bay Area Jeep', None]
+
+def synthetic_local_data(n_vehicles, listings_per_vehicle=LISTINGS_PER_VEHICLE, seed=SEED):
+	rng = random.Random(seed)
+	raw_vehicles = []
+	raw_listings = []
+	for i in range(n_vehicles):
+		vin = f'SYNTH{rng.getrandbits(48):012X}{i:06d}'
+		raw_vehicles.append({
+			'vin': vin,
+			'created_on': START_TIME.isoformat(),
+			'make': 'jeep',
+			'model': rng.choice(MODELS),
+			'version': rng.choice(['', 'limited', 'laredo']),
+			'year': str(rng.randint(2011, 2020)),
+		})
+		for day in range(listings_per_vehicle):
+			raw_listings.append({
+				'id': str(len(raw_listings) + 1),
+				'created_on': (START_TIME + datetime.timedelta(days=day, seconds=i)).isoformat(),
+				'vin': vin,
+				'source': rng.choice(SOURCES),
+				'owner': '',
+				'zip': str(rng.randint(90000, 96000)),
+				'mileage': str(rng.randint(5000, 100000)),
+				'price': str(rng.randint(8000, 20000)),
+				'title': '',
+			})
+	# listings table is in insertion (scrape) order, not vin order
+	raw_listings.sort(key=lambda l: l['created_on'])
+	return raw_vehicles, raw_listings
+
+# prepped listing table (see analyze.LISTING_SCHEMA), listings of each vehicle a day apart ending now
+def synthetic_listing_table(n_vehicles, listings_per_vehicle=LISTINGS_PER_VEHICLE, seed=SEED, models=MODELS):
+	rng = np.random.default_rng(seed)
+	n = n_vehicles*listings_per_vehicle
+	vehicle = np.repeat(np.arange(n_vehicles), listings_per_vehicle)
+	day = np.tile(np.arange(listings_per_vehicle)[::-1], n_vehicles)
+
+	def per_vehicle(values):
+		return values[vehicle]
+	def choice(options, size):
+		return [options[i] for i in rng.integers(0, len(options), size)]
+
+	distance = rng.integers(0, 300, n_vehicles).astype(float)
+	distance[rng.random(n_vehicles) < 0.1] = np.nan
+	columns = {
+		'vin': per_vehicle(np.array([f'SYNTH{i:012d}' for i in range(n_vehicles)])),
+		'make': ['jeep']*n,
+		'model': per_vehicle(np.array(choice(models, n_vehicles), dtype=object)),
+		'version': per_vehicle(np.array(choice(['limited', 'laredo', None], n_vehicles), dtype=object)),
+		'year': per_vehicle(rng.integers(2011, 2021, n_vehicles)),
+		'drivetrain': per_vehicle(np.array(choice(['4x4', 'fwd', None], n_vehicles), dtype=object)),
+		'color': per_vehicle(np.array(choice(COLORS, n_vehicles), dtype=object)),
+		'estimated_value': per_vehicle(rng.integers(10000, 20000, n_vehicles)),
+		'parsed_owner': per_vehicle(np.array(choice(OWNERS, n_vehicles), dtype=object)),
+		'distance': [None if np.isnan(d) else d for d in per_vehicle(distance)],
+		'score_adjustments': [{}]*n,
+		'sold': per_vehicle(rng.random(n_vehicles) < 0.05),
+		'source': choice(SOURCES, n),
+		'owner': ['']*n,
+		'zip': rng.integers(90000, 96000, n),
+		'price': per_vehicle(rng.integers(8000, 20000, n_vehicles)) + rng.integers(-5, 5, n)*100,
+		'mileage': per_vehicle(rng.integers(5000, 100000, n_vehicles)),
+		'scrape_time': time.time() - day*60*60*24 - rng.integers(0, 60*60, n),
+		'remote': rng.random(n) < 0.2,
+		'listing_count': np.ones(n, dtype=np.int64),
+	}
+	columns['first_seen'] = columns['scrape_time']
+	return py_table.from_columns(columns, analyze.LISTING_SCHEMA)
+
+def synthetic_vehicles(n_vehicles, listings_per_vehicle=LISTINGS_PER_VEHICLE, seed=SEED):
+	return analyze.augment_vehicles(analyze.get_unique_vehicles(synthetic_listing_table(n_vehicles, listings_per_vehicle, seed)))
+
+def _nested_loop_join(raw_vehicles, raw_listings):
+	joined_data = []
+	for vehicle in raw_vehicles:
+		for listing in raw_listings:
+			if listing['vin'] is not None and listing['vin'] != "" and vehicle['vin'] == listing['vin']:
+				joined_data.append({
+					**py_utils.dict_pick(vehicle, ['make', 'model', 'version', 'year']),
+					**py_utils.dict_omit(listing, ['created_on']),
+					'scrape_time': analyze.dateutil.parser.parse(listing['created_on'])
+				})
+	return sorted(joined_data, key=lambda j: j['vin'])
+
+# {column: list of values} of rows, as py_utils.read_csv_columns(...) reads them
+def _row_columns(rows):
+	return {column: [row[column] for row in rows] for column in rows[0]} if len(rows) else {}
+
+def _time(func, *args):
+	start = time.perf_counter()
+	result = func(*args)
+	return result, time.perf_counter() - start
+
+# best of repeats, less noisy for short allocation heavy runs
+def _best_time(func, *args, repeats=5):
+	times = []
+	for i in range(repeats):
+		gc.collect()
+		result, run_time = _time(func, *args)
+		times.append(run_time)
+	return result, min(times)
+
+def bench_join():
+	for scale in SCALES:
+		raw_vehicles, raw_listings = synthetic_local_data(BASE_VEHICLES*scale)
+		joined, hash_time = _time(analyze.join_local_data, _row_columns(raw_vehicles), _row_columns(raw_listings))
+
+		loop_time = None
+		if len(raw_vehicles)*len(raw_listings) <= NESTED_LOOP_MAX_COMPARISONS:
+			loop_joined, loop_time = _time(_nested_loop_join, raw_vehicles, raw_listings)
+			if loop_joined != joined:
+				raise RuntimeError(f'bench_join: hash join output differs from nested loop at scale {scale}x')
+
+		loop_str = f'{loop_time:.3f}s' if loop_time is not None else 'skipped'
+		speedup_str = f', speedup: {loop_time/hash_time:.1f}x' if loop_time is not None else ''
+		print(f'join {scale}x ({len(raw_vehicles)} vehicles, {len(raw_listings)} listings): hash: {hash_time:.3f}s, nested loop: {loop_str}{speedup_str}')
+
+def bench_score():
+	sort_config = json.load(open(analyze.SELECTION_PATH))['sort']
+	for size in SCORE_SIZES:
+		vehicles = synthetic_vehicles(size, listings_per_vehicle=2)
+		plan, compile_time = _time(analyze.compile_sort_plan, sort_config)
+		_, cold_time = _time(analyze.score_vehicles, vehicles, plan)
+		start = time.perf_counter()
+		for i in range(SCORE_REPEATS):
+			analyze.sort_listings(vehicles, plan)
+		warm_time = (time.perf_counter() - start)/SCORE_REPEATS
+		print(f'score {size} vehicles: compile: {compile_time*1000:.2f}ms, first score: {cold_time*1000:.2f}ms, score + sort: {warm_time*1000:.2f}ms')
+
+def _old_dict_omit(d, keys):
+	return {x: d[x] for x in d if x not in keys}
+
+def _old_dedupe(_list):
+	deduped_list = []
+	for val in _list:
+		if val not in deduped_list:
+			deduped_list.append(val)
+	return deduped_list
+
+def bench_py_utils():
+	rng = random.Random(SEED)
+	values = [rng.randrange(PY_UTILS_UNIQUE_VALUES) for i in range(PY_UTILS_ROWS)]
+	unhashable_values = [[v % 50] for v in values[:PY_UTILS_ROWS//10]]
+	raw_vehicles, raw_listings = synthetic_local_data(PY_UTILS_ROWS//LISTINGS_PER_VEHICLE + 1)
+	rows = [{**vehicle, **listing} for vehicle, listing in zip(itertools.cycle(raw_vehicles), raw_listings[:PY_UTILS_ROWS])]
+	omit_keys = ['created_on', 'title', 'owner']
+
+	cases = [
+		(f'dedupe ({PY_UTILS_UNIQUE_VALUES} unique)', lambda: _old_dedupe(values), lambda: py_utils.dedupe(values)),
+		(f'dedupe unhashable ({len(unhashable_values)} rows)', lambda: _old_dedupe(unhashable_values), lambda: py_utils.dedupe(unhashable_values)),
+		('dict_omit per row', lambda: [_old_dict_omit(r, omit_keys) for r in rows], lambda: [py_utils.dict_omit(r, omit_keys) for r in rows]),
+	]
+	for name, old_func, new_func in cases:
+		old_result, old_time = _best_time(old_func)
+		new_result, new_time = _best_time(new_func)
+		if old_result != new_result:
+			raise RuntimeError(f'bench_py_utils: {name}: results differ from previous implementation')
+		print(f'py_utils {name}, {PY_UTILS_ROWS} rows: old: {old_time*1000:.1f}ms, new: {new_time*1000:.1f}ms, speedup: {old_time/new_time:.1f}x')
+
+# listing table where source, price & mileage only change at ~change_rate of each vehicle's listings
+def synthetic_repeating_listing_table(n_vehicles, change_rate=0.1, seed=SEED):
+	listings = synthetic_listing_table(n_vehicles, seed=seed)
+	n = py_table.length(listings)
+	changes = np.random.default_rng(seed).random(n) < change_rate
+	changes[np.flatnonzero(np.append(True, listings['vin'][1:] != listings['vin'][:-1]))] = True
+	repeated = np.maximum.accumulate(np.where(changes, np.arange(n), 0))
+	for field in analyze.HISTORY_RUN_FIELDS:
+		listings[field] = listings[field][repeated]
+	return listings
+
+def bench_history():
+	vehicles = analyze.get_unique_vehicles(synthetic_repeating_listing_table(10**5))
+	reference_time = time.time()
+	full, full_time = _best_time(analyze.augment_vehicles, vehicles, reference_time, repeats=3)
+	compressed, compress_time = _best_time(analyze.compress_history, vehicles, repeats=3)
+	compressed_full, augment_time = _best_time(analyze.augment_vehicles, compressed, reference_time, repeats=3)
+	for field in ['days_detected', 'active', 'all_sources', 'active_sources', 'net_price_change', 'price_increases', 'price_decreases']:
+		if not np.array_equal(full[field], compressed_full[field]):
+			raise RuntimeError(f'bench_history: {field} differs between full and compressed history')
+	full_bytes = sum([v.nbytes for k, v in vehicles['_listings'].items() if py_table.is_column(k)])
+	compressed_bytes = sum([v.nbytes for k, v in compressed['_listings'].items() if py_table.is_column(k)])
+	print(f'history {py_table.length(vehicles)} vehicles: listings: {py_table.length(vehicles["_listings"])} -> {py_table.length(compressed["_listings"])}, listing arrays: {full_bytes/2**20:.0f}MB -> {compressed_bytes/2**20:.0f}MB')
+	print(f'history augment: full: {full_time*1000:.1f}ms, compress: {compress_time*1000:.1f}ms, compressed augment: {augment_time*1000:.1f}ms')
+
+def bench_windows():
+	vehicles = analyze.get_unique_vehicles(synthetic_listing_table(10**5))
+	reference_time = time.time()
+	for n_windows in [0, 2, 6]:
+		windows = {f'{days}d': days*60*60*24 for days in range(2, 2 + n_windows)}
+		augmented, run_time = _best_time(analyze.augment_vehicles, vehicles, reference_time, analyze.ACTIVE_PERIOD, windows, repeats=3)
+		print(f'windows augment {py_table.length(vehicles)} vehicles, {py_table.length(vehicles["_listings"])} listings, {n_windows} extra windows: {run_time*1000:.1f}ms')
+
+def _old_model_vehicles(listings, models):
+	return {model: analyze.build_model_vehicles(py_table.take(listings, py_table.isin(listings, 'model', [model]))) for model in models}
+
+def bench_models():
+	listings = synthetic_listing_table(MODELS_VEHICLES, listings_per_vehicle=5, models=MANY_MODELS)
+	old_vehicles, old_time = _time(_old_model_vehicles, listings, MANY_MODELS)
+	print(f'models {len(MANY_MODELS)} models, {py_table.length(listings)} listings: isin per model, serial: {old_time:.3f}s')
+	for workers in dict.fromkeys([1, os.cpu_count()]):
+		analyze.MODEL_WORKERS = workers
+		vehicles, run_time = _time(analyze.get_model_vehicles, listings, MANY_MODELS)
+		if list(vehicles) != MANY_MODELS or any([not np.array_equal(vehicles[m]['vin'], old_vehicles[m]['vin']) for m in MANY_MODELS]):
+			raise RuntimeError(f'bench_models: {workers} workers: vehicles differ from the serial isin pipeline')
+		print(f'models {len(MANY_MODELS)} models, {py_table.length(listings)} listings: partition, {workers} workers: {run_time:.3f}s, speedup: {old_time/run_time:.1f}x')
+
+def bench_plots():
+	listings = synthetic_listing_table(MODELS_VEHICLES, listings_per_vehicle=2, models=MANY_MODELS)
+	vehicles_by_model = analyze.get_model_vehicles(listings, MANY_MODELS)
+	all_vehicles = analyze.concat_vehicles(list(vehicles_by_model.values()))
+	plan = analyze.compile_sort_plan(json.load(open(analyze.SELECTION_PATH))['sort'])
+	plot_data = {
+		'models': {model: {'all_vehicles': vehicles} for model, vehicles in vehicles_by_model.items()},
+		'all': {'all_vehicles': all_vehicles},
+		'filtered_for_csv': py_table.take(all_vehicles, np.arange(0, py_table.length(all_vehicles), 10)),
+		'filtered_for_plot': analyze.sort_listings(all_vehicles, plan)
+	}
+	with tempfile.TemporaryDirectory() as directory:
+		analyze.plotter.RESULTS_DIR = directory
+		jobs, jobs_time = _time(analyze.plot_jobs, plot_data, {'chosen_vin': ''})
+		for workers in dict.fromkeys([1, os.cpu_count()]):
+			filepaths, render_time = _time(analyze.plotter.render_batch, jobs, workers)
+			print(f'plots {len(filepaths)} figures, {len(MANY_MODELS)} models, {py_table.length(all_vehicles)} vehicles: plot data: {jobs_time*1000:.1f}ms, render, {workers} workers: {render_time:.2f}s')
+
+def _old_line_plot(x, y, series_lengths, title):
+	fig, ax = analyze.plotter.plt.subplots(figsize=analyze.plotter.SINGLE_FIGURE_SIZE)
+	for series_x, series_y in zip(np.split(x, np.cumsum(series_lengths)[:-1]), np.split(y, np.cumsum(series_lengths)[:-1])):
+		ax.plot(series_x, series_y)
+	analyze.plotter._save_figure(fig, title)
+	analyze.plotter.plt.close(fig)
+
+def bench_lines():
+	vehicles = synthetic_vehicles(LINE_VEHICLES, listings_per_vehicle=LINE_LISTINGS_PER_VEHICLE)
+	lines = analyze._price_history_lines(vehicles)
+	# most daily listings repeat the previous price: prices only change at ~10% of listings
+	starts = np.cumsum(lines['series_lengths']) - lines['series_lengths']
+	changes = np.random.default_rng(SEED).random(len(lines['y'])) < 0.1
+	changes[starts] = True
+	lines['y'] = lines['y'][np.maximum.accumulate(np.where(changes, np.arange(len(changes)), 0))]
+	analyze.plotter._set_headless()
+	with tempfile.TemporaryDirectory() as directory:
+		analyze.plotter.RESULTS_DIR = directory
+		_, old_time = _time(_old_line_plot, lines['x'], lines['y'], lines['series_lengths'], 'old')
+		_, collection_time = _time(lambda: analyze.plotter.array_line_plot(**lines, title='collection'))
+		_, decimated_time = _time(lambda: analyze.plotter.array_line_plot(**lines, title='decimated', decimate=True))
+	print(f'lines {LINE_VEHICLES} vehicles, {len(lines["x"])} listings: ax.plot per vehicle: {old_time:.2f}s, line collection: {collection_time:.2f}s, decimated: {decimated_time:.2f}s, speedup: {old_time/decimated_time:.1f}x')
+
+def _old_local_listings(vehicles_path, listings_path):
+	raw_vehicles = py_utils.read_csv(vehicles_path)
+	raw_listings = py_utils.read_csv(listings_path)
+	vehicles_by_vin = {vehicle['vin']: py_utils.dict_pick(vehicle, analyze.LOCAL_VEHICLE_FIELDS) for vehicle in reversed(raw_vehicles)}
+	joined_data = []
+	for listing in raw_listings:
+		if listing['vin'] in vehicles_by_vin:
+			joined_data.append({
+				**vehicles_by_vin[listing['vin']],
+				**py_utils.dict_omit(listing, ['created_on']),
+				'scrape_time': analyze.dateutil.parser.parse(listing['created_on'])
+			})
+	return analyze.prep_listings(sorted(joined_data, key=lambda j: j['vin']))
+
+def _new_local_listings(vehicles_path, listings_path):
+	vehicle_columns = py_utils.read_csv_columns(vehicles_path, analyze.LOCAL_VEHICLES_SCHEMA)
+	listing_columns = py_utils.read_csv_columns(listings_path, analyze.LOCAL_LISTINGS_SCHEMA)
+	return analyze.prep_listings(analyze.join_local_data(vehicle_columns, listing_columns))
+
+def _old_write_csv(filepath, data):
+	with open(filepath, 'w', newline='') as csv_file:
+		csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=data[0].keys())
+		csv_writer.writeheader()
+		for row in data:
+			csv_writer.writerow(row)
+
+def bench_csv():
+	raw_vehicles, raw_listings = synthetic_local_data(CSV_LISTINGS//LISTINGS_PER_VEHICLE + 1)
+	raw_listings = raw_listings[:CSV_LISTINGS]
+	with tempfile.TemporaryDirectory() as directory:
+		vehicles_path = os.path.join(directory, 'vehicles.csv')
+		listings_path = os.path.join(directory, 'vehicle_listings.csv')
+		old_path = os.path.join(directory, 'old.csv')
+		new_path = os.path.join(directory, 'new.csv')
+		with contextlib.redirect_stdout(io.StringIO()):
+			py_utils.write_csv(vehicles_path, raw_vehicles)
+			py_utils.write_csv(listings_path, raw_listings)
+
+			old_listings, old_time = _time(_old_local_listings, vehicles_path, listings_path)
+			new_listings, new_time = _time(_new_local_listings, vehicles_path, listings_path)
+		if py_table.to_lists(old_listings) != py_table.to_lists(new_listings):
+			raise RuntimeError('bench_csv: typed csv load differs from read_csv load')
+		print(f'csv local load + prep, {len(raw_listings)} listings: old: {old_time:.3f}s, new: {new_time:.3f}s, speedup: {old_time/new_time:.1f}x')
+
+		dump_rows = [{'rank': i, **py_utils.dict_omit(listing, ['id'])} for i, listing in enumerate(raw_listings)]
+		_, old_time = _best_time(_old_write_csv, old_path, dump_rows)
+		with contextlib.redirect_stdout(io.StringIO()):
+			_, new_time = _best_time(py_utils.write_csv, new_path, dump_rows)
+		if open(old_path).read() != open(new_path).read():
+			raise RuntimeError('bench_csv: write_csv output differs from DictWriter output')
+		print(f'csv write, {len(dump_rows)} rows: old: {old_time*1000:.1f}ms, new: {new_time*1000:.1f}ms, speedup: {old_time/new_time:.1f}x')
+
+# the old dump ranked every candidate and searchsorted each one's alltime score %
+def _old_rank(vehicles, plan):
+	ranked = analyze.sort_listings(vehicles, plan)
+	sorted_scores = np.sort(ranked['score'])
+	percentiles = [round(np.searchsorted(sorted_scores, score)/len(sorted_scores)*100, 1) for score in ranked['score']]
+	return ranked['vin'][:RANK_TOP], percentiles[:RANK_TOP]
+
+# all scores are still needed for the percentiles, main(...) has them from scoring the plotted vehicles
+def _new_rank(vehicles, plan):
+	all_scores = analyze.score_vehicles(vehicles, plan)
+	ranked = analyze.rank_vehicles(vehicles, plan, RANK_TOP)
+	percentiles = analyze.score_percentiles(np.sort(all_scores), ranked['score']).tolist()
+	return ranked['vin'], percentiles
+
+# rss growth of a py_instrument stage record, empty where the start rss is unknown (no /proc)
+def _rss_growth(stage):
+	return f' (+{stage["peak_rss_mb"] - stage["start_rss_mb"]:.0f}MB)' if stage['start_rss_mb'] is not None else ''
+
+def bench_rank():
+	plan = analyze.compile_sort_plan(json.load(open(analyze.SELECTION_PATH))['sort'])
+	for size in RANK_SIZES:
+		vehicles = synthetic_vehicles(size, listings_per_vehicle=2)
+		py_instrument.start_run('rank')
+		with py_instrument.stage('old') as old_stage:
+			(old_vins, old_percentiles), old_time = _best_time(_old_rank, vehicles, plan, repeats=3)
+		with py_instrument.stage('new') as new_stage:
+			(new_vins, new_percentiles), new_time = _best_time(_new_rank, vehicles, plan, repeats=3)
+		py_instrument.finish_run()
+		if not np.array_equal(old_vins, new_vins) or old_percentiles != new_percentiles:
+			raise RuntimeError(f'bench_rank: top {RANK_TOP} differs from the full sort at {size} vehicles')
+		print(f'rank top {RANK_TOP} of {size} vehicles: old: {old_time*1000:.1f}ms{_rss_growth(old_stage)}, new: {new_time*1000:.1f}ms{_rss_growth(new_stage)}, speedup: {old_time/new_time:.1f}x')
+
+# local mode csv rows (strings, as read from the exported tables) totalling exactly n_listings listings
+# each vehicle is scraped about daily from its own 1-4 sources, ending anywhere in the last PIPELINE_HISTORY_DAYS
+def realistic_local_data(n_listings, seed=SEED, models=MODELS):
+	rng = np.random.default_rng(seed)
+	counts = rng.geometric(1/PIPELINE_LISTINGS_PER_VEHICLE, n_listings//PIPELINE_LISTINGS_PER_VEHICLE*2 + 10)
+	n_vehicles = int(np.searchsorted(np.cumsum(counts), n_listings)) + 1
+	counts = counts[:n_vehicles]
+	counts[-1] -= counts.sum() - n_listings
+	vehicle = np.repeat(np.arange(n_vehicles), counts)
+	offsets = np.cumsum(counts) - counts
+	position = np.arange(n_listings) - offsets[vehicle]
+
+	day = 60*60*24
+	spacing = np.minimum(day, PIPELINE_HISTORY_DAYS*day/counts)
+	first_time = time.time() - PIPELINE_HISTORY_DAYS*day + rng.random(n_vehicles)*(PIPELINE_HISTORY_DAYS*day - counts*spacing)
+	scrape_time = first_time[vehicle] + position*spacing[vehicle] + rng.random(n_listings)*spacing[vehicle]/2
+
+	price_steps = np.where(rng.random(n_listings) < PIPELINE_PRICE_DROP_RATE, -rng.integers(1, 11, n_listings)*100, 0)
+	price_steps += np.where(rng.random(n_listings) < PIPELINE_PRICE_RAISE_RATE, rng.integers(1, 6, n_listings)*100, 0)
+	price_steps[offsets] = 0
+	drift = np.cumsum(price_steps)
+	base_price = np.clip(np.round(rng.normal(16000, 3500, n_vehicles), -2), 4000, 40000)
+	price = np.maximum(base_price[vehicle] + drift - drift[offsets][vehicle], 1000).astype(np.int64)
+	mileage = rng.integers(5000, 90000, n_vehicles)
+
+	sources = list(PIPELINE_SOURCE_WEIGHTS.keys())
+	source_p = np.array(list(PIPELINE_SOURCE_WEIGHTS.values()))/sum(PIPELINE_SOURCE_WEIGHTS.values())
+	n_sources = rng.choice(np.arange(1, len(PIPELINE_SOURCES_PER_VEHICLE) + 1), n_vehicles, p=PIPELINE_SOURCES_PER_VEHICLE)
+	vehicle_sources = [rng.choice(sources, k, replace=False, p=source_p) for k in n_sources]
+	listing_source = rng.random(n_listings)
+
+	raw_vehicles = []
+	for i in range(n_vehicles):
+		raw_vehicles.append({
+			'vin': f'SYNTH{i:012d}',
+			'created_on': datetime.datetime.fromtimestamp(first_time[i]).isoformat(),
+			'make': 'jeep',
+			'model': models[i % len(models)],
+			'version': ['limited', 'laredo', ''][i % 3],
+			'year': str(2011 + i % 10)
+		})
+	raw_listings = []
+	for i, v in enumerate(vehicle.tolist()):
+		raw_listings.append({
+			'id': str(i + 1),
+			'created_on': datetime.datetime.fromtimestamp(scrape_time[i]).isoformat(),
+			'vin': raw_vehicles[v]['vin'],
+			'source': vehicle_sources[v][int(listing_source[i]*len(vehicle_sources[v]))],
+			'owner': '',
+			'zip': str(90000 + (v*37) % 6000),
+			'mileage': str(mileage[v]),
+			'price': str(price[i]),
+			'title': '',
+			'remote': 't' if v % 10 == 0 else 'f'
+		})
+	raw_listings.sort(key=lambda l: l['created_on'])
+	return raw_vehicles, raw_listings
+
+def _stage(stages, name, func, *args):
+	gc.collect()
+	with py_instrument.stage(name) as record:
+		result = func(*args)
+	stages[name] = {'time': record['wall_s'], 'cpu_time': record['cpu_s'], 'start_rss_mb': record['start_rss_mb'], 'peak_rss_mb': record['peak_rss_mb']}
+	return result
+
+def _git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+# analyze.main(...) stages, in LOCAL_MODE with a single process for the models & plots so rss covers all the work
+def _pipeline_stages(directory, selection_params):
+	stages = {}
+	config = {'chosen_vin': ''}
+	data = _stage(stages, 'get_data', analyze.get_data, config, MODELS)
+	listings = _stage(stages, 'prep_listings', analyze.prep_listings, data)
+	del data
+	unique_vehicles = _stage(stages, 'get_unique_vehicles', analyze.get_unique_vehicles, listings)
+	vehicles = _stage(stages, 'augment_vehicles', analyze.augment_vehicles, unique_vehicles)
+	del listings, unique_vehicles
+
+	filters = py_utils.dict_pick(selection_params, ['filters_for_csv', 'filters_for_plot'])
+	filtered = _stage(stages, 'filter_vehicles', analyze.filter_vehicle_sets, vehicles, filters)
+	sort_plan = analyze.compile_sort_plan(selection_params['sort'])
+	filtered_for_plot = analyze.score_listings(filtered['filters_for_plot'], sort_plan)
+	ranked_choices = _stage(stages, 'sort_listings', analyze.rank_vehicles, filtered['filters_for_csv'], sort_plan, analyze.RANKED_LIMIT, analyze.RANKED_OFFSET)
+	link_templates = analyze.compile_link_templates(json.load(open(analyze.CONFIG_PUBLIC_PATH))['scrape_configs'])
+	_stage(stages, 'dump_ranked_listings', analyze.dump_ranked_listings, np.sort(filtered_for_plot['score']), ranked_choices, link_templates, analyze.RANKED_OFFSET + 1)
+
+	partitions = analyze.partition_by_model(vehicles, MODELS)
+	plot_data = {
+		'models': {model: {'all_vehicles': py_table.take(vehicles, partitions[model])} for model in MODELS},
+		'all': {'all_vehicles': vehicles},
+		'filtered_for_csv': filtered['filters_for_csv'],
+		'filtered_for_plot': filtered_for_plot
+	}
+	_stage(stages, 'plot_vehicles', analyze.plot_vehicles, plot_data, config)
+	return stages, py_table.length(vehicles)
+
+def _previous_pipeline_runs(path):
+	if not os.path.exists(path):
+		return []
+	with open(path) as results_file:
+		return [json.loads(line) for line in results_file if line.strip()]
+
+def bench_pipeline():
+	selection_params = json.load(open(analyze.SELECTION_PATH))
+	previous_runs = _previous_pipeline_runs(PIPELINE_RESULTS_PATH)
+	runs = []
+	with tempfile.TemporaryDirectory() as directory:
+		analyze.LOCAL_MODE = True
+		analyze.LOCAL_VEHCILES_PATH = os.path.join(directory, 'vehicles.csv')
+		analyze.LOCAL_LISTINGS_PATH = os.path.join(directory, 'vehicle_listings.csv')
+		analyze.OUTPUT_PATH = os.path.join(directory, 'ranked_listings.csv')
+		analyze.PLOT_WORKERS = 1
+		analyze.plotter.RESULTS_DIR = directory
+		for size in PIPELINE_SIZES:
+			raw_vehicles, raw_listings = realistic_local_data(size)
+			with contextlib.redirect_stdout(io.StringIO()):
+				py_utils.write_csv(analyze.LOCAL_VEHCILES_PATH, raw_vehicles)
+				py_utils.write_csv(analyze.LOCAL_LISTINGS_PATH, raw_listings)
+			del raw_vehicles, raw_listings
+			gc.collect()
+
+			py_instrument.start_run('pipeline')
+			with contextlib.redirect_stdout(io.StringIO()):
+				stages, n_vehicles = _pipeline_stages(directory, selection_params)
+			py_instrument.finish_run()
+			run = {
+				'time': datetime.datetime.now().isoformat(timespec='seconds'),
+				'commit': _git_commit(),
+				'listings': size,
+				'vehicles': n_vehicles,
+				'stages': stages
+			}
+			runs.append(run)
+
+			previous = next((r for r in reversed(previous_runs) if r['listings'] == size), None)
+			print(f'pipeline {size} listings, {n_vehicles} vehicles' + (f', vs {previous["commit"]} ({previous["time"]})' if previous else ''))
+			for name, stage in stages.items():
+				compare_str = ''
+				if previous is not None and name in previous['stages']:
+					ratio = stage['time']/previous['stages'][name]['time']
+					compare_str = f', {ratio:.2f}x previous' + (' (slower)' if ratio > PIPELINE_REGRESSION_RATIO else '')
+				print(f'\t{name}: {stage["time"]:.3f}s, peak rss: {stage["peak_rss_mb"]:.0f}MB{_rss_growth(stage)}{compare_str}')
+
+	os.makedirs(os.path.dirname(PIPELINE_RESULTS_PATH), exist_ok=True)
+	with open(PIPELINE_RESULTS_PATH, 'a') as results_file:
+		for run in runs:
+			results_file.write(json.dumps(run) + '\n')
+	print(f'pipeline results appended to {PIPELINE_RESULTS_PATH}')
+
+DB_TABLES_DDL = f'''
+	drop schema if exists {DB_SCHEMA} cascade;
+	create schema {DB_SCHEMA};
+	create table vehicles (
+		vin text primary key,
+		created_on timestamp default now(),
+		make text not null,
+		model text not null,
+		version text,
+		year integer not null,
+		model_validated_on timestamp,
+		drivetrain text,
+		color text,
+		estimated_value integer,
+		_owner text,
+		distance int,
+		score_adjustments jsonb default '{{}}'::jsonb,
+		sold boolean not null default false
+	);
+	create table vehicle_listings (
+		id serial primary key,
+		created_on timestamp not null default now(),
+		vin text references vehicles (vin),
+		source text not null,
+		owner text,
+		zip integer not null,
+		mileage integer not null,
+		price integer not null,
+		title text,
+		remote boolean,
+		unique (vin, created_on)
+	);
+'''
+# each vehicle is listed once a day for listings_per_vehicle days, first listings spread over the history up to today
+DB_DATA_QUERY = '''
+	select setseed(0.5);
+	insert into vehicles (vin, make, model, year)
+	select 'BENCH' || lpad(v::text, 12, '0'), 'jeep', (%(models)s::text[])[1 + mod(v, cardinality(%(models)s::text[]))], 2011 + mod(v, 10)
+	from generate_series(1, %(vehicles)s) v;
+	insert into vehicle_listings (created_on, vin, source, zip, mileage, price, remote)
+	select
+		now()::date - (%(days)s - 1) * interval '1 day'
+			+ (mod(v, %(days)s - %(listings_per_vehicle)s + 1) + d) * interval '1 day'
+			+ mod(v, 86400) * interval '1 second',
+		'BENCH' || lpad(v::text, 12, '0'),
+		(%(sources)s::text[])[1 + floor(random()*cardinality(%(sources)s::text[]))::integer],
+		90000 + floor(random()*6000)::integer,
+		5000 + floor(random()*95000)::integer,
+		20000 + floor(random()*20000)::integer,
+		random() < 0.1
+	from generate_series(1, %(vehicles)s) v, generate_series(0, %(listings_per_vehicle)s - 1) d;
+	analyze vehicles;
+	analyze vehicle_listings;
+'''
+# schema.sql reporting queries before the summary views, keyed like db_tools.REPORT_QUERIES
+OLD_REPORT_QUERIES = {
+	'recent': '''
+		select listings.created_on::date, model, count(*)
+		from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
+		where listings.created_on::date > now()::date - interval '2 weeks'
+		group by listings.created_on::date, model order by listings.created_on::date desc, model
+	''',
+	'recent_sources': '''
+		select listings.created_on::date, source, model, count(*)
+		from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
+		where listings.created_on::date > now()::date - interval '3 days'
+		group by listings.created_on::date, source, model order by listings.created_on::date desc, source, model
+	''',
+	'today': '''
+		select source, model, count(*)
+		from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
+		where listings.created_on::date = now()::date
+		group by source, model order by source, model
+	''',
+	'coverage': '''
+		with vehicle_sources as (
+			select vehicles.vin, array_agg(distinct listings.source order by listings.source) as all_sources
+			from vehicles join vehicle_listings listings
+				on vehicles.vin = listings.vin
+			group by vehicles.vin
+		) select all_sources, count(*)
+		from vehicle_sources
+		where %(sources)s::text[] && all_sources = false
+		group by all_sources order by count(*) desc, all_sources
+	''',
+	'coverage_by_model': '''
+		with vehicle_sources as (
+			select vehicles.vin, vehicles.model, array_agg(distinct listings.source order by listings.source) as all_sources
+			from vehicles join vehicle_listings listings
+				on vehicles.vin = listings.vin
+			group by vehicles.vin, vehicles.model
+		) select model, count(*)
+		from vehicle_sources
+		where %(sources)s::text[] && all_sources = false
+		group by model order by model
+	''',
+	'cheapest_sources': '''
+		with source_latest as (
+			select distinct on (vin, source) vin, source, created_on, created_on as last_seen, price
+			from vehicle_listings
+			order by vin, source, created_on desc
+		), cheapest as (
+			select distinct on (vin) vin, source
+			from source_latest
+			where last_seen > now() - interval '1 day'
+			order by vin, price, created_on desc
+		) select source, count(*)
+		from cheapest
+		group by source order by count(*) desc, source
+	''',
+	'source_counts': '''
+		with distinct_sources as (
+			select array_agg(distinct source) as sources
+			from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
+			group by vehicles.vin
+		) select array_length(sources, 1) as sources, count(*)
+		from distinct_sources
+		group by array_length(sources, 1) order by array_length(sources, 1) desc
+	''',
+	'detection_length': '''
+		with detection_lengths as (
+			select max(created_on) - min(created_on) as detection_length
+			from vehicle_listings
+			group by vin
+		) select avg(detection_length) as detection_length
+		from detection_lengths
+	'''
+}
+
+# another day of listings for every vehicle, days_ahead days after today
+DB_NEXT_DAY_QUERY = '''
+	insert into vehicle_listings (created_on, vin, source, zip, mileage, price, remote)
+	select
+		now()::date + %(days_ahead)s * interval '1 day' + mod(v, 86400) * interval '1 second',
+		'BENCH' || lpad(v::text, 12, '0'),
+		(%(sources)s::text[])[1 + floor(random()*cardinality(%(sources)s::text[]))::integer],
+		90000 + floor(random()*6000)::integer,
+		5000 + floor(random()*95000)::integer,
+		20000 + floor(random()*20000)::integer,
+		random() < 0.1
+	from generate_series(1, %(vehicles)s) v
+'''
+DB_SOURCE_INDEX_QUERY = 'select * from vehicle_source_listings order by vin, source'
+
+# analyze.py queries timed before & after setup, the scrape summary needs the views so is only timed after
+DB_ANALYZE_QUERIES = {
+	'latest scrape': analyze.LATEST_SCRAPE_QUERY,
+	'data fingerprint': analyze.DATA_FINGERPRINT_QUERY
+}
+
+def _time_report(query_str):
+	params = {'sources': db_tools.COVERAGE_SOURCES, 'models': DB_MODELS}
+	return _best_time(py_postgres.query, query_str, params, None, 'benchmark', repeats=DB_REPEATS)
+
+def bench_db():
+	pg_config = json.load(open(analyze.CONFIG_SECRET_PATH))['pg_config']
+	py_postgres.connect({**pg_config, 'options': f'-c search_path={DB_SCHEMA}'}, 'benchmark')
+	try:
+		py_postgres.execute(DB_TABLES_DDL, name='benchmark')
+		_, data_time = _time(py_postgres.execute, DB_DATA_QUERY, {
+			'models': DB_MODELS,
+			'sources': SOURCES,
+			'vehicles': DB_VEHICLES,
+			'days': DB_HISTORY_DAYS,
+			'listings_per_vehicle': DB_LISTINGS_PER_VEHICLE
+		}, 'benchmark')
+		print(f'db generated {DB_VEHICLES*DB_LISTINGS_PER_VEHICLE} listings in {data_time:.1f}s')
+
+		old_times = {}
+		old_results = {}
+		for name, query_str in OLD_REPORT_QUERIES.items():
+			old_results[name], old_times[name] = _time_report(query_str)
+		old_analyze_times = {name: _time_report(query_str)[1] for name, query_str in DB_ANALYZE_QUERIES.items()}
+
+		_, setup_time = _time(db_tools.setup, 'benchmark')
+		_, refresh_time = _time(db_tools.refresh, True, 'benchmark')
+		print(f'db setup (indexes, summary views & source index): {setup_time:.2f}s, concurrent refresh: {refresh_time:.2f}s')
+
+		for name, query_str in db_tools.REPORT_QUERIES.items():
+			new_result, new_time = _time_report(query_str)
+			# sum(...) over the summary view comes back as a decimal, compare printed values
+			if [[str(value) for value in row] for row in old_results[name]] != [[str(value) for value in row] for row in new_result]:
+				raise RuntimeError(f'bench_db: {name} report differs from the old query')
+			_, old_indexed_time = _time_report(OLD_REPORT_QUERIES[name])
+			print(f'db report {name}: old: {old_times[name]*1000:.1f}ms, old + indexes: {old_indexed_time*1000:.1f}ms, new: {new_time*1000:.1f}ms, speedup: {old_times[name]/new_time:.1f}x')
+
+		for name, query_str in DB_ANALYZE_QUERIES.items():
+			_, new_time = _time_report(query_str)
+			print(f'db analyze {name}: old: {old_analyze_times[name]*1000:.1f}ms, new: {new_time*1000:.1f}ms, speedup: {old_analyze_times[name]/new_time:.1f}x')
+		_, summary_time = _time_report(analyze.SCRAPE_SUMMARY_QUERY)
+		print(f'db analyze scrape summary: {summary_time*1000:.1f}ms')
+
+		# per-source latest listing index upkeep, the trigger maintained index must match a rebuild
+		next_day = {'sources': SOURCES, 'vehicles': DB_VEHICLES}
+		py_postgres.execute('alter table vehicle_listings disable trigger vehicle_source_listings_insert_trigger', name='benchmark')
+		_, untracked_time = _time(py_postgres.execute, DB_NEXT_DAY_QUERY, {**next_day, 'days_ahead': 1}, 'benchmark')
+		py_postgres.execute('alter table vehicle_listings enable trigger vehicle_source_listings_insert_trigger', name='benchmark')
+		_, rebuild_time = _time(py_postgres.execute, db_tools.SOURCE_INDEX_REBUILD, None, 'benchmark')
+		_, tracked_time = _time(py_postgres.execute, DB_NEXT_DAY_QUERY, {**next_day, 'days_ahead': 2}, 'benchmark')
+		tracked = py_postgres.query(DB_SOURCE_INDEX_QUERY, name='benchmark')
+		py_postgres.execute(db_tools.SOURCE_INDEX_REBUILD, name='benchmark')
+		if tracked != py_postgres.query(DB_SOURCE_INDEX_QUERY, name='benchmark'):
+			raise RuntimeError('bench_db: trigger maintained vehicle_source_listings differs from a rebuild')
+		print(f'db insert {DB_VEHICLES} listings: {untracked_time:.2f}s, with the source index trigger: {tracked_time:.2f}s, index rebuild: {rebuild_time:.2f}s')
+	finally:
+		py_postgres.execute(f'drop schema if exists {DB_SCHEMA} cascade', name='benchmark')
+		py_postgres.close('benchmark')
+
+BENCHMARKS = {
+	'join': bench_join,
+	'score': bench_score,
+	'py_utils': bench_py_utils,
+	'history': bench_history,
+	'windows': bench_windows,
+	'models': bench_models,
+	'plots': bench_plots,
+	'lines': bench_lines,
+	'csv': bench_csv,
+	'rank': bench_rank,
+	'pipeline': bench_pipeline,
+}
+
+# need a postgres, only run when named
+DB_BENCHMARKS = {
+	'db': bench_db,
+}
+
+def main():
+	names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+	benchmarks = {**BENCHMARKS, **DB_BENCHMARKS}
+	for name in names:
+		if name not in benchmarks:
+			raise ValueError(f'benchmark: unknown benchmark: {name}, options: {list(benchmarks.keys())}')
+		benchmarks[name]()
+
+if __name__ == '__main__':
+	main()
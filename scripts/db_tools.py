@@ -0,0 +1,384 @@
+'''
+DB Tools
+- maintains the analytics indexes & summary views and the per-source latest listing index from schema.sql
+- compacts listing history (COMPACTED_DB in scripts/analyze.py)
+- run from repo root: python scripts/db_tools.py <command> [args]
+
+Commands
+	setup	: create the indexes, summary views & per-source latest listing index (rebuilt), re-runnable
+	refresh	: refresh the summary views & create partitions ahead if partitioned, run after each scrape
+	report <name>	: print a reporting query's rows, names: see REPORT_QUERIES
+	compact	: compact listing history into price change points, deletes listing rows, re-runnable
+	partitions [YYYY-MM]	: create monthly vehicle_listings partitions from YYYY-MM (default: this month) through PARTITION_MONTHS_AHEAD
+		rows in the default partition (listings outside every monthly partition) move to their new month's partition
+	archive <YYYY-MM>	: detach partitions of months before YYYY-MM and move them to ARCHIVE_SCHEMA
+
+partitions & archive need vehicle_listings partitioned by the schema.sql partitioning migration
+'''
+
+import sys, os
+import re
+import json
+import time
+import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../utils/'))
+
+import py_postgres
+
+# control vars
+CONFIG_SECRET_PATH = 'incl/config_secret.json'
+COVERAGE_SOURCES = ['autolist', 'edmunds'] # reports coverage & coverage_by_model: vehicles never listed by any of these
+PARTITION_MONTHS_AHEAD = 2 # inserts into months without a partition go to the default partition, keep this many created ahead
+ARCHIVE_SCHEMA = 'listings_archive' # detached partitions are kept here, dump or drop them from there
+
+# statements below are kept in sync with schema.sql
+
+# summary views read last_seen & listing_count, written by compact
+LISTING_COLUMNS_DDL = '''
+	alter table vehicle_listings
+		add column if not exists remote boolean default false,
+		add column if not exists last_seen timestamp,
+		add column if not exists listing_count integer not null default 1
+'''
+# compact listing history into price change points, in one transaction
+# consecutive listings of a vin with the same source, price & mileage are collapsed into the run's first row:
+# created_on stays the first seen time, last_seen & listing_count cover the run, owner/zip/remote/title come from its latest row
+# re-runnable: later scrapes are inserted uncompacted and folded into their runs on the next run
+COMPACT_LISTINGS = '''
+	create temporary table listing_run_rows on commit drop as
+	with ordered as (
+		select
+			id, vin, created_on, coalesce(last_seen, created_on) as last_seen, listing_count,
+			case when lag(source) over w is distinct from source
+				or lag(price) over w is distinct from price
+				or lag(mileage) over w is distinct from mileage
+			then 1 else 0 end as new_run
+		from vehicle_listings
+		window w as (partition by vin order by created_on)
+	) select
+		id, vin, created_on, last_seen, listing_count,
+		sum(new_run) over (partition by vin order by created_on) as run
+	from ordered;
+
+	create temporary table listing_runs on commit drop as
+	select
+		vin, run,
+		(array_agg(id order by created_on))[1] as first_id,
+		(array_agg(id order by created_on desc))[1] as latest_id,
+		max(last_seen) as last_seen,
+		sum(listing_count) as listing_count
+	from listing_run_rows
+	group by vin, run;
+
+	update vehicle_listings listings set
+		last_seen = runs.last_seen,
+		listing_count = runs.listing_count,
+		owner = latest.owner,
+		zip = latest.zip,
+		remote = latest.remote,
+		title = latest.title
+	from listing_runs runs
+	join vehicle_listings latest on latest.id = runs.latest_id
+	where listings.id = runs.first_id;
+
+	delete from vehicle_listings listings
+	using listing_run_rows run_rows
+	join listing_runs runs on runs.vin = run_rows.vin and runs.run = run_rows.run
+	where listings.id = run_rows.id and run_rows.id != runs.first_id;
+'''
+INDEXES_DDL = '''
+	create index if not exists vehicle_listings_created_on_idx on vehicle_listings (created_on);
+	create index if not exists vehicle_listings_source_created_on_idx on vehicle_listings (source, created_on);
+	create index if not exists vehicles_model_idx on vehicles (model);
+'''
+SUMMARY_VIEWS_DDL = '''
+	create materialized view if not exists vehicle_summaries as
+	select
+		vehicles.vin,
+		vehicles.model,
+		min(listings.created_on) as first_seen,
+		max(coalesce(listings.last_seen, listings.created_on)) as last_seen,
+		sum(listings.listing_count) as listing_count,
+		array_agg(distinct listings.source order by listings.source) as sources
+	from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
+	group by vehicles.vin, vehicles.model;
+	create unique index if not exists vehicle_summaries_vin_idx on vehicle_summaries (vin);
+	create index if not exists vehicle_summaries_model_idx on vehicle_summaries (model);
+
+	create materialized view if not exists daily_listing_counts as
+	select listings.created_on::date as scrape_date, listings.source, vehicles.model, count(*) as listings
+	from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
+	group by listings.created_on::date, listings.source, vehicles.model;
+	create unique index if not exists daily_listing_counts_key_idx on daily_listing_counts (scrape_date, source, model);
+'''
+SUMMARY_VIEWS = ['vehicle_summaries', 'daily_listing_counts']
+
+# each vehicle's latest listing per source, kept current by statement level vehicle_listings triggers:
+# one upsert per insert / update statement over its new rows, not one per row
+SOURCE_INDEX_DDL = '''
+	create table if not exists vehicle_source_listings (
+		vin text not null,
+		source text not null,
+		listing_id integer not null,
+		created_on timestamp not null,
+		last_seen timestamp not null,
+		price integer not null,
+		primary key (vin, source)
+	);
+
+	create or replace function track_vehicle_source_listings() returns trigger as $$
+	begin
+		insert into vehicle_source_listings as latest (vin, source, listing_id, created_on, last_seen, price)
+		select distinct on (vin, source) vin, source, id, created_on, coalesce(last_seen, created_on), price
+		from new_listings
+		where vin is not null
+		order by vin, source, created_on desc
+		on conflict (vin, source) do update set
+			listing_id = excluded.listing_id,
+			created_on = excluded.created_on,
+			last_seen = excluded.last_seen,
+			price = excluded.price
+		where excluded.created_on >= latest.created_on;
+		return null;
+	end
+	$$ language plpgsql;
+
+	drop trigger if exists vehicle_source_listings_insert_trigger on vehicle_listings;
+	drop trigger if exists vehicle_source_listings_update_trigger on vehicle_listings;
+	create trigger vehicle_source_listings_insert_trigger
+		after insert on vehicle_listings
+		referencing new table as new_listings
+		for each statement execute function track_vehicle_source_listings();
+	create trigger vehicle_source_listings_update_trigger
+		after update on vehicle_listings
+		referencing new table as new_listings
+		for each statement execute function track_vehicle_source_listings();
+
+	create or replace view cheapest_active_listings as
+	select distinct on (vin) vin, source, listing_id, created_on, last_seen, price
+	from vehicle_source_listings
+	where last_seen > now() - interval '1 day'
+	order by vin, price, created_on desc;
+'''
+# the triggers only track inserts & updates, rebuilding also drops listings deleted since
+SOURCE_INDEX_REBUILD = '''
+	truncate vehicle_source_listings;
+	insert into vehicle_source_listings (vin, source, listing_id, created_on, last_seen, price)
+	select distinct on (vin, source) vin, source, id, created_on, coalesce(last_seen, created_on), price
+	from vehicle_listings
+	where vin is not null
+	order by vin, source, created_on desc;
+	analyze vehicle_source_listings;
+'''
+
+REPORT_QUERIES = {
+	'recent': '''
+		select scrape_date, model, sum(listings)
+		from daily_listing_counts
+		where scrape_date > now()::date - interval '2 weeks'
+		group by scrape_date, model order by scrape_date desc, model
+	''',
+	'recent_sources': '''
+		select scrape_date, source, model, listings
+		from daily_listing_counts
+		where scrape_date > now()::date - interval '3 days'
+		order by scrape_date desc, source, model
+	''',
+	'today': '''
+		select source, model, count(*)
+		from vehicles join vehicle_listings listings on vehicles.vin = listings.vin
+		where listings.created_on >= now()::date
+		group by source, model order by source, model
+	''',
+	'coverage': '''
+		with vehicle_sources as (
+			select vin, array_agg(source order by source) as sources
+			from vehicle_source_listings
+			group by vin
+		) select sources, count(*)
+		from vehicle_sources
+		where %(sources)s::text[] && sources = false
+		group by sources order by count(*) desc, sources
+	''',
+	'coverage_by_model': '''
+		select vehicles.model, count(*) as not_covered
+		from vehicles
+		where exists (select 1 from vehicle_source_listings listed where listed.vin = vehicles.vin)
+			and not exists (select 1 from vehicle_source_listings covered where covered.vin = vehicles.vin and covered.source = any(%(sources)s::text[]))
+		group by vehicles.model order by vehicles.model
+	''',
+	'cheapest_sources': '''
+		select source, count(*)
+		from cheapest_active_listings
+		group by source order by count(*) desc, source
+	''',
+	'source_counts': '''
+		select array_length(sources, 1) as sources, count(*)
+		from vehicle_summaries
+		group by array_length(sources, 1) order by array_length(sources, 1) desc
+	''',
+	'detection_length': '''
+		select avg(last_seen - first_seen) as detection_length
+		from vehicle_summaries
+	'''
+}
+
+# names match the schema.sql partitioning migration
+PARTITION_PREFIX = 'vehicle_listings_'
+PARTITION_NAME_PATTERN = re.compile(r'^vehicle_listings_y(\d{4})m(\d{2})$')
+DEFAULT_PARTITION = 'vehicle_listings_default'
+
+SOURCE_INDEX_EXISTS_QUERY = '''
+	select to_regclass('vehicle_source_listings') is not null
+'''
+IS_PARTITIONED_QUERY = '''
+	select coalesce((select relkind = 'p' from pg_class where oid = to_regclass('vehicle_listings')), false)
+'''
+DEFAULT_PARTITION_ROWS_QUERY = f'''
+	select exists (select 1 from {DEFAULT_PARTITION} where created_on >= %(start)s and created_on < %(end)s)
+'''
+PARTITIONS_QUERY = '''
+	select child.relname
+	from pg_inherits
+	join pg_class child on child.oid = pg_inherits.inhrelid
+	where pg_inherits.inhparent = to_regclass('vehicle_listings')
+'''
+
+COMMANDS = ['setup', 'refresh', 'report <name>', 'compact', 'partitions [YYYY-MM]', 'archive <YYYY-MM>']
+
+def setup(name='default'):
+	py_postgres.execute(LISTING_COLUMNS_DDL, name=name)
+	py_postgres.execute(INDEXES_DDL, name=name)
+	py_postgres.execute(SUMMARY_VIEWS_DDL, name=name)
+	py_postgres.execute(SOURCE_INDEX_DDL, name=name)
+	py_postgres.execute(SOURCE_INDEX_REBUILD, name=name)
+	if py_postgres.query(IS_PARTITIONED_QUERY, name=name)[0][0]:
+		create_partitions(name=name)
+
+# concurrently: readers of the views aren't blocked, needs the views' unique indexes & a populated view
+# also keeps partitions created ahead (once vehicle_listings is partitioned), so months don't pile up in the default partition
+def refresh(concurrently=True, name='default'):
+	if py_postgres.query(IS_PARTITIONED_QUERY, name=name)[0][0]:
+		create_partitions(name=name)
+	for view in SUMMARY_VIEWS:
+		py_postgres.execute(f'refresh materialized view {"concurrently " if concurrently else ""}{view}', name=name)
+
+def report(report_name, name='default'):
+	if report_name not in REPORT_QUERIES:
+		raise ValueError(f'db_tools.report: unknown report: {report_name}, options: {list(REPORT_QUERIES.keys())}')
+	return py_postgres.query(REPORT_QUERIES[report_name], {'sources': COVERAGE_SOURCES}, name=name)
+
+# deletes the listing rows folded into their runs, returns how many
+# the per-source latest listing index points at deleted rows afterwards, so it's rebuilt
+def compact(name='default'):
+	py_postgres.execute(LISTING_COLUMNS_DDL, name=name)
+	deleted = py_postgres.execute(COMPACT_LISTINGS, name=name)
+	if py_postgres.query(SOURCE_INDEX_EXISTS_QUERY, name=name)[0][0]:
+		py_postgres.execute(SOURCE_INDEX_REBUILD, name=name)
+	return deleted
+
+def partition_name(month):
+	return f'{PARTITION_PREFIX}y{month.year}m{month.month:02d}'
+
+def _add_months(month, months):
+	index = month.year*12 + month.month - 1 + months
+	return datetime.date(index // 12, index % 12 + 1, 1)
+
+def _parse_month(text):
+	try:
+		return datetime.datetime.strptime(text, '%Y-%m').date()
+	except ValueError:
+		raise ValueError(f'db_tools: invalid month: {text}, expected YYYY-MM')
+
+def _check_partitioned(name):
+	if not py_postgres.query(IS_PARTITIONED_QUERY, name=name)[0][0]:
+		raise ValueError('db_tools: vehicle_listings isn\'t partitioned, run the partitioning migration in schema.sql first')
+
+# first month of each attached partition, sorted
+def list_partitions(name='default'):
+	months = []
+	for (relname,) in py_postgres.query(PARTITIONS_QUERY, name=name):
+		match = PARTITION_NAME_PATTERN.match(relname)
+		if match is not None:
+			months.append(datetime.date(int(match.group(1)), int(match.group(2)), 1))
+	return sorted(months)
+
+# returns the names of the partitions created, existing ones are skipped
+# a month's rows already in the default partition are moved into its new partition, the default partition is detached meanwhile
+def create_partitions(first_month=None, months_ahead=PARTITION_MONTHS_AHEAD, name='default'):
+	_check_partitioned(name)
+	py_postgres.execute(f'create table if not exists {DEFAULT_PARTITION} partition of vehicle_listings default', name=name)
+	this_month = datetime.date.today().replace(day=1)
+	month = this_month if first_month is None else first_month.replace(day=1)
+	existing = set(list_partitions(name))
+	created = []
+	while month <= _add_months(this_month, months_ahead):
+		if month not in existing:
+			bounds = {'start': month, 'end': _add_months(month, 1)}
+			create = f'create table {partition_name(month)} partition of vehicle_listings for values from (%(start)s) to (%(end)s);'
+			if py_postgres.query(DEFAULT_PARTITION_ROWS_QUERY, bounds, name=name)[0][0]:
+				create = f'''
+					alter table vehicle_listings detach partition {DEFAULT_PARTITION};
+					{create}
+					with moved as (
+						delete from {DEFAULT_PARTITION} where created_on >= %(start)s and created_on < %(end)s returning *
+					)
+					insert into vehicle_listings select * from moved;
+					alter table vehicle_listings attach partition {DEFAULT_PARTITION} default;
+				'''
+			py_postgres.execute(create, bounds, name=name)
+			created.append(partition_name(month))
+		month = _add_months(month, 1)
+	return created
+
+# detached partitions keep their rows, indexes & vehicles fk, summary views drop their rows on the next refresh
+def archive_partitions(before_month, name='default'):
+	_check_partitioned(name)
+	if before_month > datetime.date.today().replace(day=1):
+		raise ValueError(f'db_tools.archive_partitions: refusing to archive the current month, before: {before_month}')
+	archived = []
+	for month in list_partitions(name):
+		if month >= before_month:
+			continue
+		py_postgres.execute(f'''
+			create schema if not exists {ARCHIVE_SCHEMA};
+			alter table vehicle_listings detach partition {partition_name(month)};
+			alter table {partition_name(month)} set schema {ARCHIVE_SCHEMA};
+		''', name=name)
+		archived.append(partition_name(month))
+	return archived
+
+def main():
+	if len(sys.argv) < 2:
+		raise ValueError(f'db_tools: missing command, options: {COMMANDS}')
+	command = sys.argv[1]
+	py_postgres.connect(json.load(open(CONFIG_SECRET_PATH))['pg_config'])
+
+	start = time.time()
+	if command == 'setup':
+		setup()
+	elif command == 'refresh':
+		refresh()
+	elif command == 'report':
+		if len(sys.argv) < 3:
+			raise ValueError(f'db_tools: missing report name, options: {list(REPORT_QUERIES.keys())}')
+		for row in report(sys.argv[2]):
+			print('\t'.join(str(value) for value in row))
+	elif command == 'compact':
+		print(f'compacted listing history, deleted {compact()} listing rows')
+		print('\tset COMPACTED_DB = True in scripts/analyze.py, delete cache/incremental_state.pkl (listing ids were removed) and run refresh')
+	elif command == 'partitions':
+		created = create_partitions(_parse_month(sys.argv[2]) if len(sys.argv) > 2 else None)
+		print(f'created partitions: {created}')
+	elif command == 'archive':
+		if len(sys.argv) < 3:
+			raise ValueError('db_tools: missing archive month, expected YYYY-MM')
+		archived = archive_partitions(_parse_month(sys.argv[2]))
+		print(f'archived partitions to {ARCHIVE_SCHEMA}: {archived}')
+	else:
+		raise ValueError(f'db_tools: unknown command: {command}, options: {COMMANDS}')
+	print(f'{command} took {time.time() - start:.2f}s')
+
+if __name__ == '__main__':
+	main()
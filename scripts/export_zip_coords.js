@@ -0,0 +1,30 @@
+/*
+  export_zip_coords
+
+  Writes the zipcodes package's zip coordinates to a csv for analyze.py's distance resolution (analyze.ZIP_COORDS_PATH)
+  - same coordinates augment_vehicles.js computes vehicles.distance from
+  - run from repo root: node scripts/export_zip_coords.js [output path]
+*/
+
+'use strict'
+
+const _                 = require('lodash')
+const zipcodes          = require('zipcodes')
+const js_utils          = require('../utils/js_utils')
+
+const DEFAULT_OUTPUT_PATH = 'incl/zip_coords.csv'
+
+const main = async function() {
+  const output_path = process.argv[2] || DEFAULT_OUTPUT_PATH
+  const rows = _.map(_.values(zipcodes.codes), code => _.pick(code, ['zip', 'latitude', 'longitude']))
+  await js_utils.write_csv(output_path, _.sortBy(rows, 'zip'))
+}
+
+if (require.main === module) {
+  main()
+    .catch((err) => {
+      console.error(err)
+      process.exit(1)
+    })
+    .then(() => process.exit(0))
+}
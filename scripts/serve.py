@@ -0,0 +1,261 @@
+'''
+Serve
+- resident analyze: loads & augments vehicles once, keeps them in memory and answers ranking requests over a local api
+- refreshes every REFRESH_INTERVAL s, on SIGHUP and on POST /refresh
+	- incrementally (analyze.update_incremental_vehicles) from the in memory state, full reloads if not INCREMENTAL_REFRESH or in analyze.LOCAL_MODE / AGGREGATE_MODE
+	- requests are answered from the previous vehicles while a refresh runs, the refreshed ones are swapped in once done
+- analyze.py control vars & config files apply, run from repo root: python scripts/serve.py
+
+API: json over http on HOST:PORT, or on the unix socket SOCKET_PATH if set (curl --unix-socket SOCKET_PATH http://serve/status)
+	GET /status	: vehicle count, time & duration of the last refresh
+	POST /refresh	: refresh now, responds with the status once done
+	POST /rank	: selection_params.json style request, missing keys default to analyze.SELECTION_PATH's
+		{"filters_for_csv": {...}, "filters_for_plot": {...}, "sort": {...}, "limit": 100, "offset": 0}
+		responds {"total": vehicles passing filters_for_csv, "rows": analyze.ranked_rows(...) rows, "ms": ...}
+		alltime_score_% is relative to the vehicles passing filters_for_plot, as in the csv
+'''
+
+import sys, os
+import json
+import time
+import datetime
+import signal
+import threading
+import socketserver
+import http.server
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../utils/'))
+sys.path.append(os.path.dirname(__file__))
+
+import py_table
+import analyze
+
+# control vars
+HOST = '127.0.0.1'
+PORT = 8765
+SOCKET_PATH = None # e.g. 'cache/serve.sock': serve on a unix socket instead of HOST:PORT
+REFRESH_INTERVAL = 60*15 # s, None: only refresh on SIGHUP / POST /refresh
+INCREMENTAL_REFRESH = True # False: reload everything on refresh, as an analyze.py run would
+SAVE_INCREMENTAL_STATE = True # save the state on each incremental refresh, so analyze.py INCREMENTAL_MODE runs resume from it
+FILTER_CACHE_SIZE = 32 # filtered vehicle tables kept per loaded data, by filter
+SCORES_CACHE_SIZE = 32 # sorted scores of filters_for_plot vehicles kept per loaded data, by filter & sort config
+SORT_PLAN_CACHE_SIZE = 64 # compiled sort plans kept, by sort config, until the next refresh
+DEFAULT_LIMIT = 100 # ranked rows returned when a request has no limit
+MAX_REQUEST_BYTES = 2**20
+
+served = None # {'vehicles', 'state', 'loaded', 'refresh_s', 'refreshes', 'filtered', 'sorted_scores'}, replaced whole on refresh
+refresh_lock = threading.Lock() # one refresh at a time
+refresh_event = threading.Event() # set to refresh now, by SIGHUP
+cache_lock = threading.Lock() # request threads share the caches below & served['filtered'] / ['sorted_scores']
+sort_plans = {}
+
+def _cache_key(params):
+	return json.dumps(params, sort_keys=True)
+
+# -> all vehicles as analyze.run_pipeline(...) concats them & the incremental state for the next load
+def load_vehicles(config, models, state=None):
+	if analyze.LOCAL_MODE or analyze.AGGREGATE_MODE or not INCREMENTAL_REFRESH:
+		state = None
+		if analyze.AGGREGATE_MODE:
+			vehicles_by_model = analyze.split_by_model(analyze.get_aggregated_vehicles(config, models), models)
+		else:
+			vehicles_by_model = analyze.get_model_vehicles(analyze.get_listings(config, models), models)
+	else:
+		if state is None:
+			state = analyze.load_incremental_state(models)
+		vehicles, state = analyze.update_incremental_vehicles(config, models, state)
+		if SAVE_INCREMENTAL_STATE:
+			analyze.save_incremental_state(state)
+		vehicles_by_model = analyze.split_by_model(vehicles, models)
+	vehicles = analyze.concat_vehicles([vehicles_by_model[model] for model in models])
+	return analyze.resolve_distances(vehicles, analyze.get_locations(config)), state
+
+def refresh(config):
+	global served
+	with refresh_lock:
+		start = time.time()
+		models = list(config['scrape_configs'].keys())
+		vehicles, state = load_vehicles(config, models, served['state'] if served is not None else None)
+		served = {
+			'vehicles': vehicles,
+			'state': state,
+			'loaded': datetime.datetime.now().isoformat(timespec='seconds'),
+			'refresh_s': round(time.time() - start, 3),
+			'refreshes': (served['refreshes'] if served is not None else 0) + 1,
+			'filtered': {},
+			'sorted_scores': {}
+		}
+		# sort plans memoize dealer fees by owner, drop them with the vehicles they were built for
+		with cache_lock:
+			sort_plans.clear()
+		print(f'serve: loaded {py_table.length(vehicles)} vehicles in {served["refresh_s"]}s')
+	return status()
+
+def status():
+	current = served
+	return {
+		'vehicles': py_table.length(current['vehicles']),
+		'loaded': current['loaded'],
+		'refresh_s': current['refresh_s'],
+		'refreshes': current['refreshes'],
+		'watermark': current['state']['watermark'] if current['state'] is not None else None,
+		'refresh_interval': REFRESH_INTERVAL
+	}
+
+# filtered vehicles of current (a served dict) by a selection_params filter, cached until the next refresh
+def _filtered(current, _filter):
+	key = _cache_key(_filter)
+	with cache_lock:
+		filtered = current['filtered'].get(key)
+	if filtered is None:
+		masks, selectivity = analyze.evaluate_filter_plan(current['vehicles'], analyze.compile_filter_plan({'filter': _filter}))
+		filtered = py_table.take(current['vehicles'], masks['filter'])
+		with cache_lock:
+			if len(current['filtered']) >= FILTER_CACHE_SIZE:
+				del current['filtered'][next(iter(current['filtered']))]
+			current['filtered'][key] = filtered
+	return filtered
+
+def _sort_plan(sort_config):
+	key = _cache_key(sort_config)
+	with cache_lock:
+		plan = sort_plans.get(key)
+	if plan is None:
+		plan = analyze.compile_sort_plan(sort_config)
+		with cache_lock:
+			if len(sort_plans) >= SORT_PLAN_CACHE_SIZE:
+				del sort_plans[next(iter(sort_plans))]
+			sort_plans[key] = plan
+	return plan
+
+# sorted scores of current's vehicles passing _filter for alltime_score_% (analyze.score_percentiles(...)), cached until the next refresh
+def _sorted_scores(current, _filter, sort_config, sort_plan):
+	key = (_cache_key(_filter), _cache_key(sort_config))
+	with cache_lock:
+		scores = current['sorted_scores'].get(key)
+	if scores is None:
+		scores = np.sort(analyze.score_vehicles(_filtered(current, _filter), sort_plan))
+		with cache_lock:
+			if len(current['sorted_scores']) >= SCORES_CACHE_SIZE:
+				del current['sorted_scores'][next(iter(current['sorted_scores']))]
+			current['sorted_scores'][key] = scores
+	return scores
+
+# non-negative int, json true / false are bools (ints in python) and rejected
+def _is_count(value):
+	return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def rank_request(request, selections_params, link_templates):
+	start = time.perf_counter()
+	params = {**selections_params, **request}
+	limit = params.get('limit', DEFAULT_LIMIT)
+	offset = params.get('offset', 0)
+	if (limit is not None and not _is_count(limit)) or not _is_count(offset):
+		raise ValueError(f'serve.rank_request: limit & offset must be non-negative integers: {limit}, {offset}')
+
+	current = served
+	sort_plan = _sort_plan(params['sort'])
+	for_csv = _filtered(current, params['filters_for_csv'])
+	sorted_scores = _sorted_scores(current, params.get('filters_for_plot', params['filters_for_csv']), params['sort'], sort_plan)
+	ranked_choices = analyze.rank_vehicles(for_csv, sort_plan, limit, offset)
+	rows = analyze.ranked_rows(sorted_scores, ranked_choices, link_templates, offset + 1)
+	return {
+		'total': py_table.length(for_csv),
+		'rows': rows,
+		'ms': round((time.perf_counter() - start)*1000, 2)
+	}
+
+def make_handler(config, selections_params):
+	link_templates = analyze.compile_link_templates(config['scrape_configs'])
+
+	class Handler(http.server.BaseHTTPRequestHandler):
+		def _respond(self, code, body):
+			data = json.dumps(body, default=str).encode()
+			self.send_response(code)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def do_GET(self):
+			if self.path == '/status':
+				self._respond(200, status())
+			else:
+				self._respond(404, {'error': f'unknown path: {self.path}'})
+
+		def do_POST(self):
+			length = int(self.headers.get('Content-Length') or 0)
+			if length > MAX_REQUEST_BYTES:
+				self._respond(413, {'error': f'request over {MAX_REQUEST_BYTES} bytes'})
+				return
+			try:
+				request = json.loads(self.rfile.read(length) or b'{}')
+				if self.path == '/rank':
+					if not isinstance(request, dict):
+						raise ValueError('serve: request must be a json object')
+					self._respond(200, rank_request(request, selections_params, link_templates))
+				elif self.path == '/refresh':
+					self._respond(200, refresh(config))
+				else:
+					self._respond(404, {'error': f'unknown path: {self.path}'})
+			except (ValueError, KeyError, TypeError) as error:
+				self._respond(400, {'error': repr(error)})
+			except Exception as error:
+				self._respond(500, {'error': repr(error)})
+
+		# client_address is empty on unix sockets
+		def log_message(self, format, *args):
+			if analyze.VERBOSE:
+				print(f'serve: {format % args}')
+	return Handler
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+def make_server(handler):
+	if SOCKET_PATH is None:
+		return http.server.ThreadingHTTPServer((HOST, PORT), handler)
+	if os.path.exists(SOCKET_PATH):
+		os.remove(SOCKET_PATH)
+	return UnixHTTPServer(SOCKET_PATH, handler)
+
+# refreshes every REFRESH_INTERVAL s or when refresh_event is set, a failed refresh keeps serving the previous vehicles
+def refresh_loop(config, stop):
+	while not stop.is_set():
+		refresh_event.wait(REFRESH_INTERVAL)
+		refresh_event.clear()
+		if stop.is_set():
+			break
+		try:
+			refresh(config)
+		except Exception as error:
+			print(f'serve: refresh failed, serving vehicles loaded {served["loaded"]}: {error!r}')
+
+def main():
+	config_public = json.load(open(analyze.CONFIG_PUBLIC_PATH))
+	config_secret = json.load(open(analyze.CONFIG_SECRET_PATH))
+	config = {**config_public, **config_secret}
+	selections_params = json.load(open(analyze.SELECTION_PATH))
+
+	refresh(config)
+	stop = threading.Event()
+	refresher = threading.Thread(target=refresh_loop, args=(config, stop), daemon=True)
+	refresher.start()
+	signal.signal(signal.SIGHUP, lambda signum, frame: refresh_event.set())
+
+	server = make_server(make_handler(config, selections_params))
+	print(f'serve: listening on {SOCKET_PATH or f"http://{HOST}:{PORT}"}, pid {os.getpid()}')
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		stop.set()
+		refresh_event.set()
+		server.server_close()
+		if SOCKET_PATH is not None and os.path.exists(SOCKET_PATH):
+			os.remove(SOCKET_PATH)
+
+if __name__ == '__main__':
+	main()
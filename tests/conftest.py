@@ -0,0 +1,71 @@
+'''
+Test setup
+- scripts/ & utils/ on the path, plots headless
+- listing_rows: synthetic DATA_QUERY rows, vehicles scraped from various sources over the weeks before REFERENCE_TIME
+- run from repo root: python -m pytest -q
+'''
+
+import sys, os
+import random
+import datetime
+import matplotlib
+import pytest
+
+matplotlib.use('Agg')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../utils/'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../scripts/'))
+
+REFERENCE_TIME = datetime.datetime(2026, 3, 2, 12).timestamp()
+DAY = 60*60*24
+SOURCES = ['auto_trader', 'autolist', 'cars_com', 'carvana', 'edmunds']
+MODELS = ['grand_cherokee', 'compass']
+
+# vehicles first seen up to days before REFERENCE_TIME, scraped every few hours to ~2 days until sold or REFERENCE_TIME
+# scrape times are whole seconds, vehicles are listed by a few sources at (mostly) different prices
+def make_listing_rows(n_vehicles=300, days=30, seed=0):
+	rng = random.Random(seed)
+	rows = []
+	for i in range(n_vehicles):
+		vehicle = {
+			'make': 'jeep',
+			'model': rng.choice(MODELS),
+			'version': rng.choice(['laredo', 'limited', 'trailhawk']),
+			'year': rng.randint(2014, 2021),
+			'drivetrain': '4wd',
+			'color': rng.choice(['black', 'white', 'gray', None]),
+			'estimated_value': rng.choice([None, rng.randint(15000, 40000)]),
+			'parsed_owner': None,
+			'distance': rng.randint(0, 900),
+			'score_adjustments': rng.choice([{}, {'manual': rng.randint(-5, 5)}]),
+			'sold': rng.random() < 0.05,
+			'vin': f'1J4TEST{i:010d}'
+		}
+		sources = rng.sample(SOURCES, rng.randint(1, 3))
+		source_discount = {source: rng.choice([0, 0, 250, 500]) for source in sources}
+		price = rng.randint(15000, 40000)
+		mileage = rng.randint(5000, 90000)
+		scrape_time = REFERENCE_TIME - rng.uniform(0, days)*DAY
+		last_scrape = min(REFERENCE_TIME, scrape_time + rng.uniform(0, days)*DAY)
+		while scrape_time <= last_scrape:
+			if rng.random() < 0.15:
+				price += rng.choice([-1000, -500, 500])
+			source = rng.choice(sources)
+			rows.append({
+				**vehicle,
+				'listing_id': None,
+				'scrape_time': datetime.datetime.fromtimestamp(int(scrape_time)),
+				'source': source,
+				'owner': rng.choice(['dealer a', 'dealer b', None]),
+				'zip': rng.randint(10000, 99999),
+				'mileage': mileage,
+				'price': price - source_discount[source],
+				'title': None,
+				'remote': rng.random() < 0.1
+			})
+			mileage += rng.randint(0, 30)
+			scrape_time += rng.uniform(0.1, 2)*DAY
+	return sorted(rows, key=lambda row: (row['scrape_time'], row['vin']))
+
+@pytest.fixture
+def listing_rows():
+	return make_listing_rows()
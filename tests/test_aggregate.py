@@ -0,0 +1,88 @@
+'''
+AGGREGATE_MODE parity: AGGREGATE_QUERY + aggregated_vehicles(...) must give the same vehicles as
+get_unique_vehicles(...) + augment_vehicles(...) over the same listings
+- needs a postgres database: CARS_TEST_DSN='host=... dbname=... user=...' python -m pytest -q, skipped without it
+- tables are created in the TEST_SCHEMA schema, dropped afterwards
+'''
+
+import os
+import datetime
+import json
+import psycopg2.extras
+import pytest
+
+import py_postgres
+import analyze
+from conftest import REFERENCE_TIME, MODELS
+
+TEST_SCHEMA = 'analyze_test'
+TABLES_DDL = f'''
+	drop schema if exists {TEST_SCHEMA} cascade;
+	create schema {TEST_SCHEMA};
+	create table {TEST_SCHEMA}.vehicles (
+		vin text primary key,
+		created_on timestamp default now(),
+		make text not null,
+		model text not null,
+		version text,
+		year integer not null,
+		model_validated_on timestamp,
+		drivetrain text,
+		color text,
+		estimated_value integer,
+		_owner text,
+		distance int,
+		score_adjustments jsonb default '{{}}'::jsonb,
+		sold boolean not null default false
+	);
+	create table {TEST_SCHEMA}.vehicle_listings (
+		id serial primary key,
+		created_on timestamp not null default now(),
+		vin text references {TEST_SCHEMA}.vehicles (vin),
+		source text not null,
+		owner text,
+		zip integer not null,
+		mileage integer not null,
+		price integer not null,
+		title text,
+		remote boolean default false,
+		unique (vin, created_on)
+	);
+'''
+VEHICLE_COLUMNS = ['vin', 'make', 'model', 'version', 'year', 'drivetrain', 'color', 'estimated_value', '_owner', 'distance', 'score_adjustments', 'sold']
+LISTING_COLUMNS = ['created_on', 'vin', 'source', 'owner', 'zip', 'mileage', 'price', 'title', 'remote']
+
+@pytest.fixture
+def loaded_rows(listing_rows):
+	dsn = os.environ.get('CARS_TEST_DSN')
+	if not dsn:
+		pytest.skip('CARS_TEST_DSN not set')
+	py_postgres.connect({'dsn': dsn, 'options': f'-c search_path={TEST_SCHEMA}'}, 'aggregate_test')
+	py_postgres.execute(TABLES_DDL, name='aggregate_test')
+
+	vehicles = {row['vin']: {**row, '_owner': row['parsed_owner'], 'score_adjustments': json.dumps(row['score_adjustments'])} for row in listing_rows}
+	with py_postgres.checkout('aggregate_test') as conn:
+		with conn.cursor() as cursor:
+			psycopg2.extras.execute_values(cursor, f'insert into vehicles ({", ".join(VEHICLE_COLUMNS)}) values %s', [[v[c] for c in VEHICLE_COLUMNS] for v in vehicles.values()])
+			psycopg2.extras.execute_values(cursor, f'insert into vehicle_listings ({", ".join(LISTING_COLUMNS)}) values %s', [[row['scrape_time'], *[row[c] for c in LISTING_COLUMNS[1:]]] for row in listing_rows])
+	yield listing_rows
+	py_postgres.execute(f'drop schema {TEST_SCHEMA} cascade', name='aggregate_test')
+	py_postgres.close('aggregate_test')
+
+# vehicle dicts by vin, without the listing histories: aggregated vehicles only hold their key listings
+def comparable(vehicles):
+	return {vehicle['vin']: {k: v for k, v in vehicle.items() if k != 'listings'} for vehicle in analyze.vehicle_dicts(vehicles)}
+
+def test_aggregate_query_matches_augment(loaded_rows):
+	active_since = REFERENCE_TIME - analyze.ACTIVE_PERIOD
+	aggregate_rows = py_postgres.query(
+		analyze.AGGREGATE_QUERY,
+		{'models': MODELS, 'active_period': analyze.ACTIVE_PERIOD, 'active_since': datetime.datetime.fromtimestamp(active_since)},
+		headers=analyze.AGGREGATE_QUERY_HEADERS,
+		name='aggregate_test'
+	)
+	aggregated = comparable(analyze.aggregated_vehicles(aggregate_rows, active_since))
+	full = comparable(analyze.augment_vehicles(analyze.get_unique_vehicles(analyze.prep_listings(loaded_rows)), REFERENCE_TIME))
+	assert aggregated.keys() == full.keys()
+	for vin in full:
+		assert aggregated[vin] == full[vin], vin
@@ -0,0 +1,104 @@
+'''
+INCREMENTAL_MODE parity: merging listings batch by batch into compacted vehicles (merge_new_listings(...) +
+compact_vehicles(...)) must give the same vehicles as augmenting all listings at once
+'''
+
+import numpy as np
+import pytest
+
+import py_table
+import analyze
+from conftest import REFERENCE_TIME, DAY, MODELS
+
+# batches of listings scraped up to each cut, as successive incremental runs would fetch them
+BATCH_CUTS = [REFERENCE_TIME - 20*DAY, REFERENCE_TIME - 9*DAY, REFERENCE_TIME - 3*DAY, REFERENCE_TIME - DAY/2, REFERENCE_TIME - DAY/8]
+
+def full_vehicles(rows):
+	return analyze.augment_vehicles(analyze.get_unique_vehicles(analyze.prep_listings(rows)), REFERENCE_TIME)
+
+def incremental_vehicles(rows, cuts, tail_period):
+	previous = None
+	vehicles = None
+	batch_start = 0
+	for cut in cuts + [None]:
+		batch_end = len(rows) if cut is None else next((i for i, row in enumerate(rows) if row['scrape_time'].timestamp() > cut), len(rows))
+		vehicles = analyze.merge_new_listings(previous, analyze.prep_listings(rows[batch_start:batch_end]), REFERENCE_TIME)
+		assert vehicles is not None
+		previous = analyze.compact_vehicles(vehicles, tail_period)
+		batch_start = batch_end
+	return vehicles
+
+# vehicle dicts by vin, without the (compacted) listing histories, with each ACTIVE_WINDOWS window's columns
+def comparable(vehicles):
+	sources = vehicles['_listings']['_categories']['source']
+	compared = {}
+	for i, vehicle in enumerate(analyze.vehicle_dicts(vehicles)):
+		compared[vehicle['vin']] = {k: v for k, v in vehicle.items() if k != 'listings'}
+		for name in analyze.ACTIVE_WINDOWS:
+			compared[vehicle['vin']][f'active_{name}'] = bool(vehicles[f'active_{name}'][i])
+			compared[vehicle['vin']][f'active_sources_{name}'] = sorted([source for code, source in enumerate(sources) if (int(vehicles[f'active_sources_{name}'][i]) >> code) & 1])
+	return compared
+
+def test_batches_match_full_augment(listing_rows):
+	full = comparable(full_vehicles(listing_rows))
+	incremental = comparable(incremental_vehicles(listing_rows, BATCH_CUTS, analyze.INCREMENTAL_TAIL_PERIOD))
+	assert incremental.keys() == full.keys()
+	for vin in full:
+		assert incremental[vin] == full[vin], vin
+
+def test_one_batch_matches_full_augment(listing_rows):
+	assert comparable(incremental_vehicles(listing_rows, [], analyze.INCREMENTAL_TAIL_PERIOD)) == comparable(full_vehicles(listing_rows))
+
+def test_compact_keeps_earliest_and_tail(listing_rows):
+	vehicles = full_vehicles(listing_rows)
+	compacted = analyze.compact_vehicles(vehicles, analyze.INCREMENTAL_TAIL_PERIOD)
+	assert py_table.length(compacted['_listings']) < py_table.length(vehicles['_listings'])
+	for f in ['earliest_listing', 'latest_listing']:
+		for field in ['scrape_time', 'price', 'source']:
+			np.testing.assert_array_equal(compacted['_listings'][field][compacted[f]], vehicles['_listings'][field][vehicles[f]])
+
+def test_out_of_order_listings_need_full_recompute(listing_rows):
+	cut = REFERENCE_TIME - 3*DAY
+	previous = analyze.compact_vehicles(full_vehicles([row for row in listing_rows if row['scrape_time'].timestamp() <= cut]), analyze.INCREMENTAL_TAIL_PERIOD)
+	late_rows = [row for row in listing_rows if row['scrape_time'].timestamp() > cut - DAY]
+	assert analyze.merge_new_listings(previous, analyze.prep_listings(late_rows), REFERENCE_TIME) is None
+
+def test_tail_period_shorter_than_a_window_is_rejected(monkeypatch):
+	monkeypatch.setattr(analyze, 'INCREMENTAL_TAIL_PERIOD', analyze.ACTIVE_PERIOD)
+	monkeypatch.setattr(analyze, 'ACTIVE_WINDOWS', {'3d': 3*DAY})
+	with pytest.raises(ValueError):
+		analyze.update_incremental_vehicles({}, ['grand_cherokee'], None)
+
+# py_postgres stand-in for update_incremental_vehicles(...), serving the rows with committed listing ids
+class FakeListingsDb:
+	def __init__(self, rows):
+		self.rows = [{**row, 'listing_id': i + 1} for i, row in enumerate(rows)]
+		self.committed = set()
+
+	def visible(self):
+		return [row for row in self.rows if row['listing_id'] in self.committed]
+
+	def query(self, query_str, data=None, headers=None, name='default'):
+		if query_str == analyze.LISTINGS_WATERMARK_QUERY:
+			return [[max(self.committed, default=0)]]
+		return list({row['vin']: {h: row[h] for h in headers} for row in self.visible()}.values())
+
+	def stream(self, query_str, data=None, headers=None, name='default', itersize=None):
+		return [row for row in self.visible() if data['after_id'] < row['listing_id'] <= data['up_to_id']]
+
+# ids are taken at insert, so a slow insert can commit after later ids are already past the watermark
+def test_listings_committed_below_the_watermark_are_merged(listing_rows, monkeypatch):
+	db = FakeListingsDb(listing_rows)
+	monkeypatch.setattr(analyze.py_postgres, 'connect', lambda *args, **kwargs: None)
+	monkeypatch.setattr(analyze.py_postgres, 'query', db.query)
+	monkeypatch.setattr(analyze.py_postgres, 'stream', db.stream)
+
+	late_ids = {len(listing_rows) - 20, len(listing_rows) - 19}
+	db.committed = set(range(1, len(listing_rows) - 10)) - late_ids
+	_, state = analyze.update_incremental_vehicles({'pg_config': {}}, MODELS, None)
+	assert state['watermark'] > max(late_ids)
+
+	db.committed = set(range(1, len(listing_rows) + 1))
+	vehicles, state = analyze.update_incremental_vehicles({'pg_config': {}}, MODELS, state)
+	assert late_ids <= state['merged_ids']
+	assert comparable(vehicles) == comparable(analyze.augment_vehicles(analyze.get_unique_vehicles(analyze.prep_listings(listing_rows))))
@@ -0,0 +1,40 @@
+'''
+plot data parity: the array plot inputs must place points where the old per-vehicle dict plots did
+'''
+
+import time
+import datetime
+import numpy as np
+import matplotlib.dates as mdates
+import pytest
+
+import analyze
+from conftest import DAY
+
+# a zone with a daylight saving change (2026-03-08) inside the shifted listings' time range
+@pytest.fixture
+def dst_timezone(monkeypatch):
+	monkeypatch.setenv('TZ', 'America/New_York')
+	time.tzset()
+	yield
+	monkeypatch.undo()
+	time.tzset()
+
+# old plot: per vehicle (most recently seen first) the listing datetimes of vehicle_dicts(...)
+def test_price_history_x_matches_vehicle_dict_times(listing_rows, dst_timezone):
+	rows = [{**row, 'scrape_time': datetime.datetime.fromtimestamp(row['scrape_time'].timestamp() + 10*DAY)} for row in listing_rows]
+	vehicles = analyze.augment_vehicles(analyze.get_unique_vehicles(analyze.prep_listings(rows)))
+	lines = analyze._price_history_lines(vehicles)
+
+	vehicle_dicts = sorted(analyze.vehicle_dicts(vehicles), key=lambda vehicle: -vehicle['latest_listing']['scrape_time'].timestamp())
+	old_x = mdates.date2num([listing['scrape_time'] for vehicle in vehicle_dicts for listing in vehicle['listings']])
+	np.testing.assert_array_equal(lines['series_lengths'], [len(vehicle['listings']) for vehicle in vehicle_dicts])
+	np.testing.assert_allclose(lines['x'], old_x, rtol=0, atol=1e-9)
+
+def test_price_history_plot_is_optional(listing_rows, monkeypatch):
+	vehicles = analyze.augment_vehicles(analyze.get_unique_vehicles(analyze.prep_listings(listing_rows)))
+	plot_data = {'models': {}, 'all': {'all_vehicles': vehicles}, 'filtered_for_csv': vehicles, 'filtered_for_plot': analyze.score_listings(vehicles, analyze.compile_sort_plan({}))}
+	monkeypatch.setattr(analyze, 'PLOT_PRICE_HISTORY', False)
+	assert 'price history' not in [kwargs['title'] for _, kwargs in analyze.plot_jobs(plot_data, {'chosen_vin': ''})]
+	monkeypatch.setattr(analyze, 'PLOT_PRICE_HISTORY', True)
+	assert 'price history' in [kwargs['title'] for _, kwargs in analyze.plot_jobs(plot_data, {'chosen_vin': ''})]
@@ -0,0 +1,30 @@
+'''
+rank_vehicles(...) pages must match the full sort: sort_listings(...)[offset:offset + limit]
+'''
+
+import json
+import numpy as np
+import pytest
+
+import analyze
+from conftest import REFERENCE_TIME
+
+@pytest.fixture
+def vehicles(listing_rows):
+	return analyze.augment_vehicles(analyze.get_unique_vehicles(analyze.prep_listings(listing_rows)), REFERENCE_TIME)
+
+@pytest.fixture
+def sort_plan():
+	return analyze.compile_sort_plan(json.load(open(analyze.SELECTION_PATH))['sort'])
+
+@pytest.mark.parametrize('limit, offset, chunk_size', [(None, 0, 1000), (10, 0, 1000), (10, 25, 64), (1, 0, 7), (500, 0, 64), (5, 1000, 64)])
+def test_pages_match_full_sort(vehicles, sort_plan, limit, offset, chunk_size):
+	ranked = analyze.rank_vehicles(vehicles, sort_plan, limit, offset, chunk_size)
+	expected = analyze.sort_listings(vehicles, sort_plan)
+	end = None if limit is None else offset + limit
+	np.testing.assert_array_equal(ranked['vin'], expected['vin'][offset:end])
+	np.testing.assert_array_equal(ranked['score'], expected['score'][offset:end])
+
+@pytest.mark.parametrize('offset', [0, 10])
+def test_limit_0_ranks_nothing(vehicles, sort_plan, offset):
+	assert len(analyze.rank_vehicles(vehicles, sort_plan, 0, offset, 64)['vin']) == 0
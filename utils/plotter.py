@@ -1,9 +1,16 @@
 ## plotting interface
+# batch mode: render_batch(...) renders (plot function, kwargs) jobs headless (Agg) in worker processes
+# x/y/color data can be passed as arrays to grid_scatter(...) instead of per-element funcs
 
 import os
+import math
+import concurrent.futures
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import matplotlib.colors as mcolors
+import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
 from matplotlib.ticker import FuncFormatter, MultipleLocator
 from matplotlib.axis import Axis 
 
@@ -12,8 +19,17 @@ import py_utils
 SINGLE_FIGURE_SIZE = (8, 5)
 DOUBLE_FIGURE_SIZE = (14, 5)
 PADDING_COEF = 0.1
+GRID_PANEL_SIZE = (5, 4)
+GRID_COLUMNS = 4
 RESULTS_DIR = 'results'
 
+# headless: figures are saved & closed instead of shown, set by render_batch(...)
+HEADLESS = False
+BATCH_WORKERS = None # None: one worker per figure up to the cpu count, 1: render in this process
+
+# line plots: all series are drawn as one LineCollection, capped at about MAX_LINE_VERTICES vertices
+MAX_LINE_VERTICES = 200000
+
 DEFAULT_SIZE = None
 DEFAULT_MARKER = None
 DEFAULT_COLORMAP = 'winter_r'
@@ -29,6 +45,14 @@ def _save_figure(fig, title):
 		os.makedirs(RESULTS_DIR)
 	filepath = f'{RESULTS_DIR}/{title.replace(" ", "_").replace(":", "")}.png'
 	fig.savefig(filepath)
+	return filepath
+
+# blocking show unless headless
+def _show(fig):
+	if HEADLESS:
+		plt.close(fig)
+	else:
+		plt.show()
 
 def _create_legend(ax, legend_entries):
 	handles = []
@@ -83,24 +107,14 @@ def _format_axis(ax, axis, format_params):
 	if 'tick_format_func' in format_params:
 		axis_ref.set_major_formatter(FuncFormatter(format_params['tick_format_func']))
 
-def _format_series(ax, line, format_params):
-
-	# markers
-	if 'marker_style' in format_params:
-		line.set_marker(format_params['marker_style'])
-	if 'first_marker_style' in format_params:
-		ax.scatter(line.get_xdata()[0], line.get_ydata()[0], c=format_params['first_marker_style']['color'], marker=format_params['first_marker_style']['style'], zorder=4)
-	if 'last_marker_style' in format_params:
-		ax.scatter(line.get_xdata()[-1], line.get_ydata()[-1], c=format_params['last_marker_style']['color'], marker=format_params['last_marker_style']['style'], zorder=4)
-
 def _calc_axis_lims(data):
-	_min = min(data)
-	_max = max(data)
+	_min = np.min(data)
+	_max = np.max(data)
 	padding = PADDING_COEF*(_max - _min)
 	return [_min - padding, _max + padding]
 
 def _create_colorbar(fig, axes, colormap, color_data, color_axis_format):
-	norm = mcolors.Normalize(vmin=min(color_data), vmax=max(color_data))
+	norm = mcolors.Normalize(vmin=np.min(color_data), vmax=np.max(color_data))
 	cbar_ax = fig.add_axes([0.85, 0.15, 0.05, 0.7])
 	cbar = fig.colorbar(plt.cm.ScalarMappable(cmap=colormap, norm=norm), cax=cbar_ax)
 	_format_axis(cbar.ax, 'color', color_axis_format)
@@ -117,8 +131,34 @@ def _make_scatter(
 	_x = [x_func(v) for v in data]
 	_y = [y_func(v) for v in data]
 	_c = [color_func(v) for v in data]
-	
-	ax.scatter(_x, _y, s=size, c=_c, marker=marker, cmap=colormap)
+	_make_array_scatter(
+		fig, ax,
+		_x, _y, _c,
+		title, legend_entries,
+		size, marker, colormap,
+		x_axis_format, y_axis_format, color_axis_format
+	)
+
+def _make_array_scatter(
+	fig, ax,
+	_x, _y, _c,
+	title, legend_entries,
+	size, marker, colormap,
+	x_axis_format, y_axis_format, color_axis_format
+):
+	_c = np.asarray(_c)
+	if _c.dtype.kind in 'UO' and len(_c):
+		# named colors: one marker line per color, much faster to render than a per-point PathCollection
+		# smaller groups are drawn last so rare colors (e.g. chosen) stay on top
+		_x = np.asarray(_x)
+		_y = np.asarray(_y)
+		colors, counts = np.unique(_c, return_counts=True)
+		markersize = math.sqrt(size) if size is not None else None
+		for color in colors[np.argsort(-counts, kind='stable')]:
+			in_color = _c == color
+			ax.plot(_x[in_color], _y[in_color], linestyle='none', marker=marker or 'o', markersize=markersize, color=color)
+	else:
+		ax.scatter(_x, _y, s=size, c=_c, marker=marker, cmap=colormap)
 
 	# colorbar
 	if color_axis_format:
@@ -144,17 +184,87 @@ def _make_line_plot(
 	x_func, y_func, 
 	title, legend_entries,
 	size, marker,
-	plot_order_func, x_axis_format, y_axis_format, series_format
+	plot_order_func, x_axis_format, y_axis_format, series_format,
+	decimate=False, max_vertices=MAX_LINE_VERTICES
 ):
+	_x = []
+	_y = []
+	series_lengths = []
 	for d in sorted(data, key=plot_order_func):
-		_x = x_func(d)
-		_y = y_func(d)
-
-		lines = ax.plot(_x, _y)
+		series_x = x_func(d)
+		_x += series_x
+		_y += y_func(d)
+		series_lengths.append(len(series_x))
+	if len(_x) and hasattr(_x[0], 'timestamp'):
+		_x = mdates.date2num(_x)
+
+	_make_line_collection(
+		ax,
+		_x, _y, series_lengths,
+		title, legend_entries,
+		x_axis_format, y_axis_format, series_format,
+		decimate, max_vertices
+	)
 
-		if series_format is not None:
-			for l in lines:
-				_format_series(ax, l, series_format)
+# per series start, end offsets into the flattened x, y arrays
+def _series_bounds(series_lengths):
+	ends = np.cumsum(series_lengths, dtype=np.int64)
+	return ends - series_lengths, ends
+
+# keep first, last and change points of each series: a vertex equal to both its neighbours lies on a flat run
+def _decimate_mask(_y, starts, ends):
+	keep = np.ones(len(_y), dtype=bool)
+	if len(_y) > 2:
+		keep[1:-1] = (_y[1:-1] != _y[:-2]) | (_y[1:-1] != _y[2:])
+	non_empty = ends > starts
+	keep[starts[non_empty]] = True
+	keep[ends[non_empty] - 1] = True
+	return keep
+
+# thin kept vertices to about max_vertices by keeping every nth vertex of each series, series ends are always kept
+def _cap_mask(keep, starts, ends, max_vertices):
+	kept = np.flatnonzero(keep)
+	if max_vertices is None or len(kept) <= max_vertices:
+		return keep
+	stride = math.ceil(len(kept)/max_vertices)
+	kept_series = np.searchsorted(ends, kept, side='right')
+	kept_starts = np.searchsorted(kept_series, np.arange(len(starts)))
+	rank = np.arange(len(kept)) - kept_starts[kept_series]
+	is_last = np.append(kept_series[1:] != kept_series[:-1], True)
+	capped = np.zeros_like(keep)
+	capped[kept[(rank % stride == 0) | is_last]] = True
+	return capped
+
+# all series in one LineCollection instead of an ax.plot(...) call per series
+# series i is the next series_lengths[i] values of _x, _y
+def _make_line_collection(
+	ax,
+	_x, _y, series_lengths,
+	title, legend_entries,
+	x_axis_format, y_axis_format, series_format,
+	decimate=False, max_vertices=MAX_LINE_VERTICES
+):
+	_x = np.asarray(_x, dtype=float)
+	_y = np.asarray(_y, dtype=float)
+	series_lengths = np.asarray(series_lengths, dtype=np.int64)
+	starts, ends = _series_bounds(series_lengths)
+
+	keep = _decimate_mask(_y, starts, ends) if decimate else np.ones(len(_y), dtype=bool)
+	keep = _cap_mask(keep, starts, ends, max_vertices)
+	kept_count = np.concatenate([[0], np.cumsum(keep)])
+	kept_lengths = kept_count[ends] - kept_count[starts]
+	points = np.column_stack([_x[keep], _y[keep]])
+	kept_starts, kept_ends = _series_bounds(kept_lengths)
+	segments = np.split(points, kept_ends[:-1])
+
+	# same color cycle as one ax.plot(...) per series
+	cycle_colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+	colors = [cycle_colors[i % len(cycle_colors)] for i in range(len(segments))]
+	ax.add_collection(LineCollection(segments, colors=colors))
+	ax.autoscale_view()
+
+	if series_format is not None:
+		_format_series(ax, points, kept_starts, kept_ends, colors, series_format)
 
 	ax.set_title(title)
 	if legend_entries:
@@ -166,6 +276,18 @@ def _make_line_plot(
 	if y_axis_format:
 		_format_axis(ax, 'y', y_axis_format)
 
+# series markers for a whole line collection, one artist per marker style
+def _format_series(ax, points, starts, ends, colors, format_params):
+	non_empty = ends > starts
+	if 'marker_style' in format_params:
+		ax.scatter(points[:, 0], points[:, 1], c=np.repeat(colors, ends - starts), marker=format_params['marker_style'])
+	if 'first_marker_style' in format_params:
+		first = points[starts[non_empty]]
+		ax.scatter(first[:, 0], first[:, 1], c=format_params['first_marker_style']['color'], marker=format_params['first_marker_style']['style'], zorder=4)
+	if 'last_marker_style' in format_params:
+		last = points[ends[non_empty] - 1]
+		ax.scatter(last[:, 0], last[:, 1], c=format_params['last_marker_style']['color'], marker=format_params['last_marker_style']['style'], zorder=4)
+
 def _make_hist(
 	data,
 	ax,
@@ -204,7 +326,7 @@ def single_scatter(
 		x_axis_format=x_axis_format, y_axis_format=y_axis_format, color_axis_format=color_axis_format
 	)
 	_save_figure(fig, title)
-	plt.show()
+	_show(fig)
 
 # if color_axis_format is specified, will add colorbar
 def double_scatter(
@@ -248,7 +370,7 @@ def double_scatter(
 
 	fig.suptitle(title)
 	_save_figure(fig, title)
-	plt.show()
+	_show(fig)
 
 # optional params handled by generic methods:
 	# legend_entries: _create_legend(...)
@@ -259,7 +381,8 @@ def single_line_plot(
 	x_func, y_func, 
 	title, legend_entries=None,
 	size=DEFAULT_SIZE, marker=DEFAULT_MARKER,
-	plot_order_func=None, x_axis_format={}, y_axis_format={}, series_format={}
+	plot_order_func=None, x_axis_format={}, y_axis_format={}, series_format={},
+	decimate=False, max_vertices=MAX_LINE_VERTICES
 ):
 	fig, ax = plt.subplots(figsize=SINGLE_FIGURE_SIZE)
 	_format_figure(False)
@@ -269,10 +392,32 @@ def single_line_plot(
 		x_func, y_func,
 		title, legend_entries=legend_entries,
 		size=size, marker=marker,
-		plot_order_func=plot_order_func, x_axis_format=x_axis_format, y_axis_format=y_axis_format, series_format=series_format
+		plot_order_func=plot_order_func, x_axis_format=x_axis_format, y_axis_format=y_axis_format, series_format=series_format,
+		decimate=decimate, max_vertices=max_vertices
 	)
 	_save_figure(fig, title)
-	plt.show()
+	_show(fig)
+
+# single_line_plot(...) from arrays, series i is the next series_lengths[i] values of x, y (e.g. matplotlib date numbers, prices)
+# decimate: only plot the change points of each series
+def array_line_plot(
+	x, y, series_lengths,
+	title, legend_entries=None,
+	x_axis_format={}, y_axis_format={}, series_format={},
+	decimate=False, max_vertices=MAX_LINE_VERTICES
+):
+	fig, ax = plt.subplots(figsize=SINGLE_FIGURE_SIZE)
+	_format_figure(False)
+	_make_line_collection(
+		ax,
+		x, y, series_lengths,
+		title, legend_entries,
+		x_axis_format, y_axis_format, series_format,
+		decimate, max_vertices
+	)
+	filepath = _save_figure(fig, title)
+	_show(fig)
+	return filepath
 
 def single_histogram(
 	data, x_func,
@@ -289,4 +434,73 @@ def single_histogram(
 		x_axis_format
 	)
 	_save_figure(fig, title)
-	plt.show()
\ No newline at end of file
+	_show(fig)
+
+def _grid_figure_size(nrows, ncols):
+	if nrows == 1 and ncols == 1:
+		return SINGLE_FIGURE_SIZE
+	if nrows == 1 and ncols == 2:
+		return DOUBLE_FIGURE_SIZE
+	return (GRID_PANEL_SIZE[0]*ncols, GRID_PANEL_SIZE[1]*nrows)
+
+# small multiples: one scatter per panel, panels share axis limits and the colorbar
+# panels: [{'label': str, 'x': array, 'y': array, 'color': array}]
+# if color_axis_format is specified, will add colorbar
+def grid_scatter(
+	panels,
+	title, legend_entries=None,
+	size=DEFAULT_SIZE, marker=DEFAULT_MARKER, colormap=DEFAULT_COLORMAP,
+	x_axis_format={}, y_axis_format={}, color_axis_format=None,
+	ncols=GRID_COLUMNS
+):
+	ncols = max(1, min(ncols, len(panels)))
+	nrows = max(1, math.ceil(len(panels)/ncols))
+	all_x_data = np.concatenate([np.asarray(p['x'], dtype=float) for p in panels]) if len(panels) else np.array([])
+	all_y_data = np.concatenate([np.asarray(p['y'], dtype=float) for p in panels]) if len(panels) else np.array([])
+
+	x_axis_format = {**x_axis_format, **({'limits': _calc_axis_lims(all_x_data)} if len(all_x_data) else {})}
+	y_axis_format = {**y_axis_format, **({'limits': _calc_axis_lims(all_y_data)} if len(all_y_data) else {})}
+
+	fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=_grid_figure_size(nrows, ncols), squeeze=False)
+	_format_figure(color_axis_format is not None)
+
+	# do not let _make_array_scatter(...) add colorbar to individual plots, add here once to figure
+	for ax, panel in zip(axes.flat, panels):
+		_make_array_scatter(
+			fig, ax,
+			panel['x'], panel['y'], panel['color'],
+			panel['label'], legend_entries,
+			size, marker, colormap,
+			x_axis_format, y_axis_format, None
+		)
+	for ax in axes.flat[len(panels):]:
+		ax.set_visible(False)
+
+	if color_axis_format and len(panels):
+		_create_colorbar(fig, axes, colormap, np.concatenate([p['color'] for p in panels]), color_axis_format)
+
+	if len(panels) > 1:
+		fig.suptitle(title)
+	filepath = _save_figure(fig, title)
+	_show(fig)
+	return filepath
+
+def _set_headless():
+	global HEADLESS
+	HEADLESS = True
+	plt.switch_backend('Agg')
+
+def _render_job(job):
+	plot_func, kwargs = job
+	return plot_func(**kwargs)
+
+# render jobs [(plot function, kwargs)] headless, in worker processes if workers > 1
+# kwargs must be picklable: pass arrays and module level functions, not lambdas
+# returns each job's result (saved filepath for grid_scatter(...)) in jobs order
+def render_batch(jobs, workers=BATCH_WORKERS):
+	workers = min(len(jobs), workers or os.cpu_count())
+	if workers <= 1:
+		_set_headless()
+		return [_render_job(job) for job in jobs]
+	with concurrent.futures.ProcessPoolExecutor(workers, initializer=_set_headless) as executor:
+		return list(executor.map(_render_job, jobs))
@@ -0,0 +1,47 @@
+'''
+Python geo util
+- zip code coordinates & distances, vectorized over numpy arrays of zips
+- coordinates are a {'zip', 'latitude', 'longitude'} table of arrays sorted by zip, loaded from a zip,latitude,longitude csv
+- distances are computed as the zipcodes package's zipcodes.distance(...): spherical law of cosines, miles, rounded half up
+'''
+
+import csv
+import numpy as np
+
+EARTH_RADIUS_MILES = 3958.56540656
+
+# non numeric zips (e.g. canadian postal codes) are skipped
+def load_zip_coords(path):
+    rows = []
+    with open(path, newline='') as coords_file:
+        for row in csv.DictReader(coords_file):
+            if row['zip'].isdigit():
+                rows.append((int(row['zip']), float(row['latitude']), float(row['longitude'])))
+    rows.sort()
+    return {
+        'zip': np.array([r[0] for r in rows], dtype=np.int64),
+        'latitude': np.array([r[1] for r in rows], dtype=np.float64),
+        'longitude': np.array([r[2] for r in rows], dtype=np.float64)
+    }
+
+# position of each zip in coords, -1 for unknown zips
+def lookup(coords, zips):
+    zips = np.asarray(zips, dtype=np.int64)
+    if len(coords['zip']) == 0:
+        return np.full(len(zips), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(coords['zip'], zips), len(coords['zip']) - 1)
+    return np.where(coords['zip'][positions] == zips, positions, -1)
+
+# distance in miles from origin_zip to each coords row
+def distances_from(coords, origin_zip):
+    origin = lookup(coords, [origin_zip])[0]
+    if origin < 0:
+        raise ValueError(f'py_geo.distances_from: unknown origin zip: {origin_zip}')
+    latitude = np.radians(coords['latitude'])
+    cos_angle = np.sin(latitude[origin])*np.sin(latitude) + np.cos(latitude[origin])*np.cos(latitude)*np.cos(np.radians(coords['longitude'][origin] - coords['longitude']))
+    return np.floor(np.arccos(np.clip(cos_angle, -1, 1))*EARTH_RADIUS_MILES + 0.5)
+
+# distance in miles from the origin of distances (a distances_from(...) result) to each zip, nan for unknown zips
+def zip_distances(coords, distances, zips):
+    positions = lookup(coords, zips)
+    return np.where(positions >= 0, distances[positions], np.nan)
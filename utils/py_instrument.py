@@ -0,0 +1,207 @@
+'''
+Python instrumentation util
+- records wall time, cpu time, rows in/out and peak rss of named stages into a json serializable run report
+- stages nest, a stage's peak covers its child stages, stages outside a run are no-ops
+- optional per stage cProfile (top level stages only, profilers can't nest) & tracemalloc peak of python allocations
+- events(...) are for frequent calls like queries: timed & counted without nesting
+'''
+
+import sys
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import resource
+import datetime
+import tracemalloc
+import contextlib
+
+PROFILE_TOP_FUNCTIONS = 20 # functions by cumulative time kept in the report per profiled stage
+MAXRSS_KB = 1/1024 if sys.platform == 'darwin' else 1 # ru_maxrss is in bytes on macos, kB elsewhere
+
+run = None
+
+# peak rss since the last _reset_peak_rss(), linux resets the high water mark through clear_refs
+# elsewhere ru_maxrss is the process lifetime peak
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+# VmRSS (current) or VmHWM (peak) in kB, without /proc the peak is ru_maxrss & the current rss is unknown: None
+def _rss_kb(field):
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if field == 'VmHWM':
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*MAXRSS_KB
+    return None
+
+def current_rss_mb():
+    rss_kb = _rss_kb('VmRSS')
+    return rss_kb/1024 if rss_kb is not None else None
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def start_run(name, meta=None, profile=False, trace_memory=False):
+    global run
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    run = {
+        'name': name,
+        'meta': meta or {},
+        'profile': profile,
+        'trace_memory': trace_memory,
+        'started': datetime.datetime.now().isoformat(timespec='seconds'),
+        'start_wall': time.perf_counter(),
+        'start_cpu': time.process_time(),
+        'start_children_cpu': _children_cpu(),
+        'stages': [],
+        'events': {},
+        'stack': [],
+        'profiles': {}
+    }
+    _reset_peak_rss()
+    return run
+
+def is_running():
+    return run is not None
+
+# the record yielded is the stage's report entry, set record['rows_out'] (or any other field) inside the block
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    if run is None:
+        yield {}
+        return
+
+    # fold the high water marks so far into the enclosing stages before resetting them for this one
+    stack = run['stack']
+    rss_kb = _rss_kb('VmHWM')
+    traced = tracemalloc.get_traced_memory()[1] if run['trace_memory'] else 0
+    for frame in stack:
+        frame['peak_rss_kb'] = max(frame['peak_rss_kb'], rss_kb)
+        frame['peak_traced'] = max(frame['peak_traced'], traced)
+    _reset_peak_rss()
+    if run['trace_memory']:
+        tracemalloc.reset_peak()
+
+    record = {'name': name, 'depth': len(stack), 'rows_in': rows_in, 'rows_out': None}
+    if len(stack):
+        record['parent'] = stack[-1]['record']['name']
+    run['stages'].append(record)
+    frame = {'record': record, 'peak_rss_kb': 0, 'peak_traced': 0}
+    stack.append(frame)
+
+    profiler = None
+    if run['profile'] and len(stack) == 1:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start_rss_kb = _rss_kb('VmRSS')
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    start_children_cpu = _children_cpu()
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = repr(error)
+        raise
+    finally:
+        record['wall_s'] = time.perf_counter() - start_wall
+        record['cpu_s'] = time.process_time() - start_cpu
+        record['children_cpu_s'] = _children_cpu() - start_children_cpu
+        if profiler is not None:
+            profiler.disable()
+            run['profiles'][name] = profiler
+            record['profile'] = _profile_summary(profiler)
+
+        stack.pop()
+        frame['peak_rss_kb'] = max(frame['peak_rss_kb'], _rss_kb('VmHWM'))
+        record['start_rss_mb'] = start_rss_kb/1024 if start_rss_kb is not None else None
+        record['peak_rss_mb'] = frame['peak_rss_kb']/1024
+        if run['trace_memory']:
+            frame['peak_traced'] = max(frame['peak_traced'], tracemalloc.get_traced_memory()[1])
+            record['peak_traced_mb'] = frame['peak_traced']/2**20
+        if len(stack):
+            stack[-1]['peak_rss_kb'] = max(stack[-1]['peak_rss_kb'], frame['peak_rss_kb'])
+            stack[-1]['peak_traced'] = max(stack[-1]['peak_traced'], frame['peak_traced'])
+
+def _profile_summary(profiler):
+    stats = pstats.Stats(profiler, stream=io.StringIO()).sort_stats('cumulative')
+    summary = []
+    for function in stats.fcn_list[:PROFILE_TOP_FUNCTIONS]:
+        primitive_calls, calls, total_time, cumulative_time, callers = stats.stats[function]
+        summary.append({
+            'function': f'{function[0]}:{function[1]}({function[2]})',
+            'calls': calls,
+            'tottime_s': total_time,
+            'cumtime_s': cumulative_time
+        })
+    return summary
+
+# count & time a frequent call under name, e.g. each py_postgres.query(...)
+def event(name, seconds, rows=None):
+    if run is None:
+        return
+    totals = run['events'].setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'max_seconds': 0.0})
+    totals['calls'] += 1
+    totals['seconds'] += seconds
+    totals['max_seconds'] = max(totals['max_seconds'], seconds)
+    if rows is not None:
+        totals['rows'] += rows
+
+def finish_run():
+    global run
+    if run is None:
+        raise ValueError('py_instrument.finish_run: no run started')
+    finished, run = run, None
+    report = {
+        'name': finished['name'],
+        'started': finished['started'],
+        'meta': finished['meta'],
+        'wall_s': time.perf_counter() - finished['start_wall'],
+        'cpu_s': time.process_time() - finished['start_cpu'],
+        'children_cpu_s': _children_cpu() - finished['start_children_cpu'],
+        'peak_rss_mb': max([s['peak_rss_mb'] for s in finished['stages'] if 'peak_rss_mb' in s] + [_rss_kb('VmHWM')/1024]),
+        'stages': finished['stages'],
+        'events': finished['events']
+    }
+    if finished['trace_memory']:
+        tracemalloc.stop()
+    report['_profiles'] = finished['profiles']
+    return report
+
+# writes report as json, profiled stages are also saved as {name}.{stage}.prof next to it for snakeviz / pstats
+def save(report, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    base = os.path.splitext(path)[0]
+    for stage_name, profiler in report.get('_profiles', {}).items():
+        profiler.dump_stats(f'{base}.{stage_name}.prof')
+    with open(path, 'w') as report_file:
+        json.dump({k: v for k, v in report.items() if not k.startswith('_')}, report_file, indent=2, default=str)
+
+# keep the keep most recent files in directory with the given extension, returns the removed paths
+def prune(directory, keep, extension='.json'):
+    if not os.path.exists(directory):
+        return []
+    paths = sorted([os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(extension)], key=os.path.getmtime, reverse=True)
+    removed = []
+    for path in paths[keep:]:
+        base = os.path.splitext(path)[0]
+        for f in os.listdir(directory):
+            related = os.path.join(directory, f)
+            if related == path or (related.startswith(f'{base}.') and related.endswith('.prof')):
+                os.remove(related)
+                removed.append(related)
+    return removed
@@ -1,31 +1,161 @@
 '''
 Python Postgres util
+- named connection pools, connections are checked out per query and returned after
+- pools are per process: a forked worker opens its own pool on first use
+- query, execute & stream calls are counted & timed as py_instrument events when a run is active
 '''
 
+import os
+import time
+import itertools
+import contextlib
 import psycopg2
+import psycopg2.pool
 
-conns = {}
+import py_instrument
 
-def connect(config, name='default'):
+DEFAULT_ITERSIZE = 2000 # rows per server-side cursor round-trip
+DEFAULT_MIN_CONNS = 1
+DEFAULT_MAX_CONNS = 4
+
+# errors after which a connection is dropped and the query retried once on a fresh one
+RECONNECT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+pools = {}
+stream_ids = itertools.count()
+
+def connect(config, name='default', min_conns=DEFAULT_MIN_CONNS, max_conns=DEFAULT_MAX_CONNS):
+    if name in pools and pools[name]['pid'] == os.getpid():
+        if pools[name]['config'] == config and pools[name]['min_conns'] == min_conns and pools[name]['max_conns'] == max_conns:
+            return
+        close(name)
     try:
-        conn_inst = psycopg2.connect(**config)
-        conns[name] = conn_inst.cursor()
+        pool = psycopg2.pool.ThreadedConnectionPool(min_conns, max_conns, **config)
     except Exception as error:
         raise RuntimeError(f'Postgres util: connection error: {error}')
+    pools[name] = {
+        'pool': pool,
+        'config': config,
+        'min_conns': min_conns,
+        'max_conns': max_conns,
+        'pid': os.getpid()
+    }
 
+def close(name=None):
+    names = list(pools.keys()) if name is None else [name]
+    for n in names:
+        if n in pools:
+            # connections inherited from a parent process belong to the parent, just drop them
+            if pools[n]['pid'] == os.getpid():
+                pools[n]['pool'].closeall()
+            del pools[n]
 
-def query(query_str, data=None, headers=None, name='default'):
-    if name not in conns:
+def _get_pool(name):
+    if name not in pools:
         raise ValueError(f'Postgres util: haven\'t yet setup connection: {name}')
+    if pools[name]['pid'] != os.getpid():
+        inherited = pools.pop(name)
+        connect(inherited['config'], name, inherited['min_conns'], inherited['max_conns'])
+    return pools[name]['pool']
+
+# checkout a connection, committed and returned to the pool on exit, rolled back on error
+# closed (dropped) connections are discarded instead of being returned
+@contextlib.contextmanager
+def checkout(name='default'):
+    pool = _get_pool(name)
     try:
-        conns[name].execute(query_str, data)
-        raw_results = conns[name].fetchall()
+        conn = pool.getconn()
+        if conn.closed:
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
     except Exception as error:
-        raise RuntimeError(f'Postgres util: query error: {error}')
+        raise RuntimeError(f'Postgres util: connection error: {error}')
+
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+def query(query_str, data=None, headers=None, name='default'):
+    start = time.perf_counter()
+    attempts = 2
+    for attempt in range(attempts):
+        try:
+            with checkout(name) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query_str, data)
+                    raw_results = cursor.fetchall()
+            break
+        except RECONNECT_ERRORS as error:
+            if attempt == attempts - 1:
+                raise RuntimeError(f'Postgres util: query error: {error}')
+        except RuntimeError:
+            raise
+        except Exception as error:
+            raise RuntimeError(f'Postgres util: query error: {error}')
 
     if headers is not None:
         results = [dict(zip(headers, row)) for row in raw_results]
     else:
         results = raw_results
 
+    py_instrument.event('py_postgres.query', time.perf_counter() - start, len(results))
     return results
+
+# for statements without results (ddl, refreshes, bulk inserts), returns the affected row count
+def execute(query_str, data=None, name='default'):
+    start = time.perf_counter()
+    try:
+        with checkout(name) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query_str, data)
+                rowcount = cursor.rowcount
+        py_instrument.event('py_postgres.execute', time.perf_counter() - start, max(rowcount, 0))
+        return rowcount
+    except RuntimeError:
+        raise
+    except Exception as error:
+        raise RuntimeError(f'Postgres util: query error: {error}')
+
+# streams results through a named server-side cursor instead of fetching everything at once
+# yields rows, or lists of up to itersize rows if batches
+# the connection stays checked out until the generator is exhausted or closed
+# the instrumented time only covers executing & fetching, not the consumer's work between batches
+def stream(query_str, data=None, headers=None, name='default', itersize=DEFAULT_ITERSIZE, batches=False):
+    fetch_time = 0.0
+    rows = 0
+    with checkout(name) as conn:
+        start = time.perf_counter()
+        try:
+            cursor = conn.cursor(name=f'{name}_stream_{next(stream_ids)}')
+            cursor.itersize = itersize
+            cursor.execute(query_str, data)
+        except Exception as error:
+            raise RuntimeError(f'Postgres util: query error: {error}')
+        fetch_time += time.perf_counter() - start
+
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    raw_batch = cursor.fetchmany(itersize)
+                except Exception as error:
+                    raise RuntimeError(f'Postgres util: query error: {error}')
+                fetch_time += time.perf_counter() - start
+                rows += len(raw_batch)
+                if len(raw_batch) == 0:
+                    break
+
+                batch = [dict(zip(headers, row)) for row in raw_batch] if headers is not None else raw_batch
+                if batches:
+                    yield batch
+                else:
+                    yield from batch
+        finally:
+            cursor.close()
+            py_instrument.event('py_postgres.stream', fetch_time, rows)
@@ -0,0 +1,94 @@
+'''
+Python snapshot util
+- on-disk cache of py_table tables, one directory per key under a snapshot directory
+- array columns are stored as .npy files and memory-mapped on load
+- object columns are pickled, categories & nullable columns are kept in meta.json
+- loading a snapshot marks it as used, evict(...) keeps only the most recently used
+'''
+
+import os
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import numpy as np
+
+import py_table
+
+META_FILE = 'meta.json'
+
+def make_key(fingerprint):
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def _path(directory, key):
+    return os.path.join(directory, key)
+
+def save(table, directory, key):
+    path = _path(directory, key)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    meta = {
+        'created': time.time(),
+        'columns': {},
+        'categories': {name: list(categories) for name, categories in table.get('_categories', {}).items()},
+        'nullable': sorted(table.get('_nullable', set()))
+    }
+    for name in py_table.column_names(table):
+        if table[name].dtype == object:
+            with open(os.path.join(tmp_path, f'{name}.pkl'), 'wb') as column_file:
+                pickle.dump(table[name], column_file)
+            meta['columns'][name] = 'pickle'
+        else:
+            np.save(os.path.join(tmp_path, f'{name}.npy'), table[name])
+            meta['columns'][name] = 'npy'
+    with open(os.path.join(tmp_path, META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+# None if there is no snapshot for key
+def load(directory, key):
+    path = _path(directory, key)
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        return None
+    with open(os.path.join(path, META_FILE)) as meta_file:
+        meta = json.load(meta_file)
+
+    table = {'_categories': {}, '_nullable': set(meta['nullable'])}
+    for name, categories in meta['categories'].items():
+        table['_categories'][name] = np.empty(len(categories), dtype=object)
+        table['_categories'][name][:] = categories
+    for name, kind in meta['columns'].items():
+        if kind == 'pickle':
+            with open(os.path.join(path, f'{name}.pkl'), 'rb') as column_file:
+                table[name] = pickle.load(column_file)
+        else:
+            table[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+    os.utime(path)
+    return table
+
+def list_keys(directory):
+    if not os.path.exists(directory):
+        return []
+    return [key for key in os.listdir(directory) if os.path.exists(os.path.join(directory, key, META_FILE))]
+
+# drop one snapshot, or all of them if key is None
+def invalidate(directory, key=None):
+    keys = list_keys(directory) if key is None else [key]
+    for k in keys:
+        if os.path.exists(_path(directory, k)):
+            shutil.rmtree(_path(directory, k))
+    return keys
+
+# keep the keep most recently used snapshots, drop the rest
+def evict(directory, keep):
+    by_last_use = sorted(list_keys(directory), key=lambda k: os.path.getmtime(_path(directory, k)), reverse=True)
+    for key in by_last_use[keep:]:
+        invalidate(directory, key)
+    return by_last_use[keep:]
@@ -0,0 +1,111 @@
+'''
+Python columnar table util
+- a table is a dict of equal length numpy arrays keyed by column name
+- keys starting with '_' hold table metadata, not columns
+    - _categories: {column: object array of categories} for categorical columns, stored as int32 codes
+    - _nullable: set of nullable int columns, stored as float64 with nan for null
+- take(...) keeps all metadata, concat(...) only keeps _categories and _nullable
+'''
+
+import numpy as np
+
+CATEGORY = 'category'
+NULLABLE_INT = 'nullable_int'
+
+def is_column(key):
+    return not key.startswith('_')
+
+def column_names(table):
+    return [k for k in table if is_column(k)]
+
+def length(table):
+    for k in table:
+        if is_column(k):
+            return len(table[k])
+    return 0
+
+def encode(values):
+    index = {}
+    codes = np.fromiter((index.setdefault(v, len(index)) for v in values), dtype=np.int32, count=len(values))
+    categories = np.empty(len(index), dtype=object)
+    categories[:] = list(index)
+    return codes, categories
+
+# columns: {column: list of python values}, schema: {column: numpy dtype, CATEGORY or NULLABLE_INT}
+def from_columns(columns, schema):
+    table = {'_categories': {}, '_nullable': set()}
+    for name, dtype in schema.items():
+        values = columns[name]
+        if dtype == CATEGORY:
+            table[name], table['_categories'][name] = encode(values)
+        elif dtype == NULLABLE_INT:
+            table[name] = np.array([np.nan if v is None or v == '' else v for v in values], dtype=np.float64)
+            table['_nullable'].add(name)
+        else:
+            table[name] = np.array(values, dtype=dtype)
+    return table
+
+# extend a categorical column's categories, existing codes stay valid
+def add_categories(table, column, values):
+    categories = list(table['_categories'][column])
+    categories += [v for v in dict.fromkeys(values) if v not in categories]
+    table['_categories'][column] = np.empty(len(categories), dtype=object)
+    table['_categories'][column][:] = categories
+
+def select(table, columns):
+    return {k: v for k, v in table.items() if not is_column(k) or k in columns}
+
+def take(table, index):
+    return {k: (v[index] if is_column(k) else v) for k, v in table.items()}
+
+def concat(tables):
+    if len(tables) == 0:
+        raise ValueError('py_table.concat: need at least one table')
+    first = tables[0]
+    result = {'_categories': {}, '_nullable': set(first.get('_nullable', set()))}
+    for name in column_names(first):
+        if name in first.get('_categories', {}):
+            index = {}
+            remapped = []
+            for t in tables:
+                lookup = np.array([index.setdefault(c, len(index)) for c in t['_categories'][name]], dtype=np.int32)
+                remapped.append(lookup[t[name]] if len(lookup) else t[name])
+            categories = np.empty(len(index), dtype=object)
+            categories[:] = list(index)
+            result[name] = np.concatenate(remapped)
+            result['_categories'][name] = categories
+        else:
+            result[name] = np.concatenate([t[name] for t in tables])
+    return result
+
+def decode(table, column, index=None):
+    values = table[column] if index is None else table[column][index]
+    if column in table.get('_categories', {}):
+        return table['_categories'][column][values]
+    return values
+
+# codes of the given category values, values not present in the table are ignored
+def category_codes(table, column, values):
+    categories = table['_categories'][column]
+    return np.array([i for i, c in enumerate(categories) if c in values], dtype=np.int32)
+
+def isin(table, column, values):
+    if column in table.get('_categories', {}):
+        return np.isin(table[column], category_codes(table, column, values))
+    return np.isin(table[column], list(values))
+
+def to_lists(table, columns=None, index=None):
+    columns = column_names(table) if columns is None else columns
+    lists = {}
+    for name in columns:
+        values = decode(table, name, index)
+        if name in table.get('_nullable', set()):
+            lists[name] = [None if np.isnan(v) else int(v) for v in values.tolist()]
+        else:
+            lists[name] = values.tolist()
+    return lists
+
+def to_rows(table, columns=None, index=None):
+    lists = to_lists(table, columns, index)
+    names = list(lists.keys())
+    return [dict(zip(names, values)) for values in zip(*lists.values())]
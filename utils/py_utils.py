@@ -1,4 +1,8 @@
 import csv
+import itertools
+
+CSV_BATCH_SIZE = 10000 # rows parsed & cast together
+CSV_BUFFER_SIZE = 2**20 # bytes
 
 def read_csv(filepath):
     with open(filepath) as csv_file:
@@ -16,20 +20,98 @@ def read_csv(filepath):
         print(f'read {line_count} rows from {filepath}')
         return data
 
-def write_csv(filepath, data):
+# cast a column of strings, empty strings become None
+# returns cast values and {position: error} of values that failed to cast
+def _cast_column(values, cast):
+    try:
+        return [None if v == '' else cast(v) for v in values], {}
+    except (ValueError, TypeError):
+        pass
+    # slow path, only taken by batches with bad values
+    cast_values = []
+    bad_values = {}
+    for i, v in enumerate(values):
+        try:
+            cast_values.append(None if v == '' else cast(v))
+        except (ValueError, TypeError) as error:
+            cast_values.append(None)
+            bad_values[i] = error
+    return cast_values, bad_values
+
+# cast raw rows column by column, bad rows are dropped and reported to errors
+def _cast_rows(raw_rows, headers, schema, filepath, first_row, errors):
+    bad_rows = {i: ValueError(f'expected {len(headers)} fields, got {len(row)}') for i, row in enumerate(raw_rows) if len(row) != len(headers)}
+    padded_rows = [row if i not in bad_rows else [''] * len(headers) for i, row in enumerate(raw_rows)] if len(bad_rows) else raw_rows
+
+    columns = [list(column) for column in zip(*padded_rows)]
+    for i, header in enumerate(headers):
+        if header in schema:
+            columns[i], bad_values = _cast_column(columns[i], schema[header])
+            for position, error in bad_values.items():
+                bad_rows.setdefault(position, ValueError(f'{header}: {error}'))
+
+    if len(bad_rows):
+        if errors is not None:
+            for position in sorted(bad_rows):
+                errors.append({'file': filepath, 'row': first_row + position, 'values': raw_rows[position], 'error': bad_rows[position]})
+        columns = [[v for i, v in enumerate(column) if i not in bad_rows] for column in columns]
+    return columns
+
+# reads a csv as a generator of dicts, or of lists of up to batch_size dicts if batches
+# schema: {column: cast function, e.g. int}, columns not in schema stay strings
+# rows that fail to cast are skipped and appended to errors (if given) as {'file', 'row', 'values', 'error'}
+def iter_csv(filepath, schema=None, errors=None, batch_size=CSV_BATCH_SIZE, batches=False):
+    for headers, columns in _iter_csv_columns(filepath, schema, errors, batch_size):
+        batch = [dict(zip(headers, values)) for values in zip(*columns)]
+        if batches:
+            yield batch
+        else:
+            yield from batch
+
+def _iter_csv_columns(filepath, schema, errors, batch_size):
+    with open(filepath, newline='', buffering=CSV_BUFFER_SIZE) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        headers = next(csv_reader, None)
+        if headers is None:
+            return
+        row_count = 0
+        while True:
+            raw_rows = list(itertools.islice(csv_reader, batch_size))
+            if len(raw_rows) == 0:
+                break
+            if schema:
+                columns = _cast_rows(raw_rows, headers, schema, filepath, row_count + 1, errors)
+            else:
+                columns = [list(column) for column in zip(*raw_rows)]
+            row_count += len(raw_rows)
+            yield headers, columns
+
+# reads a csv into {column: list of values}, see iter_csv(...)
+# pass the result to py_table.from_columns(...) for numpy arrays
+def read_csv_columns(filepath, schema=None, errors=None, batch_size=CSV_BATCH_SIZE):
+    data = None
+    for headers, columns in _iter_csv_columns(filepath, schema, errors, batch_size):
+        if data is None:
+            data = {header: [] for header in headers}
+        for header, column in zip(headers, columns):
+            data[header] += column
+    return data if data is not None else {}
+
+def write_csv(filepath, data, headers=None):
+    headers = list(data[0].keys()) if headers is None else headers
+    row_count = write_csv_rows(filepath, headers, ([row.get(h) for h in headers] for row in data))
+    print(f'wrote {row_count} rows to {filepath}')
+
+# one writerows(...) over rows: any iterable of value lists in headers order
+def write_csv_rows(filepath, headers, rows):
+    counter = itertools.count() # zip(...) takes one count per row
     with open(filepath, 'w', newline='') as csv_file:
-        headers = data[0].keys()
-        csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=headers)
-        line_count = 0
-        for row in data:
-            if line_count == 0:
-                csv_writer.writeheader()
-            csv_writer.writerow(row)
-            line_count += 1
-        print(f'wrote {line_count} rows to {filepath}')
+        csv_writer = csv.writer(csv_file, delimiter=',')
+        csv_writer.writerow(headers)
+        csv_writer.writerows(row for row, _ in zip(rows, counter))
+    return next(counter)
 
 def dict_pick(d, keys):
-    #return {x: d[x] for x in d.keys() if x in keys}
     new_dict = {}
     for k in keys:
         if k in d:
@@ -38,14 +120,28 @@ def dict_pick(d, keys):
             new_dict[k] = None
     return new_dict
 
+# copy + pop, faster than rebuilding the dict when few keys are omitted
 def dict_omit(d, keys):
-    return {x: d[x] for x in d if x not in keys}
+    new_dict = d.copy()
+    for k in keys:
+        new_dict.pop(k, None)
+    return new_dict
 
+# order preserving, hash based
+# from the first unhashable value on, falls back to the linear scan over deduped values
 def dedupe(_list):
-    print(f'dedupe recieved: {_list}')
+    seen = set()
     deduped_list = []
-    for val in _list:
-        if val not in deduped_list:
-            deduped_list.append(val)
-    print(f'dedupe returning: {deduped_list}')
-    return deduped_list
\ No newline at end of file
+    values = iter(_list)
+    for val in values:
+        try:
+            if val in seen:
+                continue
+            seen.add(val)
+        except TypeError:
+            for val in itertools.chain([val], values):
+                if val not in deduped_list:
+                    deduped_list.append(val)
+            return deduped_list
+        deduped_list.append(val)
+    return deduped_list